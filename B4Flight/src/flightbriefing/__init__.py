@@ -55,16 +55,23 @@ def create_app(test_config=None):
     map_flight_route_opacity = cfg.get('maps','flight_route_opacity')
     map_bounds_min_coords = (int(cfg.get('maps','limit_min_lon')), int(cfg.get('maps','limit_max_lat')))
     map_bounds_max_coords = (int(cfg.get('maps','limit_max_lon')), int(cfg.get('maps','limit_min_lat')))
+    tile_cache_folder = os.path.join(app.instance_path, cfg.get('maps','tile_cache_folder'))
+    map_coord_precision = int(cfg.get('maps','coordinate_precision'))
+    map_overview_zoom = int(cfg.get('maps','overview_zoom'))
     working_folder = os.path.join(app.instance_path, cfg.get('application','working_folder'))
     upload_archive_folder = os.path.join(app.instance_path, cfg.get('application','upload_archive_folder'))
     notam_archive_folder = os.path.join(app.instance_path, cfg.get('notam_import_ZA','archive_folder'))
+    briefing_check_interval = int(cfg.get('notam_import_ZA','briefing_check_interval'))
+    briefing_diff_depth = int(cfg.get('notam_import_ZA','briefing_diff_depth'))
     database_connect_string = cfg.get('database','connect_string')
     database_pool_recycle = int(cfg.get('database','pool_recycle'))
+    query_repeat_threshold = int(cfg.get('database','query_repeat_threshold'))
     default_home_aerodrome = cfg.get('defaults','home_aerodrome')
     default_home_radius = int(cfg.get('defaults','home_radius'))
     default_route_buffer = int(cfg.get('defaults','route_buffer'))
     default_map_radius_filter = int(cfg.get('defaults','map_radius_filter'))
     default_flight_route_colour = cfg.get('defaults', 'flight_route_colour')
+    default_cruise_speed = int(cfg.get('defaults', 'cruise_speed'))
     email_host = cfg.get('email','email_host')
     email_host_user = cfg.get('email','email_host_user')
     email_host_password = cfg.get('email','email_host_password')
@@ -77,6 +84,12 @@ def create_app(test_config=None):
     weather_sigmet_airmet_url_ZA = cfg.get('weather','sigmet_airmet_url_ZA')
     weather_metar_url_ZA = cfg.get('weather','metar_url_ZA')
     weather_taf_url_ZA = cfg.get('weather','taf_url_ZA')
+    weather_archive_folder = os.path.join(app.instance_path, cfg.get('weather','archive_folder'))
+    weather_cache_ttl = int(cfg.get('weather','cache_ttl'))
+    weather_request_timeout = float(cfg.get('weather','request_timeout'))
+    weather_breaker_failures = int(cfg.get('weather','breaker_failures'))
+    weather_breaker_latency = float(cfg.get('weather','breaker_latency'))
+    weather_breaker_reset = float(cfg.get('weather','breaker_reset'))
     weather_sigmet_colour = cfg.get('weather','sigmet_colour')
     weather_sigmet_opacity = cfg.get('weather','sigmet_opacity')
     weather_airmet_colour = cfg.get('weather','airmet_colour')
@@ -100,17 +113,24 @@ def create_app(test_config=None):
         MAP_FLIGHT_ROUTE_OPACITY=map_flight_route_opacity, # The opacity to be used for the flight route
         MAP_BOUNDS_MIN_COORDS=map_bounds_min_coords, # The min bounds to limit the map to - South-West point
         MAP_BOUNDS_MAX_COORDS=map_bounds_max_coords, # The max bounds to limit the map to - North-East point
+        TILE_CACHE_FOLDER=tile_cache_folder, # Vector tiles cut from the current briefing's NOTAMs
+        MAP_COORD_PRECISION=map_coord_precision, # Decimal places kept in GEOJSON co-ordinates sent to the map
+        MAP_OVERVIEW_ZOOM=map_overview_zoom, # Zoom levels below this get simplified NOTAM geometry
         WORKING_FOLDER=working_folder, #temp folder
         UPLOAD_ARCHIVE_FOLDER=upload_archive_folder, #Saved copies of uploaded route files - for debugging
         NOTAM_ARCHIVE_FOLDER=notam_archive_folder, #saved copied of NOTAM files - for debugging / historical 
+        BRIEFING_CHECK_INTERVAL=briefing_check_interval, #Seconds between checks for a briefing imported by another process
+        BRIEFING_DIFF_DEPTH=briefing_diff_depth, #Number of earlier briefings each imported briefing's new/deleted Notams are stored against
         DATABASE_CONNECT_STRING=database_connect_string, #connection string to database
         DATABASE_POOL_RECYCLE=database_pool_recycle, #limit timeouts - refer to https://help.pythonanywhere.com/pages/UsingMySQL
+        QUERY_REPEAT_THRESHOLD=query_repeat_threshold, #in debug mode, a SELECT repeated more than this many times in a request is logged
         MAX_CONTENT_LENGTH=3*1024*1024, 
         DEFAULT_HOME_AERODROME=default_home_aerodrome, #Default home aerodrome in ICAO format - for users without this setting
         DEFAULT_HOME_RADIUS=default_home_radius, #Default radius around home aerodrome in ICAO format - for users without this setting
         DEFAULT_ROUTE_BUFFER=default_route_buffer, #Default route buffer in nm - for users without this setting
         DEFAULT_MAP_RADIUS_FILTER=default_map_radius_filter, #Default initial radius filter on map
         DEFAULT_FLIGHT_ROUTE_COLOUR=default_flight_route_colour, #Default colour for the flight rourt on the map - for users without this setting
+        DEFAULT_CRUISE_SPEED=default_cruise_speed, #Default cruise speed in knots, used for expected times along a route - for users without this setting
         EMAIL_HOST = email_host, #Email host name
         EMAIL_HOST_USER = email_host_user, #Email host username
         EMAIL_HOST_PASSWORD = email_host_password, #Email host password
@@ -123,6 +143,12 @@ def create_app(test_config=None):
         WEATHER_SIGMET_AIRMET_URL_ZA = weather_sigmet_airmet_url_ZA, #URL for ZA Sigmets and Airmets
         WEATHER_METAR_URL_ZA = weather_metar_url_ZA, #URL for ZA Metars
         WEATHER_TAF_URL_ZA = weather_taf_url_ZA, #URL for ZA TAFs
+        WEATHER_ARCHIVE_FOLDER = weather_archive_folder, #History of scraped METARs and TAFs
+        WEATHER_CACHE_TTL = weather_cache_ttl, #Seconds before scraped weather is refreshed
+        WEATHER_REQUEST_TIMEOUT = weather_request_timeout, #Seconds to wait for a weather page
+        WEATHER_BREAKER_FAILURES = weather_breaker_failures, #Consecutive failures before a weather host's circuit breaker opens
+        WEATHER_BREAKER_LATENCY = weather_breaker_latency, #Responses slower than this (seconds) count as failures
+        WEATHER_BREAKER_RESET = weather_breaker_reset, #Seconds a weather host's circuit breaker stays open
         WEATHER_AIRMET_COLOUR = weather_airmet_colour, #Colour for AIRMETs on the map
         WEATHER_AIRMET_OPACITY = weather_airmet_opacity, #opacity for AIRMETs on the map
         WEATHER_SIGMET_COLOUR = weather_sigmet_colour, #colour for SIGMETs on the map
@@ -168,14 +194,38 @@ def create_app(test_config=None):
     if not os.path.exists(app.config['NOTAM_ARCHIVE_FOLDER']):
         os.makedirs(app.config['NOTAM_ARCHIVE_FOLDER'])
 
+    if not os.path.exists(app.config['WEATHER_ARCHIVE_FOLDER']):
+        os.makedirs(app.config['WEATHER_ARCHIVE_FOLDER'])
+
+    if not os.path.exists(app.config['TILE_CACHE_FOLDER']):
+        os.makedirs(app.config['TILE_CACHE_FOLDER'])
+
     from . import db
     db.init_app(app)
     
     from . import notam_import
     notam_import.init_app(app)
 
+    from . import weather_archive
+    weather_archive.init_app(app)
+
+    from . import geojson_output
+    geojson_output.init_app(app)
+
+    from . import briefing_cache
+    briefing_cache.init_app(app)
+
+    from . import query_monitor
+    query_monitor.init_app(app)
+
     from . import viewmap
     app.register_blueprint(viewmap.bp)
+
+    from . import map_tiles
+    app.register_blueprint(map_tiles.bp)
+
+    from . import map_clusters
+    app.register_blueprint(map_clusters.bp)
     
     from . import auth
     app.register_blueprint(auth.bp)
@@ -40,11 +40,13 @@ def settings():
     sqa_sess = sqa_session()
     user = sqa_sess.query(User).get(session['userid'])
     
-    # Retrieve UserSetting objects for available settings 
-    home_aerodrome = UserSetting.get_setting(session['userid'], 'home_aerodrome') # Home Aerodrome 
-    home_radius = UserSetting.get_setting(session['userid'], 'home_radius') # Radius around Home AD to show notams for, in nm
-    route_buffer = UserSetting.get_setting(session['userid'], 'route_buffer') # Buffer along route to show notams for, in nm
-    map_radius_filter = UserSetting.get_setting(session['userid'], 'map_radius_filter') # Initial Radius filter on maps
+    # Retrieve the available settings in one query:
+    # - home_aerodrome: Home Aerodrome 
+    # - home_radius: Radius around Home AD to show notams for, in nm
+    # - route_buffer: Buffer along route to show notams for, in nm
+    # - map_radius_filter: Initial Radius filter on maps
+    # - cruise_speed: Cruise speed in kt, for expected times along a route
+    settings = UserSetting.get_setting_values(session['userid'], ['home_aerodrome', 'home_radius', 'route_buffer', 'map_radius_filter', 'cruise_speed'])
 
     # If user is saving changes
     if request.method == "POST":
@@ -73,47 +75,60 @@ def settings():
         if errors == True:
             return render_template('account/settings.html', user=user, 
                            home_aerodrome=request.form['home_aerodrome'], home_radius=request.form['home_radius'],
-                           route_buffer=request.form['route_buffer'], map_radius_filter=request.form['map_radius_filter'])
+                           route_buffer=request.form['route_buffer'], map_radius_filter=request.form['map_radius_filter'],
+                           cruise_speed=request.form['cruise_speed'])
         
         # Otherwise no errors, so update the user's details
         user.Firstname = request.form['firstname']
         user.Lastname = request.form['lastname']
-        home_aerodrome.SettingValue = request.form['home_aerodrome']
+        settings['home_aerodrome'] = request.form['home_aerodrome']
 
         # Numeric type is specified on the HTML form - this is a backup check,
         # and to avoid frustration to user, we simply apply the default setting if not numeric 
         if not request.form['home_radius'].isnumeric():
             flash(f"Your home aerodrome Radius didn't seem to be numeric - we defaulted it to {current_app.config['DEFAULT_HOME_RADIUS']}nm.", 'error')
-            home_radius.SettingValue = current_app.config['DEFAULT_HOME_RADIUS']
+            settings['home_radius'] = current_app.config['DEFAULT_HOME_RADIUS']
         # otherwise value is numeric so update setting
         else:
-            home_radius.SettingValue = request.form['home_radius']
+            settings['home_radius'] = request.form['home_radius']
 
         # Numeric type is specified on the HTML form - this is a backup check,
         # and to avoid frustration to user, we simply apply the default setting if not numeric
         if not request.form['route_buffer'].isnumeric():
             flash(f"Your Route Buffer didn't seem to be numeric - we defaulted it to {current_app.config['DEFAULT_ROUTE_BUFFER']}nm.", 'error')
-            route_buffer.SettingValue = current_app.config['DEFAULT_ROUTE_BUFFER']
+            settings['route_buffer'] = current_app.config['DEFAULT_ROUTE_BUFFER']
         # otherwise value is numeric so update setting
         else:
-            route_buffer.SettingValue = request.form['route_buffer']
+            settings['route_buffer'] = request.form['route_buffer']
 
         # Numeric type is specified on the HTML form - this is a backup check,
         # and to avoid frustration to user, we simply apply the default setting if not numeric
         if not request.form['map_radius_filter'].isnumeric():
             flash(f"Your initial NOTAM Radius Filter didn't seem to be numeric - we defaulted it to {current_app.config['DEFAULT_MAP_RADIUS_FILTER']}nm.", 'error')
-            map_radius_filter.SettingValue = current_app.config['DEFAULT_MAP_RADIUS_FILTER']
+            settings['map_radius_filter'] = current_app.config['DEFAULT_MAP_RADIUS_FILTER']
         # otherwise value is numeric so update setting
         else:
-            map_radius_filter.SettingValue = request.form['map_radius_filter']
+            settings['map_radius_filter'] = request.form['map_radius_filter']
 
-        # Commit changes and add a flask FLASH message to show success
+        # Numeric type is specified on the HTML form - this is a backup check,
+        # and to avoid frustration to user, we simply apply the default setting if not numeric
+        if not request.form['cruise_speed'].isnumeric():
+            flash(f"Your Cruise Speed didn't seem to be numeric - we defaulted it to {current_app.config['DEFAULT_CRUISE_SPEED']}kt.", 'error')
+            settings['cruise_speed'] = current_app.config['DEFAULT_CRUISE_SPEED']
+        # otherwise value is numeric so update setting
+        else:
+            settings['cruise_speed'] = request.form['cruise_speed']
+
+        # Save the settings (creating any the user didn't have), then commit them with the user's details
+        # and add a flask FLASH message to show success
+        UserSetting.set_settings(session['userid'], settings, commit=False)
         sqa_sess.commit()
         flash('Your details were successfully updated.','success')
     
     return render_template('account/settings.html', user=user, 
-                           home_aerodrome=home_aerodrome.SettingValue, home_radius=home_radius.SettingValue, 
-                           route_buffer=route_buffer.SettingValue, map_radius_filter=map_radius_filter.SettingValue)
+                           home_aerodrome=settings['home_aerodrome'], home_radius=settings['home_radius'], 
+                           route_buffer=settings['route_buffer'], map_radius_filter=settings['map_radius_filter'],
+                           cruise_speed=settings['cruise_speed'])
 
 
 @bp.route('/hidenotam', methods=('POST',))
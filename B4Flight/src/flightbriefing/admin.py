@@ -18,6 +18,7 @@ from . import helpers
 from .auth import requires_login
 from .db import User, Briefing, FlightPlan
 from .notam_import import import_notam_ZA, get_latest_CAA_briefing_date_ZA
+from .current_briefing import get_current_briefing
 from .data_handling import sqa_session    #sqa_session is the Session object for the site
 
 
@@ -40,9 +41,8 @@ def import_notams_ZA():
     sqa_sess = sqa_session()
     
     # Get the latest briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
+    briefing = get_current_briefing()
     first_brief_id = sqa_sess.query(func.min(Briefing.BriefingID)).first()[0]
-    briefing = sqa_sess.query(Briefing).get(latest_brief_id)
 
     # Get stats for display on page - earliest briefing and number of briefings
     first_briefing = sqa_sess.query(Briefing).get(first_brief_id)
@@ -4,6 +4,13 @@ APIs allow for Cross-Origin call (using https://pypi.org/project/Flask-Cors/)
 
 APIs exposed are: 
 - get_metar_za: return Metars in a JSON format for ZA aerodromes 
+- metar: return Metars in a JSON format, filtered by aerodrome, bounding box or radius
+- taf: return TAFs in a JSON format, filtered by aerodrome, bounding box or radius
+- sigmet: return SIGMETs and AIRMETs in a JSON format, filtered by bounding box or radius
+
+Weather is served from the cached weather snapshot.  Responses carry an ETag and Cache-Control header, and 
+a request with a matching If-None-Match header gets a 304 (Not Modified) response with no body.
+If the upstream weather source is down, the last good reports are returned with an X-Weather-Stale-Since header
  
 """
 
@@ -12,16 +19,139 @@ APIs exposed are:
 import json
 
 from flask import (
-    Blueprint, request, session, current_app
+    Blueprint, request, session, Response
 )
 
 from flask_cors import CORS #CORS allows for cross-origin requests
 
-from .weather import read_metar_ZA
+from .weather_cache import get_weather_snapshot, content_hash, SIGMET_LAYER, METAR_LAYER, TAF_LAYER
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 CORS(bp)
 
+def _read_weather_filters(req_data):
+    """Reads the weather filters from the request's query string (GET) or JSON body (POST)
+    
+    Parameters
+    ----------
+    req_data : dict
+        The request's arguments - the query string, or the JSON body, which must be an object
+    
+    Returns
+    -------
+    dict
+        icao_codes: list of ICAO codes, or None
+        bbox: (min lon, min lat, max lon, max lat), or None
+        point: (lon, lat), or None
+        radius_nm: radius around the point in nm, or None
+    
+    Raises
+    ------
+    ValueError
+        If a filter could not be read
+    """
+    
+    # A JSON body could be any JSON value - only an object holds filters
+    if not isinstance(req_data, dict):
+        raise ValueError('the request body must be a JSON object')
+    
+    # ICAO codes can be comma separated and/or repeated (GET), or a list (POST)
+    icao_codes = None
+    if hasattr(req_data, 'getlist'):
+        icao = ','.join(req_data.getlist('icao'))
+    else:
+        icao = req_data.get('icao')
+    if icao:
+        if isinstance(icao, str):
+            icao = icao.split(',')
+        if not isinstance(icao, list) or not all(isinstance(code, str) for code in icao):
+            raise ValueError('icao must be a list of ICAO codes')
+        icao_codes = [code.strip().upper() for code in icao if code.strip()]
+    
+    # Bounding box as min lon, min lat, max lon, max lat
+    bbox = req_data.get('bbox')
+    if bbox:
+        if isinstance(bbox, str):
+            bbox = bbox.split(',')
+        bbox = tuple(float(b) for b in bbox)
+        if len(bbox) != 4:
+            raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+    else:
+        bbox = None
+    
+    # Radius in nm around a point
+    point = None
+    radius_nm = None
+    if req_data.get('radius'):
+        if req_data.get('lat') is None or req_data.get('lon') is None:
+            raise ValueError('radius needs a lat and lon')
+        point = (float(req_data.get('lon')), float(req_data.get('lat')))
+        radius_nm = float(req_data.get('radius'))
+    
+    return {'icao_codes': icao_codes, 'bbox': bbox, 'point': point, 'radius_nm': radius_nm}
+
+
+def _weather_response(layer_name, filters):
+    """Creates the response for a weather API call from the cached weather snapshot.  
+    The ETag is a hash of the reports returned, so it only changes when they do - the same in every web process, and across 
+    weather refreshes that bring no new or amended reports; if the client already has these reports (If-None-Match), 
+    a 304 is returned without a body
+    
+    Parameters
+    ----------
+    layer_name : str
+        SIGMET_LAYER, METAR_LAYER or TAF_LAYER
+    filters : dict
+        As returned by _read_weather_filters
+    
+    Returns
+    -------
+    Response
+    """
+    
+    weather = get_weather_snapshot()
+    newest = weather.newest[layer_name]
+    
+    # The reports are already serialized - joining them is cheap, so build the body to tag it by its content
+    body = weather.filter_reports(layer_name, **filters)
+    etag = f'{layer_name}-{content_hash(body)}'
+    
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype='application/json')
+        if newest:
+            resp.last_modified = newest
+    
+    # Let clients know if the upstream source is down, and these are the last good reports
+    stale_since = weather.stale_since[layer_name]
+    if stale_since:
+        resp.headers['X-Weather-Stale-Since'] = stale_since.isoformat()
+    
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    # Clients can keep the response until the cached weather is next refreshed
+    resp.cache_control.max_age = weather.max_age()
+    
+    return resp
+
+
+def _weather_api(layer_name):
+    """Reads the filters for a weather API call, and returns the response - or a 400 if the filters are not valid"""
+    
+    if request.method == 'POST':
+        req_data = request.get_json(silent=True) or {}
+    else:
+        req_data = request.args
+    
+    try:
+        filters = _read_weather_filters(req_data)
+    except (ValueError, TypeError) as e:
+        return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+    
+    return _weather_response(layer_name, filters)
+
+
 @bp.route('/get_metar_za', methods=('POST','GET'))
 def get_metar_za():
     """API to return Metars in a JSON format for ZA aerodromes
@@ -42,26 +172,20 @@ def get_metar_za():
             body: full body of the METAR
             coords: co-ord pair for the aerodrome - LONG, LAT in decimal degrees
             
-            If no data found, returns: {'error': 'No data found'}
+            If no data found, returns: []
     
     """
 
-    metars = read_metar_ZA(current_app.config['WEATHER_METAR_URL_ZA'], date_as_ISO_text=True)
-    
-
     filter_aerodrome = None
     
     if request.method == 'GET':
         # Get the aerodrome to filter by
-        try:
-            filter_aerodrome = request.args.get('aerodrome')
-        except:
-            filter_aerodrome = None
+        filter_aerodrome = request.args.get('aerodrome')
     
     # Process the request's data
     if request.method == 'POST':
         # Get data in JSON format
-        req_data = request.get_json()
+        req_data = request.get_json(silent=True)
 
         # If there is request data then process it
         if req_data:
@@ -71,14 +195,66 @@ def get_metar_za():
             except:
                 filter_aerodrome = None
         
-    #If we have an aerodrome to filter by
-    if filter_aerodrome:    
-        metar_filter = filter(lambda met: met['aerodrome'] == filter_aerodrome, metars)
-        metars = list(metar_filter)
-        
-    #If nothing returned, then error
-    if len(metars) == 0: 
-        return json.dumps([])
+    # Return the metars - for the aerodrome if one was given
+    return _weather_response(METAR_LAYER, {'icao_codes': [filter_aerodrome] if filter_aerodrome else None, 
+                                           'bbox': None, 'point': None, 'radius_nm': None})
+
+
+@bp.route('/metar', methods=('POST','GET'))
+def metar():
+    """API to return Metars in a JSON format
+    
+    Expects (query string for GET, JSON for POST) - all optional, and combined if more than one is given:
+            icao: ICAO codes - comma separated (or repeated) - eg. icao=FAOR,FACT
+            bbox: bounding box - min_lon,min_lat,max_lon,max_lat
+            lat, lon, radius: radius in nm around a point
+    
+    Returns: json array of METAR objects - refer get_metar_za
+            If filters could not be read, returns 400: {'error': description}
+    """
+    return _weather_api(METAR_LAYER)
+
+
+@bp.route('/taf', methods=('POST','GET'))
+def taf():
+    """API to return TAFs in a JSON format
+    
+    Expects (query string for GET, JSON for POST) - all optional, and combined if more than one is given:
+            icao: ICAO codes - comma separated (or repeated) - eg. icao=FAOR,FACT
+            bbox: bounding box - min_lon,min_lat,max_lon,max_lat
+            lat, lon, radius: radius in nm around a point
+    
+    Returns: json array of objects:
+            aerodrome: ICAO code
+            is_amended_corrected: boolean
+            time: date and time of the TAF
+            valid_from: date and time the TAF is valid from
+            valid_to: date and time the TAF is valid to
+            periods: base forecast and change groups (FM/BECMG/TEMPO/PROB)
+            body: full body of the TAF
+            coords: co-ord pair for the aerodrome - LONG, LAT in decimal degrees
             
-    # Return the metars
-    return json.dumps(metars)
+            If filters could not be read, returns 400: {'error': description}
+    """
+    return _weather_api(TAF_LAYER)
+
+
+@bp.route('/sigmet', methods=('POST','GET'))
+def sigmet():
+    """API to return SIGMETs and AIRMETs in a JSON format
+    
+    Expects (query string for GET, JSON for POST) - all optional, and combined if more than one is given:
+            bbox: bounding box - min_lon,min_lat,max_lon,max_lat
+            lat, lon, radius: radius in nm around a point
+    
+    Returns: json array of objects:
+            type: SIGMET / AIRMET
+            valid_from: date and time
+            valid_to: date and time
+            body: body of the Sigmet/Airmet
+            coords: list of co-ord pairs - LONG, LAT in decimal degrees
+            flevels: vertical limits
+            
+            If filters could not be read, returns 400: {'error': description}
+    """
+    return _weather_api(SIGMET_LAYER)
@@ -0,0 +1,479 @@
+"""Caches the Classification of NOTAMs and Weather for Printed Flight Briefings
+
+A printed flight briefing (refer viewmap.flightmap) places NOTAMs and weather into departure, destination and
+en-route sections using several spatial filters.  Users often print, change the Notams they have hidden, and print again -
+so the classification is cached, and only the hidden-NOTAM presentation is worked out for each print:
+- NOTAMs are keyed by (FlightplanID, BriefingID, flight date, route buffer) - a flight's route cannot be changed,
+  and a briefing's NOTAMs do not change.  The Notam IDs are cached, and the Notams read back in one query
+- Weather is filtered from the weather snapshot, and keyed by (FlightplanID, flight date, route buffer, snapshot version), 
+  so it is re-filtered once the weather is refreshed (refer weather_cache)
+- The weather along a flight's route is also cached as serialized GEOJSON layers for the flight's map, under the same key
+
+After each NOTAM import, a background job classifies the new briefing's NOTAMs for every flight (under its owner's
+route buffer, without a flight date) and stores them as lists of NotamIDs (FlightBriefingNotams) - so a flight's
+briefing and the dashboard read the stored lists, rather than filtering the briefing when first viewed.  From the command line:
+ - precompute-flight-briefings
+
+"""
+
+import threading
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from . import flightplans
+from .db import Notam, FlightPlan, FlightBriefingNotams, UserSetting, NOTAM_LOAD_OPTIONS, FLIGHTPLAN_LOAD_OPTIONS
+from .data_handling import sqa_session    #sqa_session is the Session object for the site
+from .weather import generate_sigmet_geojson, generate_metar_geojson, generate_taf_geojson
+from .weather_cache import get_weather_snapshot, content_hash, SIGMET_LAYER, METAR_LAYER, TAF_LAYER
+from .geojson_output import dumps_geojson
+from .current_briefing import get_current_briefing
+
+
+# Number of flights' NOTAM and weather classifications to keep
+BRIEFING_CACHE_SIZE = 64
+
+# The Flight Briefing sections
+DEPART = 'depart'
+DEST = 'dest'
+ENROUTE = 'enroute'
+
+
+class FlightWeatherClassification():
+    """
+    A Class to represent a flight's weather, placed in the briefing sections - as the weather records
+    (MetarObservation, TafForecast, SigmetReport).  Use to_dict() on the records for the templates
+
+    Attributes
+    ----------
+    sigairmets : list
+        SigmetReports along the route
+    metars, tafs : dict
+        Briefing section (DEPART, DEST, ENROUTE): list of MetarObservations / TafForecasts
+    """
+
+    __slots__ = ('sigairmets', 'metars', 'tafs')
+
+    def __init__(self, sigairmets, metars, tafs):
+        self.sigairmets = sigairmets
+        self.metars = metars
+        self.tafs = tafs
+
+    def __repr__(self):
+        return f'<FlightWeatherClassification {len(self.sigairmets)} SIGMET/AIRMETs, {sum(len(m) for m in self.metars.values())} METARs>'
+
+
+class FlightWeatherLayers():
+    """
+    A Class to represent the weather along a flight's route as map layers, serialized once for all requests for the flight's map
+
+    Attributes
+    ----------
+    layers : dict
+        Layer name (SIGMET_LAYER, METAR_LAYER, TAF_LAYER): GEOJSON Feature list, serialized to UTF-8 bytes
+    layer_hashes : dict
+        Layer name: hash of the serialized layer (hex text), for ETags
+    report_counts : dict
+        Layer name: number of reports in the layer - the map only fetches layers with reports
+    used_groups, used_layers : list
+        The weather groups and map layers with reports, for the map filters
+    """
+
+    __slots__ = ('layers', 'layer_hashes', 'report_counts', 'used_groups', 'used_layers')
+
+    def __init__(self, sigairmets, metars, tafs):
+        sigair_features, self.used_groups, self.used_layers = generate_sigmet_geojson(sigairmets)
+        self.layers = {SIGMET_LAYER: dumps_geojson(sigair_features),
+                       METAR_LAYER: dumps_geojson(generate_metar_geojson(metars)),
+                       TAF_LAYER: dumps_geojson(generate_taf_geojson(tafs))}
+        self.layer_hashes = {layer_name: content_hash(layer) for layer_name, layer in self.layers.items()}
+        self.report_counts = {SIGMET_LAYER: len(sigairmets), METAR_LAYER: len(metars), TAF_LAYER: len(tafs)}
+
+        # METAR and TAF symbols are only shown in the filters if there are reports
+        if metars:
+            self.used_groups.append('METAR')
+            self.used_layers.append('METAR_symbol')
+        if tafs:
+            self.used_groups.append('TAF')
+            self.used_layers.append('TAF_symbol')
+
+    def __repr__(self):
+        return f'<FlightWeatherLayers {self.report_counts}>'
+
+
+_notam_classifications = {}
+_weather_classifications = {}
+_weather_layers = {}
+_cache_lock = threading.Lock()
+
+
+def _cache_put(cache, key, value):
+    """ Adds a classification to a cache, dropping the oldest once the cache is full """
+
+    with _cache_lock:
+        while len(cache) >= BRIEFING_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = value
+
+
+def _split_sections(depart_notams, dest_notams, route_notams):
+    """ Places NOTAMs into the briefing sections - the destination section excludes the departure NOTAMs,
+    and the en-route section excludes both.  Works with Notams or NotamIDs - returns {section: list} """
+
+    # Remove Notams applicable to the departure point from the dest and en-route lists,
+    # and Notams applicable to the dest point from the en-route list - using sets, rather than searching the lists
+    depart_set = set(depart_notams)
+    dest_notams = [ntm for ntm in dest_notams if ntm not in depart_set]
+    dest_set = set(dest_notams)
+    enroute_notams = [ntm for ntm in route_notams if ntm not in depart_set and ntm not in dest_set]
+
+    return {DEPART: depart_notams, DEST: dest_notams, ENROUTE: enroute_notams}
+
+
+def _read_notams(notam_ids):
+    """ Reads Notams by NotamID in one query - returns a list in the order of the IDs """
+
+    if not notam_ids:
+        return []
+
+    sqa_sess = sqa_session()
+    notams = {ntm.NotamID: ntm for ntm in sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.NotamID.in_(notam_ids)).all()}
+
+    return [notams[notam_id] for notam_id in notam_ids if notam_id in notams]
+
+
+def _filter_flight_notams(flight, flight_date, buffer_nm):
+    """ Filters the NOTAMs near a flight's departure and destination, and along its route - returns (depart, dest, route) lists of Notams """
+
+    # Get the departure point and destination point for the flight plan
+    depart = flight.FlightPlanPoints[0]
+    dest = flight.FlightPlanPoints[-1]
+
+    # Get NOTAMS within 5nm of dep and dest.
+    # If the departure and destination are the same, only get for departure point
+    depart_notams = flightplans.filter_point_notams(depart.Longitude, depart.Latitude, 5, True, flight_date)
+    if depart.Latitude == dest.Latitude and depart.Longitude == dest.Longitude:
+        dest_notams = []
+    # Otherwise get for destination
+    else:
+        dest_notams = flightplans.filter_point_notams(dest.Longitude, dest.Latitude, 5, True, flight_date)
+
+    # Filter by flight date if one is given
+    route_notams = flightplans.filter_route_notams(flight.FlightplanID, buffer_nm, date_of_flight=flight_date)
+
+    return depart_notams, dest_notams, route_notams
+
+
+def get_flight_notams(flight, briefing_id, flight_date, buffer_nm):
+    """ Function to return the NOTAMs for a flight's briefing, placed in the briefing sections.
+    Cached by (FlightplanID, BriefingID, flight date, route buffer)
+
+    Parameters
+    ----------
+    flight : FlightPlan
+        The flight
+    briefing_id : int
+        The Briefing the NOTAMs come from (the latest)
+    flight_date : date or None
+        Only include NOTAMs applicable on this date
+    buffer_nm : int
+        Width of the buffer along the route in nautical miles
+
+    Returns
+    -------
+    dict
+        Briefing section (DEPART, DEST, ENROUTE): list of Notam objects
+    """
+
+    key = (flight.FlightplanID, briefing_id, flight_date, int(buffer_nm))
+
+    notam_ids = _notam_classifications.get(key)
+
+    # Without a flight date, the Notams may have been precomputed when the briefing was imported
+    if notam_ids is None and flight_date is None:
+        precomputed = get_precomputed_notam_ids(flight.FlightplanID, briefing_id, buffer_nm)
+        if precomputed is not None:
+            notam_ids = _split_sections(*precomputed)
+            _cache_put(_notam_classifications, key, notam_ids)
+
+    if notam_ids is None:
+        sections = _split_sections(*_filter_flight_notams(flight, flight_date, buffer_nm))
+        _cache_put(_notam_classifications, key, {section: [ntm.NotamID for ntm in notams] for section, notams in sections.items()})
+        return sections
+
+    # Read the Notams back in one query, keeping each section's order
+    all_notams = {ntm.NotamID: ntm for ntm in _read_notams([notam_id for ids in notam_ids.values() for notam_id in ids])}
+
+    return {section: [all_notams[notam_id] for notam_id in ids if notam_id in all_notams] for section, ids in notam_ids.items()}
+
+
+def get_flight_route_notams(flight, briefing_id, flight_date, buffer_nm):
+    """ Function to return all the NOTAMs along a flight's route (for the flight's map) - read from the lists precomputed
+    when the briefing was imported if they can be used, otherwise filtered from the briefing
+
+    Parameters
+    ----------
+    flight : FlightPlan
+        The flight
+    briefing_id : int
+        The Briefing the NOTAMs come from (the latest)
+    flight_date : date or None
+        Only include NOTAMs applicable on this date
+    buffer_nm : int
+        Width of the buffer along the route in nautical miles
+
+    Returns
+    -------
+    list
+        List of Notam objects
+    """
+
+    if flight_date is None:
+        precomputed = get_precomputed_notam_ids(flight.FlightplanID, briefing_id, buffer_nm)
+        if precomputed is not None:
+            return _read_notams(precomputed[2])
+
+    return flightplans.filter_route_notams(flight.FlightplanID, buffer_nm, date_of_flight=flight_date)
+
+
+def get_precomputed_notam_ids(flight_id, briefing_id, buffer_nm):
+    """ Function to return the NotamIDs precomputed for a flight's briefing, if they were computed with this route buffer
+
+    Parameters
+    ----------
+    flight_id : int
+        ID of the flight
+    briefing_id : int
+        The Briefing the NOTAMs come from
+    buffer_nm : int
+        Width of the buffer along the route in nautical miles
+
+    Returns
+    -------
+    tuple or None
+        (departure, destination, route) lists of NotamIDs - or None if they have not been precomputed
+    """
+
+    sqa_sess = sqa_session()
+    stored = sqa_sess.query(FlightBriefingNotams).get((flight_id, briefing_id))
+
+    # The owner may have changed their route buffer since the briefing was imported
+    if stored is None or stored.Route_Buffer != int(buffer_nm):
+        return None
+
+    return (FlightBriefingNotams.notam_ids(stored.Depart_Notam_IDs), FlightBriefingNotams.notam_ids(stored.Dest_Notam_IDs),
+            FlightBriefingNotams.notam_ids(stored.Route_Notam_IDs))
+
+
+def precompute_flight_briefings(briefing_id):
+    """ Classifies a briefing's NOTAMs for every flight that has not been deleted, under each owner's route buffer,
+    and stores them as lists of NotamIDs (FlightBriefingNotams).  Lists stored for earlier briefings are removed
+
+    Parameters
+    ----------
+    briefing_id : int
+        The Briefing just imported - this must be the latest briefing, as the route filters use the latest briefing
+
+    Returns
+    -------
+    int
+        Number of flights precomputed
+    """
+
+    sqa_sess = sqa_session()
+
+    # The route filters read the current briefing - if another briefing has been imported since, leave it to that briefing's job
+    latest_brief_id = get_current_briefing().BriefingID
+    if latest_brief_id != briefing_id:
+        current_app.logger.info(f'Flight briefings not precomputed for briefing {briefing_id} - briefing {latest_brief_id} is the latest')
+        return 0
+
+    # Route buffers of the flights' owners - read once per owner
+    user_buffers = {}
+    flight_count = 0
+
+    for flight in sqa_sess.query(FlightPlan).options(*FLIGHTPLAN_LOAD_OPTIONS).filter(FlightPlan.Is_Deleted == False).all():
+        if not flight.FlightPlanPoints:
+            continue
+
+        if flight.UserID not in user_buffers:
+            user_buffers[flight.UserID] = int(UserSetting.get_setting(flight.UserID, 'route_buffer', create_if_missing=False).SettingValue)
+        buffer_nm = user_buffers[flight.UserID]
+
+        try:
+            depart_notams, dest_notams, route_notams = _filter_flight_notams(flight, None, buffer_nm)
+        except Exception as e:
+            current_app.logger.error(f'Error precomputing the briefing for flight {flight.FlightplanID}: {e}')
+            continue
+
+        # The lists are stored whole - the route list is used by the flight's map, and the sections are split when read
+        id_text = lambda notams: ' '.join(str(ntm.NotamID) for ntm in notams)
+
+        sqa_sess.merge(FlightBriefingNotams(FlightplanID=flight.FlightplanID, BriefingID=briefing_id, Route_Buffer=buffer_nm,
+                                            Depart_Notam_IDs=id_text(depart_notams), Dest_Notam_IDs=id_text(dest_notams),
+                                            Route_Notam_IDs=id_text(route_notams)))
+        flight_count += 1
+
+    # Only the latest briefing's lists are used
+    sqa_sess.query(FlightBriefingNotams).filter(FlightBriefingNotams.BriefingID != briefing_id).delete(synchronize_session=False)
+    sqa_sess.commit()
+
+    current_app.logger.info(f'Precomputed briefing {briefing_id} for {flight_count} flights')
+
+    return flight_count
+
+
+def start_flight_briefing_precompute(briefing_id):
+    """ Starts precompute_flight_briefings in a background thread, so the NOTAM import returns without waiting for it.
+    The thread is not a daemon - a command-line import waits for it to finish before exiting
+
+    Parameters
+    ----------
+    briefing_id : int
+        The Briefing just imported
+
+    Returns
+    -------
+    threading.Thread
+    """
+
+    app = current_app._get_current_object()
+
+    def run_precompute():
+        with app.app_context():
+            try:
+                precompute_flight_briefings(briefing_id)
+            except Exception as e:
+                app.logger.error(f'Error precomputing flight briefings for briefing {briefing_id}: {e}')
+            finally:
+                # The scoped session belongs to this thread - release it
+                sqa_session.remove()
+
+    thread = threading.Thread(target=run_precompute, name=f'precompute-briefing-{briefing_id}')
+    thread.start()
+
+    return thread
+
+
+def _classify_weather(flight, flight_date, buffer_nm, weather):
+    """ Places the weather in a WeatherSnapshot into the briefing sections for a flight - returns a FlightWeatherClassification """
+
+    # Filter the snapshot's records, rather than reading the weather pages again
+    metars = weather.metar_records
+    tafs = weather.taf_records
+
+    sigairmet_list = flightplans.filter_route_sigairmets_ZA(flight.FlightplanID, buffer_nm, flight_date=flight_date, sigairmet_list=weather.sigairmet_records)
+    metar_list, taf_list = flightplans.filter_route_metar_taf_ZA(flight.FlightplanID, buffer_nm, metar_list=metars, taf_list=tafs)
+
+    # Get METAR and TAF for departure and destination aerodromes
+    depart = flight.FlightPlanPoints[0]
+    dest = flight.FlightPlanPoints[-1]
+    depart_metar, depart_taf = flightplans.filter_point_metar_taf_ZA(depart.Longitude, depart.Latitude, 5, metar_list=metars, taf_list=tafs)
+    if depart.Latitude == dest.Latitude and depart.Longitude == dest.Longitude:
+        dest_metar = []
+        dest_taf = []
+    # Otherwise get for destination
+    else:
+        dest_metar, dest_taf = flightplans.filter_point_metar_taf_ZA(dest.Longitude, dest.Latitude, 5, metar_list=metars, taf_list=tafs)
+
+    # Now remove depart and dest metars from the list of metars, and depart metars from the dest list
+    # Weather records are keyed by station and time, so this is done with sets
+    depart_set = set(depart_metar)
+    dest_metar = [met for met in dest_metar if met not in depart_set]
+    dest_set = set(dest_metar)
+    metar_list = [met for met in metar_list if met not in depart_set and met not in dest_set]
+
+    # Stations with no data are not shown for the departure and destination
+    depart_metar = [met for met in depart_metar if not met.has_no_data]
+    dest_metar = [met for met in dest_metar if not met.has_no_data]
+
+    # Now remove depart and dest tafs from the list of tafs, and depart tafs from the dest list
+    depart_set = set(depart_taf)
+    dest_taf = [taf for taf in dest_taf if taf not in depart_set]
+    dest_set = set(dest_taf)
+    taf_list = [taf for taf in taf_list if taf not in depart_set and taf not in dest_set]
+
+    return FlightWeatherClassification(sigairmet_list, {DEPART: depart_metar, DEST: dest_metar, ENROUTE: metar_list},
+                                       {DEPART: depart_taf, DEST: dest_taf, ENROUTE: taf_list})
+
+
+def get_flight_weather(flight, flight_date, buffer_nm):
+    """ Function to return the weather for a flight's briefing, placed in the briefing sections.
+    Cached by (FlightplanID, flight date, route buffer, weather snapshot version) - and filtered from that snapshot
+
+    Parameters
+    ----------
+    flight : FlightPlan
+        The flight
+    flight_date : date or None
+        SIGMETs/AIRMETs not valid on this date are excluded
+    buffer_nm : int
+        Width of the buffer along the route in nautical miles
+
+    Returns
+    -------
+    FlightWeatherClassification
+    """
+
+    # The classification is worked out from the same snapshot as the version in its key
+    snapshot = get_weather_snapshot()
+    key = (flight.FlightplanID, flight_date, int(buffer_nm), snapshot.version)
+
+    weather = _weather_classifications.get(key)
+    if weather is None:
+        weather = _classify_weather(flight, flight_date, buffer_nm, snapshot)
+        _cache_put(_weather_classifications, key, weather)
+
+    return weather
+
+
+def get_flight_weather_layers(flight, flight_date, buffer_nm):
+    """ Function to return the weather along a flight's route as serialized map layers.
+    Cached by (FlightplanID, flight date, route buffer, weather snapshot version) - and filtered from that snapshot
+
+    Parameters
+    ----------
+    flight : FlightPlan
+        The flight
+    flight_date : date or None
+        SIGMETs/AIRMETs not valid on this date are excluded
+    buffer_nm : int
+        Width of the buffer along the route in nautical miles
+
+    Returns
+    -------
+    FlightWeatherLayers
+    """
+
+    snapshot = get_weather_snapshot()
+    key = (flight.FlightplanID, flight_date, int(buffer_nm), snapshot.version)
+
+    layers = _weather_layers.get(key)
+    if layers is None:
+        # The map shows all the weather along the route - it is not placed in the briefing sections
+        sigairmet_list = flightplans.filter_route_sigairmets_ZA(flight.FlightplanID, buffer_nm, flight_date=flight_date, sigairmet_list=snapshot.sigairmet_records)
+        metar_list, taf_list = flightplans.filter_route_metar_taf_ZA(flight.FlightplanID, buffer_nm, metar_list=snapshot.metar_records, taf_list=snapshot.taf_records)
+
+        layers = FlightWeatherLayers([met.to_dict() for met in sigairmet_list], [met.to_dict() for met in metar_list], [taf.to_dict() for taf in taf_list])
+        _cache_put(_weather_layers, key, layers)
+
+    return layers
+
+
+@click.command('precompute-flight-briefings')
+@with_appcontext
+def precompute_flight_briefings_command():
+    """Command Line to precompute the latest briefing's NOTAMs for every flight - normally done after each import
+    usage: flask precompute-flight-briefings
+    """
+    briefing_id = get_current_briefing().BriefingID
+
+    flight_count = precompute_flight_briefings(briefing_id)
+    click.echo(f'Precomputed briefing {briefing_id} for {flight_count} flights')
+
+
+def init_app(app):
+    """
+    Register the Command-Line commands with the flightbriefing app
+    """
+    app.cli.add_command(precompute_flight_briefings_command)
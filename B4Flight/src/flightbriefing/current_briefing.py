@@ -0,0 +1,136 @@
+"""Holds the Current NOTAM Briefing
+
+Almost every page needs the latest briefing - this module keeps its ID and details in the process, per country,
+rather than each view finding MAX(BriefingID) and then loading the briefing:
+- get_current_briefing() returns a CurrentBriefing, which views and templates use like a Briefing
+- The import refreshes it as soon as a briefing is committed (refresh_current_briefing)
+- Briefings are imported from the command line (another process), so every BRIEFING_CHECK_INTERVAL seconds
+  the latest BriefingID is checked, and the briefing reloaded if it has changed
+
+"""
+
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func
+
+from .db import Briefing, Notam
+from .data_handling import sqa_session    #sqa_session is the Session object for the site
+
+
+class CurrentBriefing():
+    """
+    A Class to represent the details of the current briefing - held between requests, so detached from any session.
+    Has the same attributes as a Briefing (other than the Notams relationship), so can be passed to templates in its place
+
+    Attributes
+    ----------
+    BriefingID : int
+    Briefing_Country : str
+        ICAO Country Code
+    Briefing_Ref : str
+        CAA-assigned Briefing Reference
+    Briefing_Date : date
+    Briefing_Time : time
+    Import_DateTime : datetime
+    Notam_Count : int
+        Number of Notams in the briefing
+    checked : float
+        When the briefing was last checked to be the latest (time.monotonic)
+    """
+
+    __slots__ = ('BriefingID', 'Briefing_Country', 'Briefing_Ref', 'Briefing_Date', 'Briefing_Time', 'Import_DateTime',
+                 'Notam_Count', 'checked')
+
+    def __init__(self, brf, notam_count):
+        """
+        Parameters
+        ----------
+        brf : Briefing
+            The briefing
+        notam_count : int
+            Number of Notams in the briefing
+        """
+        self.BriefingID = brf.BriefingID
+        self.Briefing_Country = brf.Briefing_Country
+        self.Briefing_Ref = brf.Briefing_Ref
+        self.Briefing_Date = brf.Briefing_Date
+        self.Briefing_Time = brf.Briefing_Time
+        self.Import_DateTime = brf.Import_DateTime
+        self.Notam_Count = notam_count
+        self.checked = time.monotonic()
+
+    def __repr__(self):
+        return f'<CurrentBriefing {self.BriefingID} {self.Briefing_Country} {self.Briefing_Ref} {self.Briefing_Date}>'
+
+
+_current_briefings = {}
+_current_briefings_lock = threading.Lock()
+
+
+def _latest_briefing_id(country):
+    """ Returns the latest BriefingID for a country from the database - None if there are no briefings """
+
+    sqa_sess = sqa_session()
+    return sqa_sess.query(func.max(Briefing.BriefingID)).filter(Briefing.Briefing_Country == country).first()[0]
+
+
+def refresh_current_briefing(country='ZA'):
+    """ Function to reload the current briefing for a country from the database - called once a briefing is imported
+
+    Parameters
+    ----------
+    country : str, default='ZA'
+        ICAO Country Code
+
+    Returns
+    -------
+    CurrentBriefing or None
+        None if there are no briefings for the country
+    """
+
+    sqa_sess = sqa_session()
+
+    briefing_id = _latest_briefing_id(country)
+    if briefing_id is None:
+        current_app.logger.error(f'No NOTAM briefings found for {country}')
+        return None
+
+    brf = sqa_sess.query(Briefing).get(briefing_id)
+    notam_count = sqa_sess.query(func.count(Notam.NotamID)).filter(Notam.BriefingID == briefing_id).scalar()
+    current = CurrentBriefing(brf, notam_count)
+
+    with _current_briefings_lock:
+        _current_briefings[country] = current
+
+    return current
+
+
+def get_current_briefing(country='ZA'):
+    """ Function to return the current (latest) briefing for a country - reloading it if another process
+    may have imported a newer one since it was last checked
+
+    Parameters
+    ----------
+    country : str, default='ZA'
+        ICAO Country Code
+
+    Returns
+    -------
+    CurrentBriefing or None
+        None if there are no briefings for the country
+    """
+
+    current = _current_briefings.get(country)
+
+    if current is None:
+        return refresh_current_briefing(country)
+
+    # Check for a newer briefing - only the ID is read unless it has changed
+    if time.monotonic() - current.checked > current_app.config['BRIEFING_CHECK_INTERVAL']:
+        if _latest_briefing_id(country) != current.BriefingID:
+            return refresh_current_briefing(country)
+        current.checked = time.monotonic()
+
+    return current
@@ -3,25 +3,31 @@
 Implements classes for:
     - User and UserSetting
     - NavPoint and NavPointCategory
-    - FlightPlan and FlightPlanPoint
-    - Briefing, Notam and QCode lookups
+    - FlightPlan and FlightPlanPoint, and the NOTAMs precomputed for each FlightPlan (FlightBriefingNotams)
+    - Briefing, Notam and QCode lookups, and the Notams added/removed between Briefings (BriefingDiff)
+
+Defines the loader strategies for the relationships read on the hot queries:  NOTAM_LOAD_OPTIONS and FLIGHTPLAN_LOAD_OPTIONS
     
 Provides command-line functions to:
     - Create the database models:  create-db
+    - Add indexes missing from an existing database:  create-db-indexes
+    - Check the hot queries use indexes, rather than scanning whole tables:  check-query-plans
     - Import the CSV files containing QCode Lookups:  import-qcode-lookups
     - Import the CSV files contianing NavPoint Lookups:  import-navpoint-lookups 
 
 """
 
 import os
+import re
+import sys
 
 from datetime import datetime, timedelta
 
 from email.headerregistry import Address
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Date, Time, DateTime, Float, Text, ForeignKey, UniqueConstraint, and_
-from sqlalchemy.orm import relationship
+from sqlalchemy import create_engine, inspect, func, Column, Integer, String, Boolean, Date, Time, DateTime, Float, Text, ForeignKey, UniqueConstraint, Index, and_
+from sqlalchemy.orm import relationship, joinedload, selectinload, Session
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from polycircles import polycircles
@@ -33,7 +39,7 @@ import csv
 from werkzeug.security import generate_password_hash
 
 import click
-from flask import current_app, render_template
+from flask import current_app, render_template, g, has_app_context
 from flask.cli import with_appcontext
 
 from .data_handling import sqa_session
@@ -245,8 +251,14 @@ class UserSetting(Base):
     
     Methods
     -------
-    get_setting(user_id, setting_name, create_if_missing=True)
+    get_settings(user_id)
+        Returns all of a user's settings, read in one query per request
+    get_setting(user_id, setting_name, create_if_missing=False)
         Returns a UserSetting object for a specific user
+    get_setting_values(user_id, setting_names)
+        Returns the values of several settings for a user
+    set_settings(user_id, values, commit=True)
+        Saves several settings for a user
 
     """ 
     __tablename__ = 'UserSettings'
@@ -260,14 +272,49 @@ class UserSetting(Base):
     User = relationship("User")
 
     @staticmethod
-    def get_setting(user_id, setting_name, create_if_missing=True):
+    def get_settings(user_id):
+        """
+        Retrieves all of a user's settings in one query.  Within a request (or app context) the settings are 
+        held in flask.g, so each user's settings are only read once per request - set_settings updates them there too.
+        Settings the user doesn't have are added with their default values as they are asked for (refer get_setting)
+        
+        Parameters
+        ----------
+        user_id : int
+            The ID of the user to retrieve the settings for
+            
+        Returns
+        -------
+        dict
+            Setting Name: UserSetting
         """
-        Retrieves a UserSetting object for a specific setting for a specific user,
-        and allows for the setting to be created if it doesn't yet exist.
-        If the setting doesn't exist:
-        - If create_if_missing ==  False, the application's DEFAULT_<<setting_name>> is returned
-        - If create_if_missing ==  True, the application's DEFAULT_<<setting_name>> is returned and the setting is created
         
+        user_id = int(user_id)
+        
+        # Settings already read in this request
+        if has_app_context():
+            if 'user_settings' not in g:
+                g.user_settings = {}
+            settings = g.user_settings.get(user_id)
+            if settings is not None:
+                return settings
+        
+        sqa_sess = sqa_session()
+        settings = {setg.SettingName: setg for setg in sqa_sess.query(UserSetting).filter(UserSetting.UserID == user_id).all()}
+        
+        if has_app_context():
+            g.user_settings[user_id] = settings
+        
+        return settings
+    
+    @staticmethod
+    def get_setting(user_id, setting_name, create_if_missing=False):
+        """
+        Retrieves a UserSetting object for a specific setting for a specific user (refer get_settings).
+        If the setting doesn't exist, a UserSetting with the application's DEFAULT_<<setting_name>> is returned,
+        without writing to the database:
+        - If create_if_missing ==  False, the setting is only saved if it is changed with set_settings
+        - If create_if_missing ==  True, the setting is added to the session, and saved with the session's next commit
         
         Parameters
         ----------
@@ -275,7 +322,7 @@ class UserSetting(Base):
             The ID of the user to retrive the setting for
         setting_name : str
             The name of the setting to be retrieved.  If the setting doesn't exist, the DEFAULT value will be returned 
-        create_if_missing : bool, default=True
+        create_if_missing : bool, default=False
             Specifies if the setting should be created for the user if it doesn't exist.
             Setting will be created from the app config variable DEFAULT_<<setting_name>>
             This allows new settings to be created in the app, without needing to update all users in the DB
@@ -287,22 +334,70 @@ class UserSetting(Base):
             allows for the settings to be updated using this method
         """
         
-        # Retrieve the setting
-        sqa_sess = sqa_session()
-        setg = sqa_sess.query(UserSetting).filter(and_(UserSetting.UserID ==  user_id, UserSetting.SettingName == setting_name)).first()
+        settings = UserSetting.get_settings(user_id)
+        setg = settings.get(setting_name)
         
         # If this setting doesn't exist
         if setg is None:
-            # Create a UserSetting object with the default value
+            # Create a UserSetting object with the default value - held with the user's settings, so it is only created once
             default_set = current_app.config['DEFAULT_'+setting_name.upper()]
-            setg = UserSetting(UserID = user_id, SettingName = setting_name, SettingValue = default_set)
+            setg = UserSetting(UserID = int(user_id), SettingName = setting_name, SettingValue = default_set)
+            settings[setting_name] = setg
+        
+        # If method is asked to create the setting, save it with the next commit
+        if create_if_missing == True and setg.ID is None:
+            sqa_session().add(setg)
+        
+        return setg
+    
+    @staticmethod
+    def get_setting_values(user_id, setting_names):
+        """
+        Retrieves the values of several settings for a user - defaults are used for settings the user doesn't have
+        
+        Parameters
+        ----------
+        user_id : int
+            The ID of the user to retrieve the settings for
+        setting_names : list
+            Names of the settings
+            
+        Returns
+        -------
+        dict
+            Setting Name: Setting Value
+        """
+        
+        return {setting_name: UserSetting.get_setting(user_id, setting_name).SettingValue for setting_name in setting_names}
+    
+    @staticmethod
+    def set_settings(user_id, values, commit=True):
+        """
+        Saves several settings for a user - updating the settings the user has, and creating the rest.
+        The settings held for this request (refer get_settings) are updated as well
+        
+        Parameters
+        ----------
+        user_id : int
+            The ID of the user to save the settings for
+        values : dict
+            Setting Name: Setting Value
+        commit : bool, default=True
+            Commit the session once the settings are saved.  Set to False to commit them with other changes
+        """
+        
+        sqa_sess = sqa_session()
+        
+        for setting_name, setting_value in values.items():
+            setg = UserSetting.get_setting(user_id, setting_name)
+            setg.SettingValue = setting_value
             
-            # If method is asked to create the setting, then save to the DB
-            if create_if_missing == True:
+            # Defaults not yet in the database are added
+            if setg.ID is None:
                 sqa_sess.add(setg)
-                sqa_sess.commit()
         
-        return setg
+        if commit == True:
+            sqa_sess.commit()
 
 
 class UserHiddenNotam(Base):
@@ -318,6 +413,9 @@ class UserHiddenNotam(Base):
     Notam_Number = Column(String(20), primary_key= True) #CAA-assigned Notam number - e.g. A1543/20
     Date_Hidden = Column(DateTime(), default=datetime.utcnow)
     
+    # The primary key only finds a user's Notams - joins to Notams look up by Notam Number
+    __table_args__ = (Index('IX_UserHiddenNotams_Notam_Number', 'Notam_Number'),)
+    
     User = relationship("User")
 
 
@@ -354,6 +452,9 @@ class NavPoint(Base):
     Longitude = Column(Float())
     Active = Column(Boolean(), default=True)
 
+    # NavPoints are looked up by ICAO Code (home aerodromes, route points, weather stations)
+    __table_args__ = (Index('IX_NavPoints_ICAO_Code', 'ICAO_Code'),)
+
     Category = relationship("NavPointCategory")
 
 
@@ -375,6 +476,9 @@ class FlightPlan(Base):
     Flight_Desc = Column(String(255))
     Is_Deleted = Column(Boolean, default=False)
     
+    # A user's flights are listed without the deleted ones
+    __table_args__ = (Index('IX_FlightPlans_UserID_Is_Deleted', 'UserID', 'Is_Deleted'),)
+    
     # Link with the User (parent) and FlightPlanPoints (children)
     User = relationship("User")
     FlightPlanPoints = relationship("FlightPlanPoint", back_populates="FlightPlan")
@@ -399,10 +503,44 @@ class FlightPlanPoint(Base):
     Elevation = Column(Integer())
     Name = Column(String(255))
     
+    # The points are loaded for their FlightPlan
+    __table_args__ = (Index('IX_FlightPlanPoints_FlightplanID', 'FlightplanID'),)
+    
     # Relationship with the parent FlightPlan
     FlightPlan = relationship("FlightPlan", back_populates="FlightPlanPoints")
 
 
+class FlightBriefingNotams(Base):
+    """
+    A Class to represent the NOTAMs of a Briefing that apply to a FlightPlan, precomputed after the briefing is imported
+    (refer briefing_cache.precompute_flight_briefings) - for the flight's owner's route buffer, without a flight date.
+    The Notams are held as compact lists of NotamIDs, separated by spaces
+    
+    Uses the SQLAlchemy ORM to interact with database
+    
+    Methods
+    -------
+    notam_ids(id_text)
+        Returns a list of NotamIDs from one of the ID lists
+    """
+    __tablename__ = 'FlightBriefingNotams'
+    
+    FlightplanID = Column(Integer(), ForeignKey("FlightPlans.FlightplanID"), primary_key=True)
+    BriefingID = Column(Integer(), ForeignKey("Briefings.BriefingID"), primary_key=True)
+    Route_Buffer = Column(Integer()) # Buffer along route the Notams were found with, in nm
+    Depart_Notam_IDs = Column(Text()) # Notams within 5nm of the departure point
+    Dest_Notam_IDs = Column(Text()) # Notams within 5nm of the destination
+    Route_Notam_IDs = Column(Text()) # All Notams along the route - the en-route Notams are those not in the departure or destination lists
+    Create_Date = Column(DateTime(), default=datetime.utcnow)
+    
+    @staticmethod
+    def notam_ids(id_text):
+        """ Returns a list of NotamIDs from one of the space-separated ID lists """
+        return [int(notam_id) for notam_id in id_text.split()] if id_text else []
+    
+    @property
+    def Notam_Count(self):
+        return len(set(self.notam_ids(self.Depart_Notam_IDs) + self.notam_ids(self.Dest_Notam_IDs) + self.notam_ids(self.Route_Notam_IDs)))
 
 
 class QCode_2_3_Lookup(Base):
@@ -461,9 +599,41 @@ class Briefing(Base):
     Briefing_Time = Column(Time) #Time CAA releases the briefing
     Import_DateTime = Column(DateTime) #Date & Time the briefing was imported
     
+    # The current briefing is the latest for its country (refer current_briefing)
+    __table_args__ = (Index('IX_Briefings_Briefing_Country_BriefingID', 'Briefing_Country', 'BriefingID'),)
+    
     Notams = relationship("Notam", back_populates='Briefing')
 
 
+class BriefingDiff(Base):
+    """
+    A Class to represent the Notams added and removed between a Briefing and an earlier Briefing, 
+    computed when the Briefing is imported (refer notams.compute_briefing_diffs).
+    The Notam Numbers are held as lists separated by spaces
+    
+    Uses the SQLAlchemy ORM to interact with database
+    
+    Methods
+    -------
+    notam_numbers(number_text)
+        Returns a list of Notam Numbers from one of the lists
+    """
+    __tablename__ = "BriefingDiffs"
+    
+    BriefingID = Column(Integer(), ForeignKey("Briefings.BriefingID"), primary_key=True)
+    Prev_BriefingID = Column(Integer(), ForeignKey("Briefings.BriefingID"), primary_key=True) # The earlier briefing compared to
+    New_Count = Column(Integer()) # Notams in the briefing, not in the earlier briefing
+    Deleted_Count = Column(Integer()) # Notams in the earlier briefing, no longer in the briefing
+    New_Notam_Numbers = Column(Text())
+    Deleted_Notam_Numbers = Column(Text())
+    Create_Date = Column(DateTime(), default=datetime.utcnow)
+    
+    @staticmethod
+    def notam_numbers(number_text):
+        """ Returns a list of Notam Numbers from one of the space-separated lists """
+        return number_text.split() if number_text else []
+
+
 class Notam(Base):
     """
     A Class to respresent a single NOTAM, and is a child of 
@@ -518,6 +688,10 @@ class Notam(Base):
     Coord_Lon = Column(String(8)) #Final co-ordinates to use for the Notam Mapping
     Bounded_Area = Column(String(4096)) # Co-ordinates of a bounded area defined in the Notam
     Unique_Geo_ID = Column(String(25)) #Combination of Lat + Lon + Radius to allow grouping of 
+    
+    # Notams are read per briefing, and compared across briefings (and with hidden Notams) by Notam Number
+    __table_args__ = (Index('IX_Notams_BriefingID_Notam_Number', 'BriefingID', 'Notam_Number'),
+                      Index('IX_Notams_Notam_Number', 'Notam_Number'),)
         
     Briefing = relationship("Briefing", back_populates='Notams')
     QCode_2_3_Lookup = relationship("QCode_2_3_Lookup")
@@ -628,7 +802,18 @@ class ContactMessage(Base):
         was_mail_sent = helpers.send_mail(mail_from, mail_to,'Thank you for contacting us.', msg_txt, msg_html, recipients_bcc=mail_bcc)
         
         return was_mail_sent, msg
-        
+
+
+# Loader strategies for the hot queries - relationships are lazy-loaded by default, which issues a SELECT per row
+# the first time a relationship is read in a loop.  Pass these to query.options() wherever a list is read in a loop:
+# - NOTAM_LOAD_OPTIONS: the QCode lookups are joined (many-to-one, a handful of rows shared by all Notams) - 
+#   the map groups and colours come from QCode_2_3_Lookup.  Notam.Briefing is left lazy - every Notam in a list
+#   is from the same briefing, which the session loads once
+# - FLIGHTPLAN_LOAD_OPTIONS: the FlightPlanPoints are loaded with a single SELECT ... IN for all the FlightPlans in the 
+#   query (one-to-many, so a join would repeat the FlightPlan columns on every point)
+NOTAM_LOAD_OPTIONS = (joinedload(Notam.QCode_2_3_Lookup), joinedload(Notam.QCode_4_5_Lookup))
+FLIGHTPLAN_LOAD_OPTIONS = (selectinload(FlightPlan.FlightPlanPoints),)
+
     
 def init_db(sqa_engine):
     """Initialise the SQLAlchemy database - for use when DB module is used
@@ -657,6 +842,156 @@ def create_new_db():
     Base.metadata.create_all()
 
 
+def _app_engine():
+    """Returns a SQLAlchemy engine for the application's database (DATABASE_CONNECT_STRING)"""
+    
+    return create_engine(current_app.config['DATABASE_CONNECT_STRING'], pool_recycle = current_app.config['DATABASE_POOL_RECYCLE'])
+
+
+def find_missing_indexes(sqa_engine=None):
+    """Finds the indexes declared on the ORM models that are missing from an existing database.
+    Tables not yet in the database are skipped - create-db creates them with their indexes
+    
+    Parameters
+    ----------
+    sqa_engine : sqlalchemy.engine, optional
+        The database to check - defaults to the application's database
+    
+    Returns
+    -------
+    list
+        The missing sqlalchemy Index objects
+    """ 
+
+    if sqa_engine is None:
+        sqa_engine = _app_engine()
+    
+    inspector = inspect(sqa_engine)
+    existing_tables = inspector.get_table_names()
+    
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        
+        existing_indexes = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing_indexes)
+    
+    return missing
+
+
+def create_missing_indexes(sqa_engine=None):
+    """Adds the indexes declared on the ORM models that are missing from an existing database - 
+    create_new_db only creates indexes along with new tables
+    
+    Parameters
+    ----------
+    sqa_engine : sqlalchemy.engine, optional
+        The database to add the indexes to - defaults to the application's database
+    
+    Returns
+    -------
+    list
+        Names of the indexes created
+    """ 
+
+    if sqa_engine is None:
+        sqa_engine = _app_engine()
+    
+    created = []
+    for index in find_missing_indexes(sqa_engine):
+        index.create(bind=sqa_engine)
+        created.append(index.name)
+    
+    return created
+
+
+def hot_queries(sess):
+    """Returns the queries run on most page views, for checking their query plans (refer check_query_plans).
+    Add to this list when adding a query that runs per request
+    
+    Parameters
+    ----------
+    sess : Session
+        The session to build the queries with
+        
+    Returns
+    -------
+    list
+        (description, Query) tuples
+    """
+    
+    flight_date = datetime(2021, 1, 1)
+    
+    return [
+        ('Current briefing', sess.query(func.max(Briefing.BriefingID)).filter(Briefing.Briefing_Country == 'ZA')),
+        ('Briefing Notams', sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.BriefingID == 1).order_by(Notam.A_Location)),
+        ('Briefing Notams on a flight date', sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == 1, Notam.From_Date <= flight_date, Notam.To_Date >= flight_date))),
+        ('Briefing Notam Numbers', sess.query(Notam.Notam_Number).filter(Notam.BriefingID == 1)),
+        ('Notams by Number', sess.query(Notam).filter(and_(Notam.BriefingID == 1, Notam.Notam_Number.in_(['A1000/21', 'A1001/21'])))),
+        ('Notams by ID', sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.NotamID.in_([1, 2, 3]))),
+        ('User hidden Notams in a briefing', sess.query(Notam).join(UserHiddenNotam, Notam.Notam_Number == UserHiddenNotam.Notam_Number).filter(
+            and_(Notam.BriefingID == 1, UserHiddenNotam.UserID == 1))),
+        ('Users hiding a Notam', sess.query(UserHiddenNotam).filter(UserHiddenNotam.Notam_Number == 'A1000/21')),
+        ('NavPoint by ICAO Code', sess.query(NavPoint).filter(NavPoint.ICAO_Code == 'FAJS')),
+        ('User flights', sess.query(FlightPlan).filter(and_(FlightPlan.UserID == 1, FlightPlan.Is_Deleted == False)).order_by(FlightPlan.FlightplanID.desc())),
+        ('FlightPlan points', sess.query(FlightPlanPoint).filter(FlightPlanPoint.FlightplanID.in_([1, 2, 3]))),
+        ('Precomputed flight Notams', sess.query(FlightBriefingNotams).filter(and_(FlightBriefingNotams.FlightplanID == 1, FlightBriefingNotams.BriefingID == 1))),
+        ('Briefing diff', sess.query(BriefingDiff).filter(and_(BriefingDiff.BriefingID == 2, BriefingDiff.Prev_BriefingID == 1))),
+        ('User by Username', sess.query(User).filter(User.Username == 'pilot')),
+        ('User by Email', sess.query(User).filter(User.Email == 'pilot@example.com')),
+        ('User settings', sess.query(UserSetting).filter(UserSetting.UserID == 1)),
+    ]
+
+
+def check_query_plans(sqa_engine=None):
+    """Captures the SQLite query plan (EXPLAIN QUERY PLAN) for each of the hot_queries, and finds those that scan 
+    a whole table rather than searching an index.  
+    By default the plans are for an empty in-memory database created from the ORM models - which checks the models declare 
+    the indexes the queries need.  Pass a SQLite database's engine to check that database's actual indexes
+    
+    Parameters
+    ----------
+    sqa_engine : sqlalchemy.engine, optional
+        An existing SQLite database to check
+    
+    Returns
+    -------
+    list
+        (description, list of query plan lines, list of tables scanned) tuples
+    """
+    
+    if sqa_engine is None:
+        sqa_engine = create_engine('sqlite://')
+        Base.metadata.create_all(bind=sqa_engine)
+    table_names = set(Base.metadata.tables)
+    
+    # SQLite describes a full table scan as "SCAN <table>" (or "SCAN TABLE <table>" in older versions), 
+    # without "USING ... INDEX" - scans of subqueries or temporary results are not tables
+    scan_pattern = re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.*USING)')
+    
+    sess = Session(bind=sqa_engine)
+    raw_conn = sqa_engine.raw_connection()
+    results = []
+    try:
+        cursor = raw_conn.cursor()
+        for description, query in hot_queries(sess):
+            # Compile to SQLite's SQL with positional parameters, expanding any IN lists
+            compiled = query.statement.compile(dialect=sqa_engine.dialect, compile_kwargs={'render_postcompile': True})
+            params = [compiled.params[name] for name in compiled.positiontup]
+            
+            cursor.execute(f'EXPLAIN QUERY PLAN {compiled}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+            
+            scanned = [match.group(1) for match in map(scan_pattern.match, plan) if match and match.group(1) in table_names]
+            results.append((description, plan, scanned))
+    finally:
+        raw_conn.close()
+        sess.close()
+    
+    return results
+
+
 def import_qcode_ref_tables(csv_script_folder):
     """Imports CSV files containing the Q_Code lookup data, 
     into the underlying tables for Q_Code_2_3_Lookup and Q_Code_4_5_Lookup objects
@@ -846,6 +1181,65 @@ def create_db_command():
     click.echo("--- Command-Line Completed ---")
 
     
+@click.command('create-db-indexes')
+@with_appcontext
+def create_db_indexes_command():
+    """Command-line to add missing indexes to an existing B4Flight database
+    usage: flask create-db-indexes
+    
+    """
+    click.echo("--- Command-Line ready to add missing indexes ---")
+    created = create_missing_indexes()
+    for index_name in created:
+        click.echo(f"Created index {index_name}")
+    click.echo(f"--- Command-Line Completed - {len(created)} indexes created ---")
+
+
+@click.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Show the query plan of every query')
+@with_appcontext
+def check_query_plans_command(verbose):
+    """Command-line to check the hot queries use indexes - exits with status 1 if any problems are found:
+    - The query plans on the ORM models (an in-memory SQLite database) must not scan whole tables
+    - The application's database must have all the indexes declared on the models (refer create-db-indexes)
+    - If the application's database is SQLite, its own query plans must not scan whole tables either
+    usage: flask check-query-plans [--verbose]
+    
+    """
+    
+    def check_plans(plans, source):
+        failed = 0
+        for description, plan, scanned in plans:
+            if scanned:
+                failed += 1
+                click.echo(f"FAIL {description} ({source}) - scans {', '.join(scanned)}")
+            elif verbose:
+                click.echo(f"ok   {description} ({source})")
+            
+            if scanned or verbose:
+                for line in plan:
+                    click.echo(f"       {line}")
+        return failed
+    
+    failed = check_plans(check_query_plans(), 'models')
+    
+    # The models only show what a new database would have - check the indexes were added to the actual database
+    sqa_engine = _app_engine()
+    missing = find_missing_indexes(sqa_engine)
+    for index in missing:
+        click.echo(f"FAIL index {index.name} on {index.table.name} is missing from the database - run flask create-db-indexes")
+    failed += len(missing)
+    
+    if sqa_engine.dialect.name == 'sqlite':
+        failed += check_plans(check_query_plans(sqa_engine), 'database')
+    
+    if failed:
+        click.echo(f"--- {failed} problems found ---")
+        sys.exit(1)
+    
+    click.echo("--- All queries use indexes ---")
+
+
 @click.command('import-qcode-lookups')
 @click.argument('csv_folder')
 @with_appcontext
@@ -894,6 +1288,8 @@ def init_app(app):
     """
     
     app.cli.add_command(create_db_command)
+    app.cli.add_command(create_db_indexes_command)
+    app.cli.add_command(check_query_plans_command)
     app.cli.add_command(import_qcode_lookup_command)
     app.cli.add_command(import_navpoint_lookup_command)
     
@@ -26,6 +26,7 @@ from . import helpers, flightplans
 from .auth import requires_login
 from .db import FlightPlan, FlightPlanPoint, NavPoint
 from .data_handling import sqa_session    #sqa_session is the Session object for the site
+from .geojson_output import dumps_geojson
 
 bp = Blueprint('flightadmin', __name__)
 
@@ -286,7 +287,7 @@ def validateroute():
             fpl_geojson = flightplans.generate_flight_geojson(flightplan_object=fplan)
 
             # Then return a JSON string, showing the status and the GEOJSON object
-            fp_json = json.dumps({'is_route_valid' : route_valid, 'GEOJSON' : fpl_geojson})
+            fp_json = dumps_geojson({'is_route_valid' : route_valid, 'GEOJSON' : fpl_geojson})
                 
             return fp_json 
             
@@ -2,7 +2,8 @@
 
 This module contains functions to import flightplans, 
 generate GEOJSON representations of flightplans,
-and filter NOTAMS relevant to a specific flightplan
+and filter NOTAMS relevant to a specific flightplan,
+and look up the forecast weather at the expected time overhead
 
 """
 
@@ -10,7 +11,7 @@ from datetime import datetime
 import datetime as dt
 
 
-from sqlalchemy import func, and_
+from sqlalchemy import and_
 
 import xml.etree.ElementTree as ET
 from shapely import geometry 
@@ -20,9 +21,13 @@ import re
 from flask import session, current_app
 from geojson import LineString, Feature
 
-from .db import FlightPlan, FlightPlanPoint, Notam, Briefing, UserSetting
+from .db import FlightPlan, FlightPlanPoint, Notam, UserSetting, NOTAM_LOAD_OPTIONS
 from .data_handling import sqa_session    #sqa_session is the Session object for the site
 from .weather import read_metar_ZA, read_taf_ZA, read_sigmet_airmet_ZA
+from .weather_parsing import TafIndex
+from .geojson_output import map_output_geometry, FeatureList
+from .notams import notam_geometry_key
+from .current_briefing import get_current_briefing
 from . import helpers
 
 
@@ -265,14 +270,14 @@ def generate_flight_geojson(flightplan_id=None, flightplan_object=None):
     else:
         flightplan = flightplan_object
         
-    route_feature = []
+    route_feature = FeatureList()
     point_list = []
     # Loop through each route point, adding tuples of coordinates
     for rte_point in flightplan.FlightPlanPoints:
         point_list.append((rte_point.Longitude, rte_point.Latitude))
 
-    # Create a GEOJSON Linestring from the tuples
-    geojson_geom = LineString(point_list)
+    # Create a GEOJSON Linestring from the tuples - quantized to the map's co-ordinate precision
+    geojson_geom = map_output_geometry(LineString(point_list))
     
     #Set the line colour using the User's setting - if no setting, don't create one (use the app default)
     line_colour = UserSetting.get_setting(session['userid'], 'flight_route_colour', create_if_missing=False).SettingValue
@@ -405,14 +410,14 @@ def filter_relevant_notams(shapely_geom, buffer_width_nm, include_matches=True,
 
     sqa_sess = sqa_session()
     
-    # Retrieve the latest NOTAM Briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
+    # The current NOTAM Briefing - held in the process, rather than read on each call
+    latest_brief_id = get_current_briefing().BriefingID
     
     # Retrieve the notams for the latest Briefing, filtering by Date of Flight if necessary
     if date_of_flight is None:
-        notam_list = sqa_sess.query(Notam).filter(Notam.BriefingID == latest_brief_id).order_by(Notam.A_Location).all()
+        notam_list = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.BriefingID == latest_brief_id).order_by(Notam.A_Location).all()
     else:
-        notam_list = sqa_sess.query(Notam).filter(and_(Notam.BriefingID == latest_brief_id, Notam.From_Date <= date_of_flight, Notam.To_Date >= date_of_flight)).all()
+        notam_list = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == latest_brief_id, Notam.From_Date <= date_of_flight, Notam.To_Date >= date_of_flight)).all()
         
 
     # Calculate the buffer in degrees
@@ -443,26 +448,30 @@ def filter_relevant_notams(shapely_geom, buffer_width_nm, include_matches=True,
         fplShapelyBuffers = [shapely_geom.buffer(buffer_width_deg)]
 
     # Now process each NOTAM, and check if it intersects with the route buffer.
+    # Many Notams share a geometry (eg. the same centre and radius at an aerodrome) - each geometry is only tested once
+    geometry_intersects = {}
     filtered_notams = []
     for this_notam in notam_list:
-     
-        # If the NOTAM has a bounded area - i.e. it is a polygon, create a Shapely Polygon 
-        if this_notam.Bounded_Area:
-            coords = helpers.convert_bounded_dms_to_dd(this_notam.Bounded_Area, reverse_coords=True)
-            notam_shape = geometry.Polygon(coords)
-            
-        # Otherwise create either a "Shapely" point (radius is 1) or a "Shapely" circle (radius > 1) for this NOTAM 
-        elif this_notam.Radius == 1:
-            #long then lat
-            notam_shape = geometry.Point(helpers.convert_dms_to_dd(this_notam.Coord_Lon), helpers.convert_dms_to_dd(this_notam.Coord_Lat)) #Shapely Point
-        else:
-            notam_shape = helpers.generate_circle_shapely(this_notam.Coord_Lat, this_notam.Coord_Lon, this_notam.Radius)
         
-        doesIntersect = False # Assume this Notam does not intersect the Route Buffer
-
-        # Test whether each of the buffers intersect with this NOTAM's geometry
-        for routeBuf in fplShapelyBuffers:
-            if routeBuf.intersects(notam_shape): doesIntersect = True
+        geo_key = notam_geometry_key(this_notam)
+        doesIntersect = geometry_intersects.get(geo_key)
+        
+        if doesIntersect is None:
+            # If the NOTAM has a bounded area - i.e. it is a polygon, create a Shapely Polygon 
+            if this_notam.Bounded_Area:
+                coords = helpers.convert_bounded_dms_to_dd(this_notam.Bounded_Area, reverse_coords=True)
+                notam_shape = geometry.Polygon(coords)
+                
+            # Otherwise create either a "Shapely" point (radius is 1) or a "Shapely" circle (radius > 1) for this NOTAM 
+            elif this_notam.Radius == 1:
+                #long then lat
+                notam_shape = geometry.Point(helpers.convert_dms_to_dd(this_notam.Coord_Lon), helpers.convert_dms_to_dd(this_notam.Coord_Lat)) #Shapely Point
+            else:
+                notam_shape = helpers.generate_circle_shapely(this_notam.Coord_Lat, this_notam.Coord_Lon, this_notam.Radius)
+            
+            # Test whether any of the buffers intersect with this NOTAM's geometry
+            doesIntersect = any(routeBuf.intersects(notam_shape) for routeBuf in fplShapelyBuffers)
+            geometry_intersects[geo_key] = doesIntersect
         
         # Check if this is of interest:
         # If we want to show notams that intersect (include_matches == True), add this NOTAM if it intersects
@@ -476,7 +485,7 @@ def filter_relevant_notams(shapely_geom, buffer_width_nm, include_matches=True,
     return filtered_notams
 
 
-def filter_route_sigairmets_ZA(flightplan_id, buffer_width_nm, sigairmet_url=None, flight_date=None):
+def filter_route_sigairmets_ZA(flightplan_id, buffer_width_nm, sigairmet_url=None, flight_date=None, sigairmet_list=None):
     """Filters SIGMETS and AIRMETS that are relevant to a flight route ( linestring geometric feature).
     Relevent SIG/AIRMETS are those within a 'buffer_width_nm' nm around the feature.
     Buffer is approximate, using the principle of 1 minute of lat = 1 nm
@@ -495,10 +504,13 @@ def filter_route_sigairmets_ZA(flightplan_id, buffer_width_nm, sigairmet_url=Non
     flight_date: datetime OR None
         date the flight will operate - used to filter relevant SIGMET/AIRMET
 
+    sigairmet_list : list, optional
+        SigmetReport objects to filter (eg. from the weather snapshot) - if not given, the latest are read from sigairmet_url
+
     Returns
     -------
     list
-        List of SIGAIRMET object that meet criteria
+        List of SigmetReport objects that meet criteria
     """
     
     sqa_sess = sqa_session()
@@ -543,20 +555,23 @@ def filter_route_sigairmets_ZA(flightplan_id, buffer_width_nm, sigairmet_url=Non
         fplShapelyBuffers = [route_geom.buffer(buffer_width_deg)]
 
     
-    # Retrieve latest METARS
-    if sigairmet_url is None:
-        sigairmet_list = read_sigmet_airmet_ZA(current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA'])
-    else:
-        sigairmet_list = read_sigmet_airmet_ZA(sigairmet_url)
+    # Retrieve latest SIGMETS/AIRMETS - unless they were passed in
+    if sigairmet_list is None:
+        if sigairmet_url is None:
+            sigairmet_url = current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA']
+        sigairmet_list = read_sigmet_airmet_ZA(sigairmet_url, as_records=True)
     
-    # List of relevant sig/airmets
-    filtered_sigairmets = []
+    # If the weather could not be read, there is nothing to filter
+    if sigairmet_list is None: sigairmet_list = []
+
+    # Relevant sig/airmets - a dictionary keeps them in order, and ignores repeats of the same report
+    filtered_sigairmets = {}
 
     # Now process each SIGMET/AIRMET, and check if it intersects with the route buffer.
     for this_met in sigairmet_list:
         
         #If there is a date for this flight, and a validity for the SIGAIRMET (there should always be unless there was a parsing error)
-        if flight_date is not None and this_met['valid_from'] is not None and this_met['valid_to'] is not None:
+        if flight_date is not None and this_met.valid_from is not None and this_met.valid_to is not None:
             # If passed parameter is DATE (not DATETIME) convert it to DateTime - to allow comparison
             if isinstance(flight_date, dt.date): 
                 check_date = datetime(flight_date.year, flight_date.month, flight_date.day)
@@ -565,21 +580,19 @@ def filter_route_sigairmets_ZA(flightplan_id, buffer_width_nm, sigairmet_url=Non
                 check_date = flight_date
                 
             # Check if flight date is outside SIGAIRMET validity - if so ignore this one
-            if check_date < this_met['valid_from'] or check_date > this_met['valid_to']: continue
+            if check_date < this_met.valid_from or check_date > this_met.valid_to: continue
         
-        met_shape = geometry.Polygon(this_met['coords']) #Shapely polygon
+        met_shape = geometry.Polygon(this_met.coords) #Shapely polygon
         
-        # Test whether each of the buffers intersect with this SIG-AIRMET
-        for routeBuf in fplShapelyBuffers:
-            # If it does, add the metar to the list
-            if routeBuf.intersects(met_shape): 
-                if this_met not in filtered_sigairmets: filtered_sigairmets.append(this_met)
+        # Test whether any of the buffers intersect with this SIG-AIRMET - if so, add it to the list
+        if any(routeBuf.intersects(met_shape) for routeBuf in fplShapelyBuffers):
+            filtered_sigairmets[this_met] = None
 
     # Return the new Filtered list of sigmets/airmets 
-    return filtered_sigairmets
+    return list(filtered_sigairmets)
 
 
-def filter_route_metar_taf_ZA(flightplan_id, buffer_width_nm, metar_url=None, taf_url=None):
+def filter_route_metar_taf_ZA(flightplan_id, buffer_width_nm, metar_url=None, taf_url=None, metar_list=None, taf_list=None):
     """Filters METARS and TAFS that are relevant to a flight route ( linestring geometric feature).
     Creates a Shapely geometry for the flightplan then calls "filter_relevant_metar_taf" function
     
@@ -600,11 +613,14 @@ def filter_route_metar_taf_ZA(flightplan_id, buffer_width_nm, metar_url=None, ta
     taf_url: str
         url from which to retrieve the TAFs
 
+    metar_list, taf_list : list, optional
+        MetarObservation / TafForecast objects to filter (eg. from the weather snapshot) - if not given, the latest are read from the URLs
+
     Returns
     -------
     list
-        List of METAR objects that meet criteria
-        List of TAF objects that meet criteria
+        List of MetarObservation objects that meet criteria
+        List of TafForecast objects that meet criteria
     """
     
     sqa_sess = sqa_session()
@@ -621,10 +637,10 @@ def filter_route_metar_taf_ZA(flightplan_id, buffer_width_nm, metar_url=None, ta
     route_geom = geometry.LineString(lstring)
         
 
-    return filter_relevant_metar_taf_ZA(route_geom, buffer_width_nm, metar_url, taf_url)
+    return filter_relevant_metar_taf_ZA(route_geom, buffer_width_nm, metar_url, taf_url, metar_list, taf_list)
 
 
-def filter_point_metar_taf_ZA(longitude, latitude, buffer_width_nm, metar_url=None, taf_url=None):
+def filter_point_metar_taf_ZA(longitude, latitude, buffer_width_nm, metar_url=None, taf_url=None, metar_list=None, taf_list=None):
     """Filters METARS and TAFS that are relevant to a specific point - eg. an airfield.  
     Creates a Shapely geometry for the point then calls "filter_relevant_notams" function
     
@@ -648,20 +664,23 @@ def filter_point_metar_taf_ZA(longitude, latitude, buffer_width_nm, metar_url=No
     taf_url: str
         url from which to retrieve the TAFs
 
+    metar_list, taf_list : list, optional
+        MetarObservation / TafForecast objects to filter (eg. from the weather snapshot) - if not given, the latest are read from the URLs
+
     Returns
     -------
     list
-        List of METAR objects that meet criteria
-        List of TAF objects that meet criteria
+        List of MetarObservation objects that meet criteria
+        List of TafForecast objects that meet criteria
     """
     
     # Create the co-ordinates into a Shapely Point
     point = geometry.Point(longitude, latitude)
 
-    return filter_relevant_metar_taf_ZA(point, buffer_width_nm, metar_url, taf_url)
+    return filter_relevant_metar_taf_ZA(point, buffer_width_nm, metar_url, taf_url, metar_list, taf_list)
 
 
-def filter_relevant_metar_taf_ZA(shapely_geom, buffer_width_nm, metar_url=None, taf_url=None):
+def filter_relevant_metar_taf_ZA(shapely_geom, buffer_width_nm, metar_url=None, taf_url=None, metar_list=None, taf_list=None):
     """Filters METARS and TAFS that are relevant to a specific geographic geometric feature (point, linestring).
     Relevent METARS/TAFS are those within a 'buffer_width_nm' nm around the feature.
     Buffer is approximate, using the principle of 1 minute of lat = 1 nm
@@ -680,11 +699,14 @@ def filter_relevant_metar_taf_ZA(shapely_geom, buffer_width_nm, metar_url=None,
     taf_url: str
         url from which to retrieve the TAFs
 
+    metar_list, taf_list : list, optional
+        MetarObservation / TafForecast objects to filter (eg. from the weather snapshot) - if not given, the latest are read from the URLs
+
     Returns
     -------
     list
-        List of METAR objects that meet criteria
-        List of TAF objects that meet criteria
+        List of MetarObservation objects that meet criteria
+        List of TafForecast objects that meet criteria
     """
     
     sqa_sess = sqa_session()
@@ -718,44 +740,104 @@ def filter_relevant_metar_taf_ZA(shapely_geom, buffer_width_nm, metar_url=None,
         fplShapelyBuffers = [shapely_geom.buffer(buffer_width_deg)]
 
     
-    # Retrieve latest METARS
-    if metar_url is None:
-        metar_list = read_metar_ZA(current_app.config['WEATHER_METAR_URL_ZA'])
-    else:
-        metar_list = read_metar_ZA(metar_url)
+    # Retrieve latest METARS - unless they were passed in
+    if metar_list is None:
+        if metar_url is None:
+            metar_url = current_app.config['WEATHER_METAR_URL_ZA']
+        metar_list = read_metar_ZA(metar_url, as_records=True)
     
-    # Retrieve latest TAFS
-    if taf_url is None:
-        taf_list = read_taf_ZA(current_app.config['WEATHER_TAF_URL_ZA'])
-    else:
-        taf_list = read_taf_ZA(taf_url)
+    # Retrieve latest TAFS - unless they were passed in
+    if taf_list is None:
+        if taf_url is None:
+            taf_url = current_app.config['WEATHER_TAF_URL_ZA']
+        taf_list = read_taf_ZA(taf_url, as_records=True)
+
+    # If the weather could not be read, there is nothing to filter
+    if metar_list is None: metar_list = []
+    if taf_list is None: taf_list = []
 
-    # List of relevant metars and tafs
-    filtered_metars = []
-    filtered_tafs = []
+    # Relevant metars and tafs - dictionaries keep them in order, and ignore repeats of the same station and time
+    filtered_metars = {}
+    filtered_tafs = {}
     
 
     # Now process each METAR, and check if it intersects with the route buffer.
     for this_met in metar_list:
      
-        met_shape = geometry.Point(this_met['coords']) #Shapely polygon
+        met_shape = geometry.Point(this_met.coords) #Shapely point
         
-        # Test whether each of the buffers intersect with this METAR
-        for routeBuf in fplShapelyBuffers:
-            # If it does, add the metar to the list
-            if routeBuf.intersects(met_shape): 
-                if this_met not in filtered_metars: filtered_metars.append(this_met)
+        # Test whether any of the buffers intersect with this METAR - if so, add it to the list
+        if any(routeBuf.intersects(met_shape) for routeBuf in fplShapelyBuffers):
+            filtered_metars[this_met] = None
 
     # Now process each TAF, and check if it intersects with the route buffer.
     for this_met in taf_list:
      
-        met_shape = geometry.Point(this_met['coords']) #Shapely polygon
+        met_shape = geometry.Point(this_met.coords) #Shapely point
         
-        # Test whether each of the buffers intersect with this TAF
-        for routeBuf in fplShapelyBuffers:
-            # If it does, add the metar to the list
-            if routeBuf.intersects(met_shape): 
-                if this_met not in filtered_tafs: filtered_tafs.append(this_met)
+        # Test whether any of the buffers intersect with this TAF - if so, add it to the list
+        if any(routeBuf.intersects(met_shape) for routeBuf in fplShapelyBuffers):
+            filtered_tafs[this_met] = None
 
-    # Return the new Filtered list of sigmets/airmets 
-    return filtered_metars, filtered_tafs
+    # Return the new Filtered lists of metars and tafs
+    return list(filtered_metars), list(filtered_tafs)
+
+
+def forecast_tafs_at_eta(flightplan_id, taf_lists, departure_time, cruise_speed_kt):
+    """Adds the forecast conditions at the expected overhead time to TAFs relevant to a flight route.
+    The expected time is worked out from the distance along the route to the point nearest the aerodrome, 
+    and the cruise speed - departure TAFs get the departure time, destination TAFs the arrival time.
+    
+    Distance is approximate, using the principle of 1 minute of lat = 1 nm
+    
+    A TafIndex is built once over all the TAFs, so each lookup is a binary search rather than a re-read of the TAF.
+    Each TAF dictionary in the lists is updated with (so pass dictionaries made for this request - eg. from TafForecast.to_dict):
+        eta: expected overhead time (datetime)
+        eta_forecast: the conditions at the eta (refer TafIndex.conditions_at), or None if the TAF is not valid at the eta
+    
+    Parameters
+    ----------
+    flightplan_id : int
+        The FlightPlan's ID
+
+    taf_lists : list
+        List of lists of TAF dictionaries - eg. [depart_taf, enroute_taf, dest_taf]
+
+    departure_time : datetime
+        Expected departure time (UTC)
+
+    cruise_speed_kt : int
+        Cruise speed in knots
+
+    Returns
+    -------
+    TafIndex
+        The index built over the TAFs
+    """
+    
+    sqa_sess = sqa_session()
+    
+    # Retrieve the flightplan for the specified ID
+    flightplan = sqa_sess.query(FlightPlan).filter(FlightPlan.FlightplanID == flightplan_id).first()
+    
+    # Create a Shapely linestring for the route using the tuples of co-ordinates
+    route_geom = geometry.LineString([(float(rtePoint.Longitude),float(rtePoint.Latitude)) for rtePoint in flightplan.FlightPlanPoints])
+    
+    # Build the interval index once, over all the TAFs
+    all_tafs = [taf for taf_list in taf_lists for taf in taf_list]
+    taf_index = TafIndex(all_tafs)
+    
+    cruise_speed_kt = float(cruise_speed_kt)
+    
+    for taf in all_tafs:
+        # How far along the route is the aerodrome - in degrees, then approximated in nm
+        distance_nm = route_geom.project(geometry.Point(taf['coords'])) * 60.0
+        
+        if cruise_speed_kt > 0:
+            taf['eta'] = departure_time + dt.timedelta(hours=distance_nm / cruise_speed_kt)
+        else:
+            taf['eta'] = departure_time
+        
+        taf['eta_forecast'] = taf_index.conditions_at(taf['aerodrome'], taf['eta'])
+    
+    return taf_index
@@ -0,0 +1,251 @@
+"""Prepares GEOJSON Geometry for Output to the Map
+
+This module contains the output stage used for the GEOJSON sent to the map (NOTAMs, flight routes, SIGMETs/AIRMETs):
+- Quantize co-ordinates to a set number of decimal places (MAP_COORD_PRECISION) - 5 decimal places is about 1m,
+  against the 15+ digits of a full float
+- Optionally simplify polygons and lines (Douglas-Peucker, preserving topology) for overview zoom levels,
+  where detail finer than a pixel cannot be seen
+- Report the payload reduction (OutputStats), and from the command line:
+   - geojson-output-stats [zoom]
+- Serialize Features for the map (dumps_geojson, FeatureList) - with orjson when it is installed, falling back to json.
+  Keys are sorted, as str() of a geojson Feature always has, so the structure sent to the map is unchanged
+
+"""
+
+import json
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from shapely import geometry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Geometry types that can be simplified - points are only quantized
+_simplify_types = ('Polygon', 'MultiPolygon', 'LineString', 'MultiLineString')
+
+
+class OutputStats():
+    """
+    A Class to tally the effect of the output stage over a number of geometries
+
+    Attributes
+    ----------
+    geometries : int
+        Number of geometries processed
+    vertices_in, vertices_out : int
+        Number of co-ordinate pairs before and after the output stage
+    chars_in, chars_out : int
+        Length of the serialized co-ordinates before and after the output stage
+
+    Methods
+    -------
+    report()
+        Returns a one-line description of the reduction
+    """
+
+    __slots__ = ('geometries', 'vertices_in', 'vertices_out', 'chars_in', 'chars_out')
+
+    def __init__(self):
+        self.geometries = 0
+        self.vertices_in = 0
+        self.vertices_out = 0
+        self.chars_in = 0
+        self.chars_out = 0
+
+    def __repr__(self):
+        return f'<OutputStats {self.report()}>'
+
+    @property
+    def reduction(self):
+        """ Fraction of the serialized co-ordinates removed by the output stage """
+        return 1 - self.chars_out / self.chars_in if self.chars_in else 0.0
+
+    def report(self):
+        """ Returns a one-line description of the reduction """
+        return (f'{self.geometries} geometries: {self.vertices_in} -> {self.vertices_out} vertices, '
+                f'{self.chars_in} -> {self.chars_out} characters ({self.reduction:.0%} smaller)')
+
+
+def _count_vertices(coords):
+    """ Returns the number of co-ordinate pairs in nested GEOJSON co-ordinates """
+    if coords and isinstance(coords[0], (int, float)):
+        return 1
+    return sum(_count_vertices(c) for c in coords)
+
+
+def quantize_coords(coords, precision):
+    """ Rounds nested GEOJSON co-ordinates to a number of decimal places
+
+    Parameters
+    ----------
+    coords : list or tuple
+        GEOJSON co-ordinates - a pair, or nested lists of pairs
+    precision : int
+        Decimal places to keep
+
+    Returns
+    -------
+    list
+        The rounded co-ordinates, as lists
+    """
+
+    if coords and isinstance(coords[0], (int, float)):
+        return [round(c, precision) for c in coords]
+    return [quantize_coords(c, precision) for c in coords]
+
+
+def tolerance_for_zoom(zoom, overview_zoom):
+    """ Returns the simplification tolerance (degrees) for a map zoom level - about a pixel at that zoom,
+    or None if the zoom is not an overview zoom (at or above overview_zoom) and the full geometry should be used
+
+    Parameters
+    ----------
+    zoom : int or None
+        Map zoom level
+    overview_zoom : int
+        Zoom levels below this are overview levels
+
+    Returns
+    -------
+    float or None
+    """
+
+    if zoom is None or zoom >= overview_zoom:
+        return None
+
+    # A 256 pixel tile covers 360 degrees at zoom 0
+    return 360.0 / (256 * 2 ** max(zoom, 0))
+
+
+def output_geometry(geojson_geom, precision=None, tolerance=None, stats=None):
+    """ Runs a GEOJSON geometry through the output stage - simplifying it (if a tolerance is given) then quantizing it
+
+    Parameters
+    ----------
+    geojson_geom : geojson geometry
+        eg. geojson.Polygon, geojson.Point, geojson.LineString
+    precision : int, optional
+        Decimal places to keep - None keeps full precision
+    tolerance : float, optional
+        Douglas-Peucker tolerance in degrees for polygons and lines - None does not simplify
+    stats : OutputStats, optional
+        Tally to add this geometry to (serializes the co-ordinates to measure them, so only pass when reporting)
+
+    Returns
+    -------
+    geojson geometry
+        A new geometry of the same type
+    """
+
+    coords = geojson_geom['coordinates']
+    new_coords = coords
+
+    # Simplify, keeping the original if simplifying would collapse the shape
+    if tolerance and geojson_geom['type'] in _simplify_types:
+        simple_geom = geometry.shape(geojson_geom).simplify(tolerance, preserve_topology=True)
+        if not simple_geom.is_empty:
+            new_coords = geometry.mapping(simple_geom)['coordinates']
+
+    if precision is not None:
+        new_coords = quantize_coords(new_coords, precision)
+
+    if stats is not None:
+        stats.geometries += 1
+        stats.vertices_in += _count_vertices(coords)
+        stats.vertices_out += _count_vertices(new_coords)
+        stats.chars_in += len(json.dumps(coords))
+        stats.chars_out += len(json.dumps(new_coords))
+
+    if new_coords is coords:
+        return geojson_geom
+
+    return type(geojson_geom)(new_coords)
+
+
+def map_output_geometry(geojson_geom, tolerance=None, stats=None):
+    """ Runs a GEOJSON geometry through the output stage, at the application's MAP_COORD_PRECISION - refer output_geometry """
+
+    return output_geometry(geojson_geom, current_app.config['MAP_COORD_PRECISION'], tolerance, stats)
+
+
+def _json_default(value):
+    """ Converts values json cannot serialize - dates and times are converted to ISO text (as orjson does) """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def dumps_geojson(obj):
+    """ Serializes GEOJSON (a Feature, a list of Features, or any dictionaries/lists/tuples) to compact UTF-8 JSON bytes, 
+    with the keys sorted.  geojson Features and Geometries are dictionaries, so are written directly without their own encoder
+    
+    Parameters
+    ----------
+    obj : dict, list or tuple
+        The GEOJSON to serialize
+    
+    Returns
+    -------
+    bytes
+    """
+    
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    
+    return json.dumps(obj, separators=(',', ':'), sort_keys=True, default=_json_default).encode('utf-8')
+
+
+def geojson_text(obj):
+    """ Serializes GEOJSON to text, for including in a page - refer dumps_geojson """
+    return dumps_geojson(obj).decode('utf-8')
+
+
+class FeatureList(list):
+    """
+    A list of GEOJSON Features that serializes itself with dumps_geojson when shown on a page ({{ features|safe }}),
+    rather than joining str() of each Feature
+    """
+    
+    __slots__ = ()
+    
+    def __str__(self):
+        return geojson_text(self)
+
+
+@click.command('geojson-output-stats')
+@click.argument('zoom', type=int, required=False)
+@with_appcontext
+def geojson_output_stats_command(zoom):
+    """Command Line to report the payload reduction from the GEOJSON output stage, for the latest briefing's NOTAMs
+    usage: flask geojson-output-stats [zoom]
+    """
+    from .db import Notam, NOTAM_LOAD_OPTIONS
+    from .data_handling import sqa_session
+    from .notams import notam_feature
+    from .current_briefing import get_current_briefing
+
+    tolerance = tolerance_for_zoom(zoom, current_app.config['MAP_OVERVIEW_ZOOM'])
+
+    sqa_sess = sqa_session()
+    briefing_id = get_current_briefing().BriefingID
+
+    stats = OutputStats()
+    for ntm in sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.BriefingID == briefing_id).all():
+        notam_feature(ntm, simplify_tolerance=tolerance, stats=stats)
+
+    click.echo(f"Briefing {briefing_id} at precision {current_app.config['MAP_COORD_PRECISION']}" +
+               (f", simplified for zoom {zoom}" if tolerance else ""))
+    click.echo(stats.report())
+
+
+def init_app(app):
+    """
+    Register the Command-Line commands with the flightbriefing app
+    """
+    app.cli.add_command(geojson_output_stats_command)
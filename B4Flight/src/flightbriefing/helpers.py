@@ -10,6 +10,9 @@
 - convert_rgb_to_hex : convert RGB colour to HEX
 - generate_circle_shapely : generate a Shapely circle geometry for a radius around a point
 - send_mail : send an e-mail
+- SingleFlight / single_flight : share one in-flight call between concurrent callers asking for the same thing
+- CircuitBreaker : stop calling an upstream service that is failing or slow, and try it again after a cool-off period
+- LatestBuildCache : hold one expensive object per layer, built once for the layer's latest key (eg. briefing or weather version)
 
 """
 
@@ -19,6 +22,9 @@ from flask import current_app
 from email.message import EmailMessage
 
 import smtplib, ssl
+import threading
+import functools
+import time
 
 
 def read_db_connect():
@@ -448,3 +454,228 @@ def get_max_map_bounds():
         map_bounds = (current_app.config['MAP_BOUNDS_MIN_COORDS'], current_app.config['MAP_BOUNDS_MAX_COORDS'])
         
     return map_bounds
+
+
+class SingleFlight():
+    """
+    Shares one in-flight call between threads asking for the same thing (the "single-flight" pattern).
+    The first caller for a key runs the function; callers arriving with the same key while it is running wait for it,
+    and get the same result (or the same exception).  Once the call completes, the next caller runs the function again.
+    
+    Callers share the result object - so they must not modify it in place
+    
+    Methods
+    -------
+    do(key, fn, *args, **kwargs)
+        Runs fn(*args, **kwargs), unless a call for the same key is already running - then waits for its result
+    """
+    
+    class _Call():
+        __slots__ = ('done', 'result', 'exception')
+        
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exception = None
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) for the key, or waits for the call already running for the key
+        
+        Parameters
+        ----------
+        key : hashable
+            Identifies what is being fetched - callers with the same key share one call
+        fn : function
+            The function to call
+        
+        Returns
+        -------
+        The result of fn
+        """
+        
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = SingleFlight._Call()
+        
+        # Another thread is already fetching this - wait for its result
+        if not is_leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            # Remove the call before releasing waiters, so later callers start a fresh call
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        
+        return call.result
+
+
+def single_flight(fn):
+    """Decorator that coalesces concurrent calls to a function with the same arguments into one call - refer SingleFlight
+    
+    Parameters
+    ----------
+    fn : function
+        The function to wrap - its arguments must be hashable
+    
+    Returns
+    -------
+    function
+    """
+    
+    flight = SingleFlight()
+    
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return flight.do((args, tuple(sorted(kwargs.items()))), fn, *args, **kwargs)
+    
+    wrapper.single_flight = flight
+    return wrapper
+
+
+class CircuitBreaker():
+    """
+    A circuit breaker for an upstream service (eg. a web host).  
+    The breaker opens after a number of consecutive failures - a call that is slower than the latency threshold counts 
+    as a failure.  While open, callers should not call the service.  After the reset period one trial call is allowed 
+    (half-open): if it succeeds the breaker closes, otherwise it opens again
+    
+    Methods
+    -------
+    allow_request()
+        Returns True if the service may be called
+    record_success(elapsed_seconds)
+        Records a completed call and how long it took
+    record_failure()
+        Records a failed call
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    
+    def __init__(self, name, max_failures=3, latency_threshold=5.0, reset_seconds=60):
+        """
+        Parameters
+        ----------
+        name : str
+            Name of the service - used in log messages
+        max_failures : int, default=3
+            Consecutive failures (or slow calls) before the breaker opens
+        latency_threshold : float, default=5.0
+            Calls slower than this many seconds count as failures
+        reset_seconds : float, default=60
+            Seconds the breaker stays open before a trial call is allowed
+        """
+        self.name = name
+        self.max_failures = max_failures
+        self.latency_threshold = latency_threshold
+        self.reset_seconds = reset_seconds
+        
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+    
+    def allow_request(self):
+        """Returns True if the service may be called - the breaker is closed, or it is time for a trial call"""
+        
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            
+            # Only one trial call at a time while half-open
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            
+            return False
+    
+    def record_success(self, elapsed_seconds=0.0):
+        """Records a completed call.  A call slower than the latency threshold is recorded as a failure
+        
+        Returns
+        -------
+        bool
+            True if the call counted as a success
+        """
+        
+        if elapsed_seconds > self.latency_threshold:
+            self.record_failure()
+            return False
+        
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.opened_at = None
+        
+        return True
+    
+    def record_failure(self):
+        """Records a failed call - opening the breaker if there have been too many, or if this was the trial call"""
+        
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.max_failures:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+
+class LatestBuildCache():
+    """
+    Holds one built object per layer (eg. a map layer's tile source or cluster index) - the one for the layer's latest key.
+    Keys are tuples starting with the layer name, then whatever the object was built from (eg. the briefing or weather version).
+    An object is built once, by the first caller for its key; building an object for a new key drops the layer's older objects
+    
+    Methods
+    -------
+    get(key, build)
+        Returns the object for the key, calling build() to create it if needed
+    """
+    
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key, build):
+        """Returns the object for the key, building it (once) if needed
+        
+        Parameters
+        ----------
+        key : tuple
+            (layer name, ...) - identifies what the object is built from
+        build : function
+            Called with no arguments to create the object
+        
+        Returns
+        -------
+        The object built for the key
+        """
+        
+        built = self._objects.get(key)
+        if built is not None:
+            return built
+        
+        with self._lock:
+            built = self._objects.get(key)
+            if built is None:
+                built = build()
+                for old_key in [k for k in self._objects if k[0] == key[0]]:
+                    del self._objects[old_key]
+                self._objects[key] = built
+        
+        return built
@@ -9,15 +9,16 @@ Functionality is implemented using FLASK
 from flask import (
     Blueprint, render_template, redirect, request, session, url_for, current_app, flash
 )
-from sqlalchemy import func, and_
+from sqlalchemy import and_
 
 from datetime import datetime, timedelta
 
-from .db import Briefing, Notam, FlightPlan, FlightPlanPoint, User, UserSetting, NavPoint, ContactMessage
+from .db import Notam, FlightPlan, FlightPlanPoint, User, UserSetting, NavPoint, ContactMessage, FlightBriefingNotams
 from .notams import get_new_deleted_notams
 from .auth import is_logged_in
 from .data_handling import sqa_session    #sqa_session is the Session object for the site
 from .flightplans import filter_point_notams
+from .current_briefing import get_current_briefing
 
 bp = Blueprint('home', __name__)
 
@@ -35,26 +36,36 @@ def index():
     sqa_sess = sqa_session()
     
     # Get the latest briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
-    briefing = sqa_sess.query(Briefing).get(latest_brief_id)
+    briefing = get_current_briefing()
+    latest_brief_id = briefing.BriefingID
     
     # Load the flights for this user- newest to oldest
     flights = sqa_sess.query(FlightPlan).filter(and_(FlightPlan.UserID == session.get("userid"), FlightPlan.Is_Deleted == False)).order_by(FlightPlan.FlightplanID.desc()).limit(5).all()
     
+    # The user's settings for the dashboard - read in one query
+    settings = UserSetting.get_setting_values(session['userid'], ['route_buffer', 'home_aerodrome', 'home_radius'])
+    
+    # Number of NOTAMs for each flight, from the lists precomputed when the briefing was imported - if a flight's list
+    # was computed with a different route buffer (or not yet computed) the count is not shown
+    route_buffer = int(settings['route_buffer'])
+    flight_notams = sqa_sess.query(FlightBriefingNotams).filter(and_(FlightBriefingNotams.BriefingID == latest_brief_id, 
+                                                                   FlightBriefingNotams.FlightplanID.in_([fpl.FlightplanID for fpl in flights]))).all()
+    flight_notam_counts = {fbn.FlightplanID: fbn.Notam_Count for fbn in flight_notams if fbn.Route_Buffer == route_buffer}
+    
     # Show what's changed over the last week
     prev_briefing, new_notams, deleted_notams = get_new_deleted_notams(datetime.utcnow().date() - timedelta(days=7))
     lw_briefing_date = prev_briefing.Briefing_Date
     
     # NOTAMS within NM of home
-    home_aerodrome = UserSetting.get_setting(session['userid'], "home_aerodrome").SettingValue
-    home_radius = UserSetting.get_setting(session['userid'], "home_radius").SettingValue
+    home_aerodrome = settings['home_aerodrome']
+    home_radius = settings['home_radius']
     home_navpt = sqa_sess.query(NavPoint).filter(NavPoint.ICAO_Code == home_aerodrome).first()
     if home_navpt is not None:
         home_notams = len(filter_point_notams(home_navpt.Longitude, home_navpt.Latitude, home_radius))
     else:
         home_notams = None
     
-    return render_template("home.html", briefing=briefing, notam_count=len(briefing.Notams), flights=flights, 
+    return render_template("home.html", briefing=briefing, notam_count=briefing.Notam_Count, flights=flights, flight_notam_counts=flight_notam_counts,
                            last_wk_brief_date=lw_briefing_date, new_notams=new_notams, deleted_notams=deleted_notams,
                            home_notams=home_notams, home_radius=home_radius, home_aerodrome=home_aerodrome)
     
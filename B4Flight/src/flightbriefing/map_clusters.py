@@ -0,0 +1,214 @@
+"""Clusters Point Features for Overview Maps
+
+This module groups METAR/TAF symbols into clusters, so a map zoomed out over the whole country receives tens of 
+clusters (each with a count) rather than every report:
+ - /maplayer/clusters/<layer_name>?zoom=<zoom>&bbox=<min lon>,<min lat>,<max lon>,<max lat>
+
+The index is a hierarchy of grids - one per zoom level, each cell half the size of the one above it, so each level is
+built from the level below it.  It is built once per weather refresh; answering a request only reads the clusters for 
+its zoom level inside its box.  Beyond CLUSTER_MAX_ZOOM the points are returned individually.
+
+Point NOTAMs are not clustered - the NOTAM maps hide Notams per user, and filter them by radius and date, one Feature at a time.
+
+"""
+
+import math
+
+from geojson import Feature, Point
+
+from flask import Blueprint, request, Response, abort
+
+from . import helpers
+from .auth import requires_login
+from .geojson_output import FeatureList, dumps_geojson
+from .weather import generate_metar_geojson, generate_taf_geojson
+from .weather_cache import get_weather_snapshot, METAR_LAYER, TAF_LAYER
+
+bp = Blueprint('map_clusters', __name__)
+
+
+# Points within about this many pixels of each other are clustered
+CLUSTER_RADIUS_PX = 60
+
+# Above this zoom the points are returned individually
+CLUSTER_MAX_ZOOM = 10
+
+
+def _to_unit(lon, lat):
+    """ Converts longitude/latitude to Web Mercator co-ordinates scaled to 0..1 (y is 0 at the north of the map) """
+    lat = max(min(lat, 85.0511), -85.0511)
+    sin_lat = math.sin(lat * math.pi / 180.0)
+    return (lon / 360.0 + 0.5, 0.5 - 0.25 * math.log((1 + sin_lat) / (1 - sin_lat)) / math.pi)
+
+
+def _from_unit(x, y):
+    """ Converts Web Mercator co-ordinates scaled to 0..1 back to longitude/latitude """
+    return ((x - 0.5) * 360.0, 360.0 * math.atan(math.exp((0.5 - y) * 2 * math.pi)) / math.pi - 90.0)
+
+
+class PointClusterIndex():
+    """
+    A Class to represent a hierarchy of clusters of point Features, one level per zoom
+
+    Attributes
+    ----------
+    group : str
+        The map group of the points (eg. 'METAR') - clusters are put in the "<group>_cluster" layer
+    features : list
+        The point Features
+    levels : list
+        For each zoom up to max_zoom: list of clusters (x, y, count, index of the Feature if count is 1)
+
+    Methods
+    -------
+    get_clusters(zoom, bbox)
+        Returns the clusters and single points at a zoom level, within a box
+    """
+
+    __slots__ = ('group', 'max_zoom', 'features', '_points', 'levels')
+
+    def __init__(self, group, features, max_zoom=CLUSTER_MAX_ZOOM, radius_px=CLUSTER_RADIUS_PX):
+        """
+        Parameters
+        ----------
+        group : str
+            The map group of the points
+        features : list
+            GEOJSON Features with Point geometry
+        max_zoom : int
+            The highest zoom that is clustered
+        radius_px : int
+            Size of a grid cell in pixels
+        """
+
+        self.group = group
+        self.max_zoom = max_zoom
+        self.features = features
+        self._points = [_to_unit(*feature['geometry']['coordinates'][:2]) for feature in features]
+
+        # Cells at max_zoom - a 256 pixel tile covers the world at zoom 0
+        cell_size = radius_px / (256.0 * 2 ** max_zoom)
+        cells = {}
+        for index, (x, y) in enumerate(self._points):
+            cell = cells.setdefault((int(x / cell_size), int(y / cell_size)), [0, 0.0, 0.0, index])
+            cell[0] += 1
+            cell[1] += x
+            cell[2] += y
+
+        # Each coarser level merges 2x2 cells of the level below - summing the counts and positions
+        self.levels = [None] * (max_zoom + 1)
+        for zoom in range(max_zoom, -1, -1):
+            self.levels[zoom] = [(sum_x / count, sum_y / count, count, index) for count, sum_x, sum_y, index in cells.values()]
+
+            parent_cells = {}
+            for (cell_x, cell_y), (count, sum_x, sum_y, index) in cells.items():
+                parent = parent_cells.setdefault((cell_x // 2, cell_y // 2), [0, 0.0, 0.0, index])
+                parent[0] += count
+                parent[1] += sum_x
+                parent[2] += sum_y
+            cells = parent_cells
+
+    def __repr__(self):
+        return f'<PointClusterIndex {self.group} {len(self.features)} points>'
+
+    def get_clusters(self, zoom, bbox=None):
+        """ Returns the clusters and single points at a zoom level, within a box
+
+        Parameters
+        ----------
+        zoom : float
+            The map's zoom
+        bbox : tuple, optional
+            (min longitude, min latitude, max longitude, max latitude)
+
+        Returns
+        -------
+        FeatureList
+            Single points are their original Features; clusters are Points with 'point_count' properties
+        """
+
+        if bbox:
+            min_x, max_y = _to_unit(bbox[0], bbox[1])
+            max_x, min_y = _to_unit(bbox[2], bbox[3])
+            in_box = lambda x, y: min_x <= x <= max_x and min_y <= y <= max_y
+        else:
+            in_box = lambda x, y: True
+
+        # Zoomed in beyond the clusters - return the points individually
+        if zoom > self.max_zoom:
+            return FeatureList(feature for feature, (x, y) in zip(self.features, self._points) if in_box(x, y))
+
+        features = FeatureList()
+        for x, y, count, index in self.levels[max(int(zoom), 0)]:
+            if not in_box(x, y):
+                continue
+            if count == 1:
+                features.append(self.features[index])
+            else:
+                features.append(Feature(geometry=Point(_from_unit(x, y)), properties={'group': self.group,
+                                                                                     'layer_group': self.group + '_cluster',
+                                                                                     'point_count': count}))
+
+        return features
+
+
+# Indexes are built once - for the current weather
+_indexes = helpers.LatestBuildCache()
+
+
+def _read_bbox(bbox_text):
+    """ Returns the bbox query argument (min lon,min lat,max lon,max lat) as a tuple of floats - or None if not given """
+
+    if not bbox_text:
+        return None
+
+    bbox = tuple(float(value) for value in bbox_text.split(','))
+    if len(bbox) != 4:
+        raise ValueError(f'bbox needs 4 values: {bbox_text}')
+
+    return bbox
+
+
+@bp.route('/maplayer/clusters/<layer_name>', methods=('GET',))
+@requires_login
+def get_clusters(layer_name):
+    """Returns the clustered points of a layer for a zoom and box, as GEOJSON Features
+
+    Parameters
+    ----------
+    layer_name : str
+        METAR_LAYER or TAF_LAYER
+
+    Query string: zoom (required) - the map's zoom
+                  bbox (optional) - min lon,min lat,max lon,max lat of the map
+    """
+
+    if layer_name not in (METAR_LAYER, TAF_LAYER):
+        abort(404)
+
+    try:
+        zoom = float(request.args['zoom'])
+        bbox = _read_bbox(request.args.get('bbox'))
+    except (KeyError, ValueError):
+        abort(400)
+
+    # float() accepts nan and inf, which cannot pick a zoom level
+    if not math.isfinite(zoom):
+        abort(400)
+
+    weather = get_weather_snapshot()
+    if layer_name == METAR_LAYER:
+        build = lambda: PointClusterIndex('METAR', generate_metar_geojson(weather.metars))
+    else:
+        build = lambda: PointClusterIndex('TAF', generate_taf_geojson(weather.tafs))
+    index = _indexes.get((layer_name, weather.version), build)
+    max_age = weather.max_age()
+
+    resp = Response(dumps_geojson(index.get_clusters(zoom, bbox)), mimetype='application/json')
+    resp.cache_control.private = True
+    if max_age > 0:
+        resp.cache_control.max_age = max_age
+    else:
+        resp.cache_control.no_cache = True
+
+    return resp
@@ -0,0 +1,301 @@
+"""Serves Map Layers as Vector Tiles
+
+This module serves the current briefing's NOTAMs (polygons, circles and points) and the current SIGMETs/AIRMETs
+as Mapbox Vector Tiles (MVT), so a map only downloads the geometry for the area it shows, at a resolution suited to the zoom:
+ - /tiles/notams/<z>/<x>/<y>.mvt
+ - /tiles/sigairmets/<z>/<x>/<y>.mvt
+
+Each tile is clipped to the tile (with a small buffer, so shapes join up across tiles) and simplified to about a pixel at its zoom.
+NOTAM tiles are cached on disk per briefing and colour settings (in TILE_CACHE_FOLDER), as the briefing does not change - 
+they carry the NOTAMs' style table IDs, which change with the colour settings, and not the NOTAM text (the map loads it on demand);
+SIGMET/AIRMET tiles are cached in memory until the weather is next refreshed.
+
+Encoding needs the optional mapbox_vector_tile package - without it the endpoints return 501 (Not Implemented)
+
+"""
+
+import os
+import math
+import zlib
+import shutil
+import threading
+
+from shapely import geometry
+from shapely.ops import transform
+
+from flask import Blueprint, current_app, request, Response, abort
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+from . import helpers
+from .auth import requires_login
+from .db import Notam, NOTAM_LOAD_OPTIONS
+from .data_handling import sqa_session    #sqa_session is the Session object for the site
+from .notams import notam_feature, get_notam_style_table
+from .current_briefing import get_current_briefing
+from .weather_cache import get_weather_snapshot, content_hash
+
+bp = Blueprint('map_tiles', __name__)
+
+
+# The layers served as tiles
+NOTAM_TILE_LAYER = 'notams'
+SIGAIRMET_TILE_LAYER = 'sigairmets'
+
+# Tiles are TILE_EXTENT units across; features are clipped TILE_BUFFER units outside the tile
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+# Highest zoom served - beyond this the map over-zooms the last tile
+MAX_TILE_ZOOM = 14
+
+# Half the width of the Web Mercator world, in metres
+_mercator_max = 20037508.342789244
+
+
+def _to_mercator(lon, lat, z=None):
+    """ Converts longitude/latitude (decimal degrees) to Web Mercator metres - for use with shapely.ops.transform """
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = lon * _mercator_max / 180.0
+    y = math.log(math.tan((90.0 + lat) * math.pi / 360.0)) * _mercator_max / math.pi
+    return (x, y)
+
+
+def tile_bounds(z, x, y):
+    """ Returns the Web Mercator bounds of a tile (min x, min y, max x, max y), and its width in metres
+
+    Parameters
+    ----------
+    z, x, y : int
+        The tile's zoom, column and row (row 0 is the north of the map)
+
+    Returns
+    -------
+    tuple
+        ((min x, min y, max x, max y), width)
+    """
+
+    size = 2 * _mercator_max / (2 ** z)
+    min_x = -_mercator_max + x * size
+    max_y = _mercator_max - y * size
+
+    return (min_x, max_y - size, min_x + size, max_y), size
+
+
+class TileSource():
+    """
+    A Class to represent the features in a tile layer, projected to Web Mercator once so tiles can be cut from them
+
+    Methods
+    -------
+    encode_tile(z, x, y)
+        Returns the features in a tile, clipped and simplified for the zoom, as MVT bytes
+    """
+
+    __slots__ = ('layer_name', 'features')
+
+    def __init__(self, layer_name, features):
+        """
+        Parameters
+        ----------
+        layer_name : str
+            Name of the layer inside the tiles
+        features : list
+            (Shapely geometry in longitude/latitude, properties dictionary) tuples
+        """
+
+        self.layer_name = layer_name
+
+        # Project each geometry once, and note its bounds to quickly skip features outside a tile
+        self.features = []
+        for geom, properties in features:
+            if geom is None or geom.is_empty:
+                continue
+            merc_geom = transform(_to_mercator, geom)
+
+            # Vector tiles cannot hold None values
+            properties = {key: value for key, value in properties.items() if value is not None}
+            self.features.append((merc_geom.bounds, merc_geom, properties))
+
+    def __repr__(self):
+        return f'<TileSource {self.layer_name} {len(self.features)} features>'
+
+    def encode_tile(self, z, x, y):
+        """ Returns the features in a tile as MVT bytes - polygons are clipped to the tile and simplified to about a pixel
+
+        Parameters
+        ----------
+        z, x, y : int
+            The tile's zoom, column and row
+
+        Returns
+        -------
+        bytes
+        """
+
+        (min_x, min_y, max_x, max_y), size = tile_bounds(z, x, y)
+
+        # Clip slightly outside the tile, so lines do not show at tile edges
+        buffer = size * TILE_BUFFER / TILE_EXTENT
+        clip_box = geometry.box(min_x - buffer, min_y - buffer, max_x + buffer, max_y + buffer)
+
+        # One tile unit, in metres - geometry finer than this cannot be seen at this zoom
+        tolerance = size / TILE_EXTENT
+
+        # Convert from metres to tile units, with y up from the bottom of the tile (the encoder flips it)
+        to_tile = lambda mx, my, mz=None: ((mx - min_x) / size * TILE_EXTENT, (my - min_y) / size * TILE_EXTENT)
+
+        tile_features = []
+        for (f_min_x, f_min_y, f_max_x, f_max_y), merc_geom, properties in self.features:
+
+            # Skip features whose bounds do not reach the tile
+            if f_max_x < min_x - buffer or f_min_x > max_x + buffer or f_max_y < min_y - buffer or f_min_y > max_y + buffer:
+                continue
+
+            if merc_geom.geom_type == 'Point':
+                tile_geom = merc_geom
+            else:
+                tile_geom = merc_geom.intersection(clip_box)
+                if tile_geom.is_empty:
+                    continue
+                tile_geom = tile_geom.simplify(tolerance, preserve_topology=True)
+
+            tile_features.append({'geometry': transform(to_tile, tile_geom), 'properties': properties})
+
+        return mapbox_vector_tile.encode([{'name': self.layer_name, 'features': tile_features}])
+
+
+def _notam_tile_source(briefing_id):
+    """ Creates the TileSource for a briefing's NOTAMs, from the stored NOTAM geometry - without the NOTAM text, 
+    which the map loads when a NOTAM is clicked """
+
+    sqa_sess = sqa_session()
+
+    features = []
+    for ntm in sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.BriefingID == briefing_id).order_by(Notam.A_Location).all():
+        feature, this_group, type_suffix = notam_feature(ntm, include_text=False)
+        features.append((geometry.shape(feature['geometry']), feature['properties']))
+
+    return TileSource(NOTAM_TILE_LAYER, features)
+
+
+def _sigairmet_tile_source(weather):
+    """ Creates the TileSource for the SIGMETs/AIRMETs in a weather snapshot """
+
+    features = []
+    for met in weather.sigairmets:
+        # Polygons need at least 4 points (closed) - ignore anything that could not be parsed into an area
+        if len(met['coords']) < 4:
+            continue
+        features.append((geometry.Polygon(met['coords']), {'group': met['type'], 'layer_group': met['type'] + '_polygon',
+                                                           'text': met['body'], 'flight_levels': met['flevels']}))
+
+    return TileSource(SIGAIRMET_TILE_LAYER, features)
+
+
+# Tile sources are built once - for the latest briefing, and for the current weather
+_tile_sources = helpers.LatestBuildCache()
+
+# SIGMET/AIRMET tiles, held until the weather is next refreshed: (snapshot version, z, x, y) -> bytes
+_sigairmet_tiles = {}
+
+
+def _tile_response(tile, etag, max_age=0):
+    """ Returns the tile, with an ETag - or a 304 (Not Modified) if the browser already has this version """
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(tile, mimetype='application/vnd.mapbox-vector-tile')
+
+    resp.set_etag(etag)
+    resp.cache_control.private = True
+    if max_age > 0:
+        resp.cache_control.max_age = max_age
+    else:
+        resp.cache_control.no_cache = True
+
+    return resp
+
+
+@bp.route('/tiles/<layer_name>/<int:z>/<int:x>/<int:y>.mvt', methods=('GET',))
+@requires_login
+def get_tile(layer_name, z, x, y):
+    """Returns a vector tile of the current briefing's NOTAMs, or of the current SIGMETs/AIRMETs
+
+    Parameters
+    ----------
+    layer_name : str
+        NOTAM_TILE_LAYER or SIGAIRMET_TILE_LAYER
+    z, x, y : int
+        The tile's zoom, column and row
+    """
+
+    if layer_name not in (NOTAM_TILE_LAYER, SIGAIRMET_TILE_LAYER) or z > MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+
+    if mapbox_vector_tile is None:
+        current_app.logger.error("Vector tiles requested, but the mapbox_vector_tile package is not installed")
+        abort(501)
+
+    if layer_name == SIGAIRMET_TILE_LAYER:
+        weather = get_weather_snapshot()
+        tile_key = (weather.version, z, x, y)
+
+        tile = _sigairmet_tiles.get(tile_key)
+        if tile is None:
+            source = _tile_sources.get((SIGAIRMET_TILE_LAYER, weather.version), lambda: _sigairmet_tile_source(weather))
+            tile = source.encode_tile(z, x, y)
+
+            # Drop tiles from earlier weather
+            if any(k[0] != weather.version for k in _sigairmet_tiles):
+                _sigairmet_tiles.clear()
+            _sigairmet_tiles[tile_key] = tile
+
+        # Tagged by the tile's content - unchanged by weather refreshes that do not change the SIGMETs/AIRMETs in the tile
+        return _tile_response(tile, f'{layer_name}-{content_hash(tile)}-{z}-{x}-{y}', weather.max_age())
+
+    # NOTAM tiles are for the latest briefing and the current colour settings (the tiles hold style table IDs), and kept on disk
+    briefing_id = get_current_briefing().BriefingID
+    style_key = f'{zlib.crc32(repr(get_notam_style_table().key).encode("utf-8")):08x}'
+    etag = f'{layer_name}-{briefing_id}-{style_key}-{z}-{x}-{y}'
+
+    if request.if_none_match.contains(etag):
+        return _tile_response(b'', etag)
+
+    tile_folder = os.path.join(current_app.config['TILE_CACHE_FOLDER'], layer_name)
+    briefing_folder_name = f'{briefing_id}-{style_key}'
+    briefing_folder = os.path.join(tile_folder, briefing_folder_name)
+    tile_file = os.path.join(briefing_folder, str(z), str(x), f'{y}.mvt')
+
+    try:
+        with open(tile_file, 'rb') as f:
+            return _tile_response(f.read(), etag)
+    except OSError:
+        pass
+
+    def build_source():
+        # A new briefing (or new colour settings) - remove the tiles cached for earlier ones
+        if os.path.isdir(tile_folder):
+            for old_folder in os.listdir(tile_folder):
+                if old_folder != briefing_folder_name:
+                    shutil.rmtree(os.path.join(tile_folder, old_folder), ignore_errors=True)
+        return _notam_tile_source(briefing_id)
+
+    source = _tile_sources.get((NOTAM_TILE_LAYER, briefing_id, style_key), build_source)
+    tile = source.encode_tile(z, x, y)
+
+    # Write the tile to a temporary file, then move it into place - so a partly written tile is never served
+    try:
+        os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+        temp_file = f'{tile_file}.{threading.get_ident()}.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(tile)
+        os.replace(temp_file, tile_file)
+    except OSError as e:
+        current_app.logger.error(f"Error caching vector tile {tile_file}: {e}")
+
+    return _tile_response(tile, etag)
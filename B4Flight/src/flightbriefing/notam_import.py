@@ -8,6 +8,7 @@ Create NOTAM and Briefing object and import to database
 Expected to be run from the command line:
  - import-notams
  - import-notam-text-file <text_file_name>
+ - compute-briefing-diffs
  
 """
 
@@ -28,10 +29,12 @@ import click
 from flask import current_app, render_template
 from flask.cli import with_appcontext
 
-from .notams import parse_notam_text_file
+from .notams import parse_notam_text_file, compute_briefing_diffs
 from .db import Briefing, Notam
 from .data_handling import sqa_session
 from .helpers import send_mail
+from .briefing_cache import start_flight_briefing_precompute
+from .current_briefing import refresh_current_briefing, get_current_briefing
 
 
 def read_settings_ZA():
@@ -434,6 +437,15 @@ def import_notam_ZA(overwrite_existing_file=False):
     # Log the success
     current_app.logger.info(f'Database Import Completed - written {len(brf.Notams)} NOTAMS')
     print(f'Database Import Completed - written {len(brf.Notams)} NOTAMS')
+
+    # Work out the Notams added and removed since the earlier briefings
+    compute_briefing_diffs(brf.BriefingID)
+
+    # This process uses the new briefing straight away - others find it when they next check
+    refresh_current_briefing(brf.Briefing_Country)
+
+    # Classify the new briefing's NOTAMs for each flight in the background
+    start_flight_briefing_precompute(brf.BriefingID)
     
     # Copy the files to the archive
     shutil.copy(pdf_file_name, current_app.config['NOTAM_ARCHIVE_FOLDER'])
@@ -521,12 +533,33 @@ def import_notam_text_command(filename):
     sess.commit()
     
     click.echo(f'Database Import Completed - written {len(brf.Notams)} NOTAMS')
+
+    # Work out the Notams added and removed since the earlier briefings
+    compute_briefing_diffs(brf.BriefingID)
+
+    # This process uses the new briefing straight away - others find it when they next check
+    refresh_current_briefing(brf.Briefing_Country)
+
+    # Classify the new briefing's NOTAMs for each flight in the background
+    start_flight_briefing_precompute(brf.BriefingID)
     click.echo("--- Command-Line Completed ---")
 
 
+@click.command('compute-briefing-diffs')
+@with_appcontext
+def compute_briefing_diffs_command():
+    """Work out the new and expired NOTAMs of the current briefing against the earlier briefings - normally done on import
+    usage: flask compute-briefing-diffs
+    """
+    briefing_id = get_current_briefing().BriefingID
+    diff_count = compute_briefing_diffs(briefing_id)
+    click.echo(f'Stored {diff_count} briefing diffs for briefing {briefing_id}')
+
+
 def init_app(app):
     """
     Register the Command-Line commands with the flightbriefing app
     """
     app.cli.add_command(import_notams_command)
     app.cli.add_command(import_notam_text_command)
+    app.cli.add_command(compute_briefing_diffs_command)
@@ -4,10 +4,13 @@ This module contains functions to
 - parse CAA Notam Text Files
 - get new and deleted Notams since a specific date
 - generate GEOJSON features for a list of notams
+- cache the serialized GEOJSON for a whole briefing (or part of it - eg. along a flight's route), shared by all users, 
+  with each user's hidden notams overlaid per request
  
 """
 
 import re
+import threading
 from datetime import datetime, timedelta
 from flask import current_app, session
 from geojson import Polygon, Point, Feature
@@ -15,10 +18,21 @@ from geojson import Polygon, Point, Feature
 from sqlalchemy import func, and_
 
 from . import helpers    
-from .db import Briefing, Notam, UserHiddenNotam
+from .db import Briefing, Notam, UserHiddenNotam, QCode_2_3_Lookup, BriefingDiff, NOTAM_LOAD_OPTIONS
 from .data_handling import sqa_session    #sqa_session is the Session object for the site
+from .geojson_output import map_output_geometry, FeatureList, geojson_text
+from .current_briefing import get_current_briefing
 
 
+# The map group for NOTAMS the user has permanently hidden
+HIDDEN_NOTAM_GROUP = 'My Hidden NOTAMS'
+
+# Number of briefing GEOJSON layers (briefing + flight date + colours) to keep in the cache
+NOTAM_LAYER_CACHE_SIZE = 16
+
+# Number of GEOJSON layers for parts of a briefing (eg. a flight's route, a home aerodrome) to keep in the cache - these are smaller
+NOTAM_SUBSET_LAYER_CACHE_SIZE = 64
+
 
 def tidy_notam(notam):
     """ A few manipulations on the Notam object to tidy it up, calc a few derived fields 
@@ -375,9 +389,67 @@ def get_hidden_notams(briefing_id):
     return hidden
 
 
+def compute_briefing_diffs(briefing_id, depth=None):
+    """ Function to work out the Notams added and removed between a briefing and each of the earlier briefings 
+    for its country (up to BRIEFING_DIFF_DEPTH of them), storing them as BriefingDiffs - called when the briefing is imported.
+    Each briefing's Notam Numbers are read once, and compared in memory
+
+    Parameters
+    ----------
+    briefing_id : int
+        The briefing just imported
+    depth : int, optional
+        Number of earlier briefings to compare to - defaults to BRIEFING_DIFF_DEPTH
+
+    Returns
+    -------
+    int
+        Number of BriefingDiffs stored
+    """
+
+    if depth is None:
+        depth = current_app.config['BRIEFING_DIFF_DEPTH']
+
+    sqa_sess = sqa_session()
+
+    brf = sqa_sess.query(Briefing).get(briefing_id)
+    prev_briefing_ids = [row.BriefingID for row in sqa_sess.query(Briefing.BriefingID).filter(
+        and_(Briefing.Briefing_Country == brf.Briefing_Country, Briefing.BriefingID < briefing_id)).order_by(Briefing.BriefingID.desc()).limit(depth)]
+
+    # Notam Numbers of the briefing, and of the earlier briefings
+    numbers = {}
+    for row in sqa_sess.query(Notam.BriefingID, Notam.Notam_Number).filter(Notam.BriefingID.in_([briefing_id] + prev_briefing_ids)):
+        numbers.setdefault(row.BriefingID, []).append(row.Notam_Number)
+
+    latest_numbers = numbers.get(briefing_id, [])
+    latest_set = set(latest_numbers)
+
+    for prev_briefing_id in prev_briefing_ids:
+        prev_numbers = numbers.get(prev_briefing_id, [])
+        prev_set = set(prev_numbers)
+
+        # Counted per Notam, as the database comparison did
+        new_numbers = [number for number in latest_numbers if number not in prev_set]
+        deleted_numbers = [number for number in prev_numbers if number not in latest_set]
+
+        sqa_sess.merge(BriefingDiff(BriefingID=briefing_id, Prev_BriefingID=prev_briefing_id, 
+                                    New_Count=len(new_numbers), Deleted_Count=len(deleted_numbers),
+                                    New_Notam_Numbers=' '.join(sorted(set(new_numbers))), 
+                                    Deleted_Notam_Numbers=' '.join(sorted(set(deleted_numbers)))))
+
+    # Only the latest briefing is compared to earlier ones - drop the diffs of earlier briefings
+    sqa_sess.query(BriefingDiff).filter(BriefingDiff.BriefingID < briefing_id).delete(synchronize_session=False)
+    sqa_sess.commit()
+
+    current_app.logger.info(f'Stored {len(prev_briefing_ids)} briefing diffs for briefing {briefing_id}')
+
+    return len(prev_briefing_ids)
+
+
 def get_new_deleted_notams(since_date=datetime.utcnow().date() - timedelta(days=7), briefing_id=None, return_count_only=True):
     """ Function to return the New and Deleted NOTAMS since a specific date, or since a specific Briefing.  
-    Returns either a list of notams or a count of Notams
+    Returns either a list of notams or a count of Notams.
+    Uses the BriefingDiff stored when the latest briefing was imported, comparing the briefings' Notams if there isn't one
 
     Parameters
     ----------
@@ -399,7 +471,7 @@ def get_new_deleted_notams(since_date=datetime.utcnow().date() - timedelta(days=
     sqa_sess = sqa_session()
     
     # Get latest briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
+    latest_brief_id = get_current_briefing().BriefingID
 
     # If a specific previous briefing ID was supplied use that
     if briefing_id:
@@ -411,6 +483,18 @@ def get_new_deleted_notams(since_date=datetime.utcnow().date() - timedelta(days=
     # Load the prev briefing
     prev_briefing = sqa_sess.query(Briefing).get(prev_briefing_id)
     
+    # Use the stored differences if they were computed
+    diff = sqa_sess.query(BriefingDiff).get((latest_brief_id, prev_briefing_id))
+    if diff is not None:
+        if return_count_only == True:
+            return prev_briefing, diff.New_Count, diff.Deleted_Count
+        
+        new_notams = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == latest_brief_id, 
+                                                       Notam.Notam_Number.in_(BriefingDiff.notam_numbers(diff.New_Notam_Numbers)))).order_by(Notam.Notam_Number).all()
+        deleted_notams = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == prev_briefing_id, 
+                                                           Notam.Notam_Number.in_(BriefingDiff.notam_numbers(diff.Deleted_Notam_Numbers)))).order_by(Notam.Notam_Number).all()
+        return prev_briefing, new_notams, deleted_notams
+    
     # Get the notams for current briefing and prev briefing
     latest_notams = sqa_sess.query(Notam.Notam_Number).filter(Notam.BriefingID == latest_brief_id)
     prev_notams = sqa_sess.query(Notam.Notam_Number).filter(Notam.BriefingID == prev_briefing_id)
@@ -427,19 +511,445 @@ def get_new_deleted_notams(since_date=datetime.utcnow().date() - timedelta(days=
         new_notam_nos = latest_notams.filter(~Notam.Notam_Number.in_(prev_notams))
         deleted_notam_nos = prev_notams.filter(~Notam.Notam_Number.in_(latest_notams))
         
-        new_notams = sqa_sess.query(Notam).filter(and_(Notam.BriefingID == latest_brief_id, Notam.Notam_Number.in_(new_notam_nos))).order_by(Notam.Notam_Number).all()
-        deleted_notams = sqa_sess.query(Notam).filter(and_(Notam.BriefingID == prev_briefing_id, Notam.Notam_Number.in_(deleted_notam_nos))).order_by(Notam.Notam_Number).all()
+        new_notams = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == latest_brief_id, Notam.Notam_Number.in_(new_notam_nos))).order_by(Notam.Notam_Number).all()
+        deleted_notams = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == prev_briefing_id, Notam.Notam_Number.in_(deleted_notam_nos))).order_by(Notam.Notam_Number).all()
 
 
     return prev_briefing, new_notams, deleted_notams
 
 
-def generate_notam_geojson(notam_list, hide_user_notams=False):
+class NotamStyleTable():
+    """
+    A Class to represent the map styles for Notams, sent to the map once rather than with every Feature.
+    Each Notam Feature carries a small group ID and style ID - indexes into the groups and styles lists
+
+    Attributes
+    ----------
+    key : tuple
+        The colour settings the table was built with
+    groups : list
+        Group names (QCode_2_3_Lookup.Grouping, and HIDDEN_NOTAM_GROUP) - the index is the group ID
+    styles : list
+        (fill colour, line colour) rgba strings - the index is the style ID
+    hidden_group_id, hidden_style_id : int
+        The group and style for Notams the user has permanently hidden
+    default_style_id : int
+        The style for QCodes without a colour (or all QCodes, if not using category colours)
+
+    Methods
+    -------
+    style_ids(qcode, hidden=False)
+        Returns the group name, group ID and style ID for a Notam's QCode_2_3_Lookup
+    to_dict()
+        Returns the table for the map page
+    """
+
+    __slots__ = ('key', 'groups', 'styles', 'hidden_group_id', 'hidden_style_id', 'default_style_id', '_group_ids', '_style_ids', '_code_styles')
+
+    def __init__(self, key, qcodes):
+        """
+        Parameters
+        ----------
+        key : tuple
+            The colour settings, in the order (MAP_USE_CATEGORY_COLOURS, MAP_DEFAULT_CATEGORY_COLOUR, MAP_NOTAM_OPACITY,
+            MAP_HIDDEN_NOTAM_COLOUR, MAP_HIDDEN_NOTAM_OPACITY)
+        qcodes : list
+            All the QCode_2_3_Lookup objects
+        """
+
+        self.key = key
+        use_category_colours, default_colour, opacity, hidden_colour, hidden_opacity = key
+
+        self.groups = sorted(set(qcode.Grouping for qcode in qcodes if qcode.Grouping)) + [HIDDEN_NOTAM_GROUP]
+        self._group_ids = {group: group_id for group_id, group in enumerate(self.groups)}
+        self.hidden_group_id = self._group_ids[HIDDEN_NOTAM_GROUP]
+
+        self.styles = []
+        self._style_ids = {}
+
+        # The style for each QCode - if not using category colours, they all share the default colour
+        self._code_styles = {}
+        for qcode in qcodes:
+            colr = default_colour if use_category_colours == '0' or not qcode.Group_Colour else qcode.Group_Colour
+            self._code_styles[qcode.Code] = self._add_style(colr, opacity)
+
+        self.hidden_style_id = self._add_style(hidden_colour, hidden_opacity)
+        self.default_style_id = self._add_style(default_colour, opacity)
+
+    def __repr__(self):
+        return f'<NotamStyleTable {len(self.groups)} groups, {len(self.styles)} styles>'
+
+    def _add_style(self, colr, opacity):
+        """ Returns the style ID for a Hex colour and fill opacity, adding the style if it is new """
+
+        style_key = (colr.lower(), opacity)
+        if style_key not in self._style_ids:
+            col_r = int(colr[1:3],16)
+            col_g = int(colr[3:5],16)
+            col_b = int(colr[5:7],16)
+
+            # Fill Colour with the opacity, and Line Colour with an opacity of 1
+            self._style_ids[style_key] = len(self.styles)
+            self.styles.append((f'rgba({col_r},{col_g},{col_b},{opacity})', f'rgba({col_r},{col_g},{col_b},1)'))
+
+        return self._style_ids[style_key]
+
+    def style_ids(self, qcode, hidden=False):
+        """ Returns the group name, group ID and style ID for a Notam
+
+        Parameters
+        ----------
+        qcode : QCode_2_3_Lookup
+            The Notam's QCode_2_3_Lookup
+        hidden : bool
+            Has the user permanently hidden this Notam?  If so, it is placed in the HIDDEN_NOTAM_GROUP
+
+        Returns
+        -------
+        tuple
+            (group name, group ID, style ID)
+        """
+
+        if hidden:
+            return HIDDEN_NOTAM_GROUP, self.hidden_group_id, self.hidden_style_id
+
+        # A Grouping added since the table was built is added to the end, so existing IDs do not change
+        group_id = self._group_ids.get(qcode.Grouping)
+        if group_id is None:
+            group_id = len(self.groups)
+            self._group_ids[qcode.Grouping] = group_id
+            self.groups.append(qcode.Grouping)
+
+        # A QCode added since the table was built uses the default colour
+        style_id = self._code_styles.get(qcode.Code, self.default_style_id)
+
+        return qcode.Grouping, group_id, style_id
+
+    def to_dict(self):
+        """ Returns the table for the map page - group names, and fill and line colours, in ID order """
+
+        return {'groups': self.groups,
+                'fills': [fill for fill, line in self.styles],
+                'lines': [line for fill, line in self.styles],
+                'hidden_group_id': self.hidden_group_id,
+                'hidden_style_id': self.hidden_style_id}
+
+
+_notam_style_table = None
+
+
+def get_notam_style_table():
+    """ Function to return the NotamStyleTable for the current colour settings - built once from the QCode_2_3_Lookup table
+    
+    Returns
+    -------
+    NotamStyleTable
+    """
+    global _notam_style_table
+
+    key = tuple(current_app.config[setting] for setting in ('MAP_USE_CATEGORY_COLOURS', 'MAP_DEFAULT_CATEGORY_COLOUR', 'MAP_NOTAM_OPACITY',
+                                                           'MAP_HIDDEN_NOTAM_COLOUR', 'MAP_HIDDEN_NOTAM_OPACITY'))
+
+    table = _notam_style_table
+    if table is None or table.key != key:
+        sqa_sess = sqa_session()
+        table = NotamStyleTable(key, sqa_sess.query(QCode_2_3_Lookup).all())
+        _notam_style_table = table
+
+    return table
+
+
+def notam_geometry_key(ntm):
+    """ Function to return the key of a Notam's geometry - Notams with the same key are drawn with the same geometry.
+    Bounded areas are keyed by their co-ordinates; circles and points by their Unique_Geo_ID (lat_lon_radius)
+    
+    Parameters
+    ----------
+    ntm : Notam
+        The Notam to key
+        
+    Returns
+    -------
+    str
+    """
+
+    if ntm.Bounded_Area:
+        return ntm.Bounded_Area
+    
+    # Notams imported before Unique_Geo_ID was set
+    if ntm.Unique_Geo_ID is None:
+        return f'{ntm.Coord_Lat}_{ntm.Coord_Lon}_{ntm.Radius}'
+    
+    return ntm.Unique_Geo_ID
+
+
+def notam_geometry(ntm, simplify_tolerance=None, stats=None):
+    """ Function to create the GEOJSON geometry for a Notam - a polygon for a bounded area or circle, otherwise a point.
+    The geometry is passed through the output stage (refer geojson_output) - quantized to MAP_COORD_PRECISION
+    
+    Parameters
+    ----------
+    ntm : Notam
+        Notam object to create the geometry from
+    simplify_tolerance : float, optional
+        Simplify the geometry to this tolerance (degrees) - for overview zoom levels
+    stats : OutputStats, optional
+        Tally of the output stage's payload reduction
+        
+    Returns
+    -------
+    tuple
+        geojson_geom: GEOJSON Polygon or Point
+        type_suffix: the geometry of the Feature - '_polygon' or '_circle'
+    """
+
+    # If this Notam has a bounded area, then create a GEOJSON polygon object
+    if ntm.Bounded_Area:
+        # Convert from Degrees Minutes Seconds to Decimal Degrees, for the bounded area and reverse coords to Lon, Lat
+        coords = helpers.convert_bounded_dms_to_dd(ntm.Bounded_Area, reverse_coords=True)
+        # Create the GeoJson Polygon
+        geojson_geom=Polygon([coords])
+        type_suffix = '_polygon'
+
+    # If this Notam is a circle, then also create a GEOJSON polygon object
+    elif ntm.is_circle():
+        coords = helpers.convert_bounded_dms_to_dd(ntm.circle_bounded_area(), reverse_coords=True)
+        geojson_geom=Polygon([coords])
+        type_suffix = '_polygon'
+
+    # Otherwise this Notam is a point with no radius, so create a GEOJSON circle object 
+    else:
+        coords = (helpers.convert_dms_to_dd(ntm.Coord_Lon), helpers.convert_dms_to_dd(ntm.Coord_Lat))
+        geojson_geom=Point(coords)
+        type_suffix = '_circle'
+    
+    # Quantize (and simplify, for overview zooms) the geometry
+    return map_output_geometry(geojson_geom, simplify_tolerance, stats), type_suffix
+
+
+def notam_details(ntm, include_text=True):
+    """ Function to return the details of a Notam shown on the map, as a dictionary
+    
+    Parameters
+    ----------
+    ntm : Notam
+        The Notam
+    include_text : bool
+        Include the Notam text - if not, the map fetches it when the Notam is clicked (refer viewmap.notam_text)
+        
+    Returns
+    -------
+    dict
+        notam_number, notam_location, from_date, to_date, duration (and notam_text)
+    """
+
+    # Date Notam applies from
+    ntm_from = datetime.strftime(ntm.From_Date,"%Y-%m-%d %H:%M") 
+    # Date Notam applies to - take into account Perm and Est dates
+    if ntm.To_Date_Permanent == True:
+        ntm_to = 'Perm'
+    else:
+        ntm_to = datetime.strftime(ntm.To_Date,"%Y-%m-%d %H:%M")
+        ntm_to += " Est" if ntm.To_Date_Estimate == True else ""
+    
+    details = {'notam_number': ntm.Notam_Number,
+               'notam_location': ntm.A_Location,
+               'from_date': ntm_from,
+               'to_date' : ntm_to,
+               'duration' : ntm.Duration if ntm.Duration else ''}
+    if include_text:
+        details['notam_text'] = ntm.Notam_Text
+
+    return details
+
+
+def notam_feature(ntm, hidden=False, simplify_tolerance=None, stats=None, include_text=True):
+    """ Function to create the GEOJSON Feature for a single Notam, with its details as flat properties - 
+    the map uses MergedNotamFeature, which draws Notams with the same geometry as one Feature
+    The Feature's colours and group are given as IDs in the NotamStyleTable (refer get_notam_style_table)
+    
+    Parameters
+    ----------
+    ntm : Notam
+        Notam object to create the GEOJSON Feature from
+    hidden : bool
+        Has the user permanently hidden this Notam?  If so, it is placed in the 'My Hidden NOTAMS' group
+    simplify_tolerance : float, optional
+        Simplify the geometry to this tolerance (degrees) - for overview zoom levels
+    stats : OutputStats, optional
+        Tally of the output stage's payload reduction
+    include_text : bool
+        Include the Notam text
+        
+    Returns
+    -------
+    tuple
+        feature: GEOJSON Feature
+        group: the map group for the Notam - its QCode_2_3_Lookup.Grouping, or 'My Hidden NOTAMS'
+        type_suffix: the geometry of the Feature - '_polygon' or '_circle'
+    """
+
+    geojson_geom, type_suffix = notam_geometry(ntm, simplify_tolerance, stats)
+    
+    # Look up the Notam's group and colours - permanently hidden Notams are grouped with other Hidden Notams
+    this_group, group_id, style_id = get_notam_style_table().style_ids(ntm.QCode_2_3_Lookup, hidden)
+
+    # Create the Feature, setting the various Notam attributes as properties
+    properties = notam_details(ntm, include_text)
+    properties.update({'group_id': group_id, 
+                       'style_id': style_id,
+                       'radius': ntm.Radius,
+                       'permanently_hidden' : hidden})
+
+    feature = Feature(geometry=geojson_geom, properties=properties)
+    
+    return feature, this_group, type_suffix
+
+
+class MergedNotamFeature():
+    """
+    A Class to represent the Notams drawn with one geometry - Notams with the same geometry key, map group, colour and radius.
+    Busy aerodromes often have many Notams with the same centre and radius; they are drawn as one Feature
+    carrying the list of Notams
+
+    Attributes
+    ----------
+    geometry : geojson geometry
+        The shared GEOJSON Polygon or Point
+    type_suffix : str
+        The geometry of the Feature - '_polygon' or '_circle'
+    group : str
+        The map group - a QCode_2_3_Lookup.Grouping, or HIDDEN_NOTAM_GROUP
+    group_id, style_id : int
+        IDs in the NotamStyleTable
+    radius : int
+        The Notams' radius (nm) - used by the map's radius filter
+    hidden : bool
+        Are these Notams permanently hidden by the user?
+    notams : list
+        The Notam objects
+
+    Methods
+    -------
+    feature(include_text=True)
+        Returns the GEOJSON Feature
+    split_hidden(hidden_numbers)
+        Returns this Feature split into the Notams not hidden, and those permanently hidden by the user
+    """
+
+    __slots__ = ('geometry', 'type_suffix', 'group', 'group_id', 'style_id', 'radius', 'hidden', 'notams')
+
+    def __init__(self, geometry, type_suffix, group, group_id, style_id, radius, hidden=False, notams=None):
+        self.geometry = geometry
+        self.type_suffix = type_suffix
+        self.group = group
+        self.group_id = group_id
+        self.style_id = style_id
+        self.radius = radius
+        self.hidden = hidden
+        self.notams = [] if notams is None else notams
+
+    def __repr__(self):
+        return f'<MergedNotamFeature {self.layer_name} {len(self.notams)} Notams>'
+
+    @property
+    def layer_name(self):
+        """ The map layer - "Group_Geometry" """
+        return self.group + self.type_suffix
+
+    def feature(self, include_text=True):
+        """ Returns the GEOJSON Feature - the Notams' details are in the 'notams' property (refer notam_details) """
+
+        return Feature(geometry=self.geometry, properties={'group_id': self.group_id,
+                                                           'style_id': self.style_id,
+                                                           'radius': self.radius,
+                                                           'permanently_hidden': self.hidden,
+                                                           'notams': [notam_details(ntm, include_text) for ntm in self.notams]})
+
+    def split_hidden(self, hidden_numbers):
+        """ Returns this Feature split in two - the Notams not hidden, and those the user has permanently hidden
+        (in the HIDDEN_NOTAM_GROUP, with the same geometry)
+        
+        Parameters
+        ----------
+        hidden_numbers : set
+            Notam Numbers the user has permanently hidden
+        
+        Returns
+        -------
+        tuple
+            (MergedNotamFeature of the remaining Notams - None if all are hidden, MergedNotamFeature of the hidden Notams)
+        """
+
+        table = get_notam_style_table()
+        
+        remaining = [ntm for ntm in self.notams if ntm.Notam_Number not in hidden_numbers]
+        hidden = [ntm for ntm in self.notams if ntm.Notam_Number in hidden_numbers]
+
+        remaining_feature = None
+        if remaining:
+            remaining_feature = MergedNotamFeature(self.geometry, self.type_suffix, self.group, self.group_id, self.style_id, 
+                                                   self.radius, self.hidden, remaining)
+
+        hidden_feature = MergedNotamFeature(self.geometry, self.type_suffix, HIDDEN_NOTAM_GROUP, table.hidden_group_id, 
+                                            table.hidden_style_id, self.radius, True, hidden)
+
+        return remaining_feature, hidden_feature
+
+
+def merge_notam_features(notam_list, hidden_notams=frozenset(), simplify_tolerance=None, stats=None):
+    """ Function to group Notams into MergedNotamFeatures - one per geometry key (refer notam_geometry_key), map group, 
+    colour and radius.  Each geometry is built once, however many Notams share it
+    
+    Parameters
+    ----------
+    notam_list : list
+        list of Notam objects
+    hidden_notams : set, optional
+        Notam Numbers the user has permanently hidden - these are grouped in the HIDDEN_NOTAM_GROUP
+    simplify_tolerance : float, optional
+        Simplify the geometry to this tolerance (degrees) - for overview zoom levels
+    stats : OutputStats, optional
+        Tally of the output stage's payload reduction
+        
+    Returns
+    -------
+    list
+        MergedNotamFeature objects, in the order of their first Notam
+    """
+
+    table = get_notam_style_table()
+    
+    geometries = {}
+    merged = {}
+    for ntm in notam_list:
+        geo_key = notam_geometry_key(ntm)
+        
+        # Build each geometry once
+        geom = geometries.get(geo_key)
+        if geom is None:
+            geom = geometries[geo_key] = notam_geometry(ntm, simplify_tolerance, stats)
+        
+        # If this NOTAM is permanently hidden, it is grouped with other Hidden Notams
+        hidden = ntm.Notam_Number in hidden_notams
+        this_group, group_id, style_id = table.style_ids(ntm.QCode_2_3_Lookup, hidden)
+        
+        merge_key = (geo_key, group_id, style_id, ntm.Radius)
+        merged_feature = merged.get(merge_key)
+        if merged_feature is None:
+            merged_feature = merged[merge_key] = MergedNotamFeature(geom[0], geom[1], this_group, group_id, style_id, ntm.Radius, hidden)
+        merged_feature.notams.append(ntm)
+
+    return list(merged.values())
+
+
+def generate_notam_geojson(notam_list, hide_user_notams=False, simplify_tolerance=None):
     """ Function to create a list of GEOJSON features based on the list of Notams passed  
     The NOTAMS grouped into GEOJSON Features using the QCode_2_3_Lookup.Grouping 
     Each Feature will form a layer on the map - this allows for easy filtering of layers.
     The function also returns a list of the Groups applicable to these NOTAMS, and a list of map layers
     The Map layers differ from the simple Groups, as each layer only contains one type of geometry.
+    Notams drawn with the same geometry (in the same group) share one Feature - refer merge_notam_features
     
     Eg. Groups could be: ['Hazards','Aerodromes'...]
     Layers could be: ['Hazards_polygon','Hazards_circle', 'Aerodromes_polygon','Aerodromes_circle' ...]
@@ -452,11 +962,13 @@ def generate_notam_geojson(notam_list, hide_user_notams=False):
         list of Notam objects to create the GEOJSON Features from
     hide_user_notams : bool
         If the User has chosen to permanently hide NOTAMS, should we hide them?
+    simplify_tolerance : float, optional
+        Simplify the geometry to this tolerance (degrees) - for overview zoom levels (refer geojson_output.tolerance_for_zoom)
         
     Returns
     -------
     tuple
-        notam_features: list of GEOJSON Feature strings - each element in the list includes Notams for a specific QCode_2_3_Lookup.Grouping
+        notam_features: FeatureList of GEOJSON Features (serializes itself on the page) - each element in the list includes Notams for a specific QCode_2_3_Lookup.Grouping
         used_groups: list of QCode_2_3_Lookup.Grouping items that were used/applicable to the Notams in the original list - eg. ['Hazards','Aerodromes'...]
         used_layers: list of Layer names structred as "Group_Geometry" - eg. ['Hazards_polygon','Hazards_circle', 'Aerodromes_polygon','Aerodromes_circle' ...]
     """
@@ -464,103 +976,31 @@ def generate_notam_geojson(notam_list, hide_user_notams=False):
     # Initialise Variables
     used_groups = []  #contains applicable groupings for use on the web page (i.e. it excludes groupings that do not appear) - used to filter layers on the map
     used_layers = []  #contains layer groupings in form: used_group+_+geometry (poly/circle) - used to separate layers on the map
-    notam_features = []
+    notam_features = FeatureList()
 
     # If we need to hide user notams:
-    if hide_user_notams == True:
+    if hide_user_notams == True and notam_list:
         # Get the briefingID from the first NOTAM in the list
         briefingid = notam_list[0].BriefingID
         # Use this briefing ID to get a list of hidden NOTAMS
-        hidden_notams = get_hidden_notams(briefingid)
-    # Otherwise an empty list
+        hidden_notams = set(get_hidden_notams(briefingid))
+    # Otherwise an empty set
     else:
-        hidden_notams = []
+        hidden_notams = set()
 
-    # Create a GEOJSON Feature for each Notam - Feature contains specific Notam attributes
-    for ntm in notam_list:
-        
-        # Date Notam applies from
-        ntm_from = datetime.strftime(ntm.From_Date,"%Y-%m-%d %H:%M") 
-        # Date Notam applies to - take into account Perm and Est dates
-        if ntm.To_Date_Permanent == True:
-            ntm_to = 'Perm'
-        else:
-            ntm_to = datetime.strftime(ntm.To_Date,"%Y-%m-%d %H:%M")
-            ntm_to += " Est" if ntm.To_Date_Estimate == True else ""
-        
-        # If this Notam has a bounded area, then create a GEOJSON polygon object
-        if ntm.Bounded_Area:
-            # Convert from Degrees Minutes Seconds to Decimal Degrees, for the bounded area and reverse coords to Lon, Lat
-            coords = helpers.convert_bounded_dms_to_dd(ntm.Bounded_Area, reverse_coords=True)
-            # Create the GeoJson Polygon
-            geojson_geom=Polygon([coords])
-            type_suffix = '_polygon'
-
-        # If this Notam is a circle, then also create a GEOJSON polygon object
-        elif ntm.is_circle():
-            coords = helpers.convert_bounded_dms_to_dd(ntm.circle_bounded_area(), reverse_coords=True)
-            geojson_geom=Polygon([coords])
-            type_suffix = '_polygon'
-
-        # Otherwise this Notam is a point with no radius, so create a GEOJSON circle object 
-        else:
-            coords = (helpers.convert_dms_to_dd(ntm.Coord_Lon), helpers.convert_dms_to_dd(ntm.Coord_Lat))
-            geojson_geom=Point(coords)
-            type_suffix = '_circle'
-        
-        # Get the Notam Duration if it exists
-        if ntm.Duration:
-            ntm_duration = ntm.Duration
-        else:
-            ntm_duration = ''
-        
-        # If this NOTAM is permanently hidden, group it with other Hidden Notams
-        if ntm.Notam_Number in hidden_notams:
-            hidden = True
-            this_group = 'My Hidden NOTAMS'
-            colr = current_app.config['MAP_HIDDEN_NOTAM_COLOUR']
-            opacity = current_app.config['MAP_HIDDEN_NOTAM_OPACITY']
-        # Otherwise use the norma Q-Code Grouping
-        else:
-            hidden = False
-            this_group = ntm.QCode_2_3_Lookup.Grouping
-
-            # Get the Colour for this QCode Group, and extract the RGB channels from the Hex colour code
-            if current_app.config['MAP_USE_CATEGORY_COLOURS'] == '0':
-                colr = current_app.config['MAP_DEFAULT_CATEGORY_COLOUR']
-            else:
-                colr = ntm.QCode_2_3_Lookup.Group_Colour
-            opacity = current_app.config['MAP_NOTAM_OPACITY']
-        
-        col_r = int(colr[1:3],16)
-        col_g = int(colr[3:5],16)
-        col_b = int(colr[5:7],16)
+    # Create a GEOJSON Feature for each geometry - Feature contains the Notams drawn with it
+    for merged_feature in merge_notam_features(notam_list, hidden_notams, simplify_tolerance):
         
-        # Create the Fill Colour attribute - opacity as set above
-        fill_col=f'rgba({col_r},{col_g},{col_b},{opacity})'
-        # Create the Line Colour attribute - opacity of 1
-        line_col=f'rgba({col_r},{col_g},{col_b},1)'
-
-        # Append this Feature to the collection, setting the various Notam attributes as properties
-        notam_features.append(Feature(geometry=geojson_geom, properties={'fill':fill_col, 'line':line_col, 
-                                                                 'group': this_group,
-                                                                 'layer_group': this_group + type_suffix, 
-                                                                 'notam_number': ntm.Notam_Number,
-                                                                 'notam_location': ntm.A_Location,
-                                                                 'from_date': ntm_from,
-                                                                 'to_date' : ntm_to,
-                                                                 'duration' : ntm_duration,
-                                                                 'radius': ntm.Radius,
-                                                                 'permanently_hidden' : hidden,
-                                                                 'notam_text': ntm.Notam_Text}))
+        # Append this Feature to the collection
+        notam_features.append(merged_feature.feature())
 
         # Add this group+geometry combination to the list, so the map knows to split out a layer for it.
-        if (this_group + type_suffix) not in used_layers:
-            used_layers.append(this_group + type_suffix)
+        if merged_feature.layer_name not in used_layers:
+            used_layers.append(merged_feature.layer_name)
 
         # Add the Notam Grouping to the collection of used groups
-        if this_group not in used_groups:
-            used_groups.append(this_group)
+        if merged_feature.group not in used_groups:
+            used_groups.append(merged_feature.group)
         
     # Sort groups alphabetically for better display on the map
     used_groups.sort()
@@ -568,3 +1008,286 @@ def generate_notam_geojson(notam_list, hide_user_notams=False):
         
     return notam_features, used_groups, used_layers
 
+
+
+class BriefingNotamLayer():
+    """
+    A Class to represent the GEOJSON for all the Notams in a briefing (optionally for a flight date), serialized once
+    and shared by all users.  The layer is built without any user's hidden Notams - overlay_hidden() re-tags
+    the Notams a user has hidden, so the work per map view depends on the number of hidden Notams, not the briefing size
+
+    Attributes
+    ----------
+    key : tuple
+        The cache key - (briefing ID, flight date, colour settings, simplify tolerance), followed by the subset of the briefing
+        for layers of only some of its Notams (refer get_notam_subset_layer)
+    text : str
+        The GEOJSON Feature list, serialized as it is shown on the map - without the Notam text, which the map 
+        fetches when a Notam is clicked
+    features : list
+        The MergedNotamFeatures in the layer
+    spans : dict
+        Notam Number: list of (start, end, index in features) - where the Features holding the Notam are in the text
+    layer_counts : dict
+        Layer name ("Group_Geometry"): number of Features in the layer
+    layer_groups : dict
+        Layer name: the Group the layer belongs to
+
+    Methods
+    -------
+    layer_names(hidden_notams)
+        Returns the Groups and Layers used on the map, once the user's hidden Notams are re-tagged
+    overlay_hidden(hidden_notams)
+        Returns the GEOJSON text, groups and layers with the user's hidden Notams re-tagged
+    """
+
+    __slots__ = ('key', 'text', 'features', 'spans', 'layer_counts', 'layer_groups')
+
+    def __init__(self, key, notam_list):
+        self.key = key
+        self.features = merge_notam_features(notam_list, simplify_tolerance=key[3])
+        self.spans = {}
+        self.layer_counts = {}
+        self.layer_groups = {}
+
+        # Serialize each Feature (as FeatureList does), noting where it sits in the list
+        pieces = []
+        offset = 1  # after the opening '['
+        for index, merged_feature in enumerate(self.features):
+            feature_text = geojson_text(merged_feature.feature(include_text=False))
+            layer_name = merged_feature.layer_name
+
+            for ntm in merged_feature.notams:
+                self.spans.setdefault(ntm.Notam_Number, []).append((offset, offset + len(feature_text), index))
+            self.layer_counts[layer_name] = self.layer_counts.get(layer_name, 0) + 1
+            self.layer_groups[layer_name] = merged_feature.group
+
+            pieces.append(feature_text)
+            offset += len(feature_text) + 1  # the ',' separator
+
+        self.text = '[' + ','.join(pieces) + ']'
+
+    def __repr__(self):
+        return f'<BriefingNotamLayer {self.key[0]} {self.key[1]}>'
+
+    def _hidden_spans(self, hidden_notams):
+        """ Returns the Features to split for the hidden Notams, in the order they appear in the text:
+        list of (start, end, MergedNotamFeature, set of hidden Notam Numbers) - Notams not in this layer are ignored """
+
+        hidden_spans = {}
+        for ntm in hidden_notams:
+            for start, end, index in self.spans.get(ntm.Notam_Number, []):
+                # A Notam number can appear more than once in hidden_notams - the set only holds it once
+                hidden_spans.setdefault(start, (start, end, self.features[index], set()))[3].add(ntm.Notam_Number)
+
+        return [hidden_spans[start] for start in sorted(hidden_spans)]
+
+    def _used_names(self, layer_counts, layer_groups):
+        """ Returns the sorted Groups and Layers that have Features """
+
+        used_layers = sorted(layer for layer, count in layer_counts.items() if count > 0)
+        used_groups = sorted(set(layer_groups[layer] for layer in used_layers))
+
+        return used_groups, used_layers
+
+    def layer_names(self, hidden_notams):
+        """ Returns the Groups and Layers used on the map for a user, with the Notams they have permanently hidden 
+        moved to the HIDDEN_NOTAM_GROUP - without building the GEOJSON text
+        
+        Parameters
+        ----------
+        hidden_notams : list
+            The Notam objects the user has hidden
+        
+        Returns
+        -------
+        tuple
+            used_groups: list of the Groups used on the map, sorted
+            used_layers: list of the Layers used on the map, sorted
+        """
+
+        layer_counts = dict(self.layer_counts)
+        layer_groups = dict(self.layer_groups)
+
+        for start, end, merged_feature, hidden_numbers in self._hidden_spans(hidden_notams):
+            # Hidden Notams keep their geometry - eg. Aerodromes_polygon becomes 'My Hidden NOTAMS_polygon'
+            hidden_layer = HIDDEN_NOTAM_GROUP + merged_feature.type_suffix
+            layer_counts[hidden_layer] = layer_counts.get(hidden_layer, 0) + 1
+            layer_groups[hidden_layer] = HIDDEN_NOTAM_GROUP
+
+            # The Feature only leaves its layer if all its Notams are hidden
+            if len(hidden_numbers) == len(merged_feature.notams):
+                layer_counts[merged_feature.layer_name] -= 1
+
+        return self._used_names(layer_counts, layer_groups)
+
+    def overlay_hidden(self, hidden_notams):
+        """ Returns the layer for a user, with the Notams they have permanently hidden moved to the HIDDEN_NOTAM_GROUP
+        
+        Parameters
+        ----------
+        hidden_notams : list
+            The Notam objects the user has hidden (Notams not in this layer are ignored)
+        
+        Returns
+        -------
+        tuple
+            notam_geojson: the GEOJSON Feature list as text
+            used_groups: list of the Groups used on the map, sorted
+            used_layers: list of the Layers used on the map, sorted
+        """
+
+        hidden_spans = self._hidden_spans(hidden_notams)
+        if not hidden_spans:
+            return (self.text,) + self._used_names(self.layer_counts, self.layer_groups)
+
+        # Splice the split Features into the shared text, in order
+        pieces = []
+        prev_end = 0
+        for start, end, merged_feature, hidden_numbers in hidden_spans:
+            pieces.append(self.text[prev_end:start])
+            pieces.append(','.join(geojson_text(split_feature.feature(include_text=False)) 
+                                   for split_feature in merged_feature.split_hidden(hidden_numbers) if split_feature is not None))
+            prev_end = end
+        pieces.append(self.text[prev_end:])
+
+        return (''.join(pieces),) + self.layer_names(hidden_notams)
+
+
+_notam_layers = {}
+_notam_layers_lock = threading.Lock()
+
+_notam_subset_layers = {}
+_notam_subset_layers_lock = threading.Lock()
+
+
+def _layer_settings():
+    """ Returns the settings the Feature colours and co-ordinates depend on - they form part of the layers' cache keys """
+    return tuple(current_app.config[setting] for setting in ('MAP_USE_CATEGORY_COLOURS', 'MAP_DEFAULT_CATEGORY_COLOUR', 'MAP_NOTAM_OPACITY',
+                                                             'MAP_HIDDEN_NOTAM_COLOUR', 'MAP_HIDDEN_NOTAM_OPACITY', 'MAP_COORD_PRECISION'))
+
+
+def _get_notam_layer(layers, layers_lock, cache_size, cache_key, read_notams):
+    """ Returns the BriefingNotamLayer for cache_key from a layer cache - building it from read_notams() if needed """
+
+    layer = layers.get(cache_key)
+    if layer is not None:
+        return layer
+
+    # Only one thread builds the layers - others waiting on the lock then use what was built
+    with layers_lock:
+        layer = layers.get(cache_key)
+        if layer is None:
+            layer = BriefingNotamLayer(cache_key, read_notams())
+
+            # Drop the oldest layers once the cache is full
+            while len(layers) >= cache_size:
+                layers.pop(next(iter(layers)))
+            layers[cache_key] = layer
+
+    return layer
+
+
+def get_briefing_notam_layer(briefing_id, flight_date=None, simplify_tolerance=None):
+    """ Function to return the shared GEOJSON layer for all the Notams in a briefing (optionally those applicable 
+    on a flight date).  Layers are cached by (briefing, flight date, colour settings, simplify tolerance), and built once
+    
+    Parameters
+    ----------
+    briefing_id : int
+        The Briefing to show the Notams for
+    flight_date : str, optional
+        Date of the flight (YYYY-MM-DD) - only Notams applicable on this date are included
+    simplify_tolerance : float, optional
+        Simplify the geometry to this tolerance (degrees) - for overview zoom levels
+
+    Returns
+    -------
+    BriefingNotamLayer
+    """
+
+    cache_key = (int(briefing_id), flight_date or None, _layer_settings(), simplify_tolerance)
+
+    def read_notams():
+        sqa_sess = sqa_session()
+
+        # Filter applicable Notams for the Briefing - filtering by flight date if required
+        if flight_date:
+            return sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == briefing_id, Notam.From_Date <= flight_date, Notam.To_Date >= flight_date)).order_by(Notam.A_Location).all()
+        return sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.BriefingID == briefing_id).order_by(Notam.A_Location).all()
+
+    return _get_notam_layer(_notam_layers, _notam_layers_lock, NOTAM_LAYER_CACHE_SIZE, cache_key, read_notams)
+
+
+def get_notam_subset_layer(briefing_id, subset, read_notams, flight_date=None):
+    """ Function to return a shared GEOJSON layer for some of the Notams in a briefing - eg. those along a flight's route, 
+    or around a home aerodrome.  Layers are cached by (briefing, flight date, colour settings, subset), and built once - 
+    the user's hidden Notams are overlaid per request, as for the whole briefing (refer BriefingNotamLayer)
+    
+    Parameters
+    ----------
+    briefing_id : int
+        The Briefing the Notams come from
+    subset : tuple
+        Identifies the Notams in the layer - eg. ('flight', FlightplanID, route buffer).  Must include everything read_notams depends on, 
+        other than the briefing and flight date
+    read_notams : function
+        Called to read the Notams (a list of Notam objects) if the layer is not cached
+    flight_date : date or str, optional
+        Date of the flight the Notams were filtered for
+
+    Returns
+    -------
+    BriefingNotamLayer
+    """
+
+    cache_key = (int(briefing_id), flight_date or None, _layer_settings(), None, subset)
+
+    return _get_notam_layer(_notam_subset_layers, _notam_subset_layers_lock, NOTAM_SUBSET_LAYER_CACHE_SIZE, cache_key, read_notams)
+
+
+def get_user_hidden_notams(briefing_id):
+    """ Function to return the Notams in a Briefing that the current user has permanently hidden - 
+    refer get_hidden_notams, which returns only the Notam Numbers
+
+    Parameters
+    ----------
+    briefing_id : int
+        The briefing to match the hidden NOTAMS from.
+
+    Returns
+    -------
+    list
+        List of Notam objects
+    """
+
+    sqa_sess = sqa_session()
+
+    return sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).join(UserHiddenNotam, Notam.Notam_Number == UserHiddenNotam.Notam_Number).filter(
+        and_(Notam.BriefingID == briefing_id, UserHiddenNotam.UserID == session['userid'])).all()
+
+
+def get_briefing_notam_geojson(briefing_id, flight_date=None):
+    """ Function to return the GEOJSON for all the Notams in a briefing (optionally those applicable on a flight date), 
+    for the current user.  The shared layer is cached (refer get_briefing_notam_layer);
+    only the user's permanently hidden Notams are processed on each call.
+    Refer generate_notam_geojson for the Groups and Layers
+    
+    Parameters
+    ----------
+    briefing_id : int
+        The Briefing to show the Notams for
+    flight_date : str, optional
+        Date of the flight (YYYY-MM-DD) - only Notams applicable on this date are included
+
+    Returns
+    -------
+    tuple
+        notam_geojson: the GEOJSON Feature list as text
+        used_groups: list of QCode_2_3_Lookup.Grouping items used - eg. ['Hazards','Aerodromes'...]
+        used_layers: list of Layer names structred as "Group_Geometry" - eg. ['Hazards_polygon','Hazards_circle' ...]
+    """
+
+    layer = get_briefing_notam_layer(briefing_id, flight_date)
+
+    return layer.overlay_hidden(get_user_hidden_notams(briefing_id))
@@ -0,0 +1,103 @@
+"""Detects Repeated Queries within a Request (N+1 queries)
+
+Relationships are lazy-loaded by default - reading a relationship for each row of a list issues one SELECT per row.
+These SELECTs have the same SQL, with different parameters, so in debug mode each request counts the SELECTs it runs:
+- A SELECT run more than QUERY_REPEAT_THRESHOLD times in a request is logged as a warning, with the endpoint
+- The number of repeated SELECTs is returned in the X-Repeated-Queries response header
+The fix is usually a loader strategy on the query that reads the list (refer db.NOTAM_LOAD_OPTIONS and db.FLIGHTPLAN_LOAD_OPTIONS)
+
+Only active when the app runs in debug mode - the counts are not kept in production
+
+"""
+
+from flask import current_app, g, request, has_request_context
+from sqlalchemy import event
+
+from .data_handling import sqa_engine
+
+
+class QueryCount():
+    """
+    A Class to represent the number of times a SELECT statement was run in a request
+
+    Attributes
+    ----------
+    count : int
+        Number of times the statement was run
+    parameters : set
+        Hashes of the distinct parameters it was run with - the same statement and parameters is a redundant query;
+        the same statement with different parameters is usually a lazy-load in a loop
+    """
+
+    __slots__ = ('count', 'parameters')
+
+    def __init__(self):
+        self.count = 0
+        self.parameters = set()
+
+    def __repr__(self):
+        return f'<QueryCount {self.count} runs, {len(self.parameters)} distinct parameters>'
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    """ SQLAlchemy before_cursor_execute event - counts each SELECT run during a request """
+
+    if not has_request_context() or not statement.lstrip().upper().startswith('SELECT'):
+        return
+
+    if 'query_counts' not in g:
+        g.query_counts = {}
+
+    query_count = g.query_counts.get(statement)
+    if query_count is None:
+        query_count = g.query_counts[statement] = QueryCount()
+
+    query_count.count += 1
+    query_count.parameters.add(hash(repr(parameters)))
+
+
+def repeated_queries():
+    """ Function to return the SELECTs in the current request that were run more than QUERY_REPEAT_THRESHOLD times
+
+    Returns
+    -------
+    list
+        (statement, QueryCount) tuples, most-run first
+    """
+
+    query_counts = g.get('query_counts', {})
+    threshold = current_app.config['QUERY_REPEAT_THRESHOLD']
+
+    return sorted([(statement, query_count) for statement, query_count in query_counts.items() if query_count.count > threshold],
+                  key=lambda item: item[1].count, reverse=True)
+
+
+def _report_repeated_queries(response):
+    """ Logs the repeated SELECTs in the request, and adds the count to the response headers """
+
+    repeated = repeated_queries()
+
+    for statement, query_count in repeated:
+        # Only the start of the statement - enough to identify the table and relationship
+        current_app.logger.warning(f'Repeated query on {request.method} {request.path} ({request.endpoint}): '
+                                   f'run {query_count.count} times, with {len(query_count.parameters)} different parameters: '
+                                   f'{" ".join(statement.split())[:300]}')
+
+    response.headers['X-Repeated-Queries'] = str(sum(query_count.count for statement, query_count in repeated))
+
+    return response
+
+
+def init_app(app):
+    """
+    Register the repeated query detection with the flightbriefing app - only in debug mode
+    """
+
+    if not app.debug:
+        return
+
+    # The engine is shared by every app in the process - only listen once
+    if not event.contains(sqa_engine, 'before_cursor_execute', _count_query):
+        event.listen(sqa_engine, 'before_cursor_execute', _count_query)
+
+    app.after_request(_report_repeated_queries)
@@ -1,6 +1,9 @@
 """Contains various standalone functions used across the application
 
 - extract_ATNS_data : Extract ATNS aerodromes, nav beacons, significant points from KML file 
+- benchmark_weather_page_extraction : Compare the PRE-block extractor to BeautifulSoup on recorded weather pages
+- benchmark_weather_date_resolution : Compare per-time date calculation to the per-page WeatherDateResolver, across month ends
+- benchmark_geojson_serialization : Compare str() of geojson Features to dumps_geojson (orjson or json) for a map-sized Feature list
 
 """
 
@@ -8,6 +11,15 @@
 
 from xml.etree.ElementTree import ElementTree as ET
 import csv
+import json
+import math
+import re
+import time
+
+from datetime import datetime, timedelta
+
+from flightbriefing.weather_parsing import extract_pre_blocks, WeatherDateResolver
+from flightbriefing import geojson_output
 
 
 def extract_ATNS_data(filename, csv_filename):
@@ -110,3 +122,205 @@ def extract_ATNS_items(ns, branch, category_name, data_list):
 #extract_ATNS_data('C:/Users/aretallack/git/B4Flight/navdata_working/RSA DATA - 22APR2021.kml', 'C:/Users/aretallack/git/B4Flight/navdata_working/RSA DATA - 22Apr2021.csv')
 
 
+def benchmark_weather_page_extraction(page_files, repeat=50):
+    """Benchmarks the streaming PRE-block extractor against the BeautifulSoup html.parser approach previously
+    used by the weather readers, on recorded weather pages (eg. METAR, TAF and SIGMET pages saved from the browser).
+    Checks that both approaches extract the same PRE text and "No Data For" stations, and prints the timings 
+    
+    Parameters
+    ----------
+    page_files : list of str
+        The recorded web pages (html files) to benchmark against
+    repeat: int, default=50
+        Number of times to parse each page
+    
+    Returns
+    -------
+    Nothing
+    
+    """
+    
+    # BeautifulSoup is only needed to compare against
+    from bs4 import BeautifulSoup
+    
+    re_no_data = re.compile(r'No Data For (?P<missing>[A-Z,a-z]{4,4})', re.IGNORECASE)
+    
+    for page_file in page_files:
+        with open(page_file, 'rb') as f:
+            content = f.read()
+        
+        # The previous approach - build the DOM, pull the PRE tags, and search the full text for stations with no data 
+        start = time.perf_counter()
+        for _ in range(repeat):
+            soup = BeautifulSoup(content.decode('utf-8', errors='replace'), 'html.parser')
+            soup_pres = [str(pre.text) for pre in soup.find_all('pre')]
+            soup_no_data = re_no_data.findall(soup.text)
+        soup_time = (time.perf_counter() - start) / repeat
+        
+        # The streaming extractor
+        start = time.perf_counter()
+        for _ in range(repeat):
+            pres, no_data = extract_pre_blocks(content)
+        extract_time = (time.perf_counter() - start) / repeat
+        
+        matches = soup_pres == pres and sorted(soup_no_data) == sorted(no_data)
+        
+        print(f'{page_file}: {len(pres)} PRE blocks, {len(no_data)} stations with no data')
+        print(f'   BeautifulSoup: {soup_time*1000:.2f}ms   Extractor: {extract_time*1000:.2f}ms   Speed-up: {soup_time/extract_time:.1f}x   Output matches: {matches}')
+
+#benchmark_weather_page_extraction(['C:/Users/aretallack/git/B4Flight/wx_pages/metars.html', 'C:/Users/aretallack/git/B4Flight/wx_pages/tafs.html', 'C:/Users/aretallack/git/B4Flight/wx_pages/sigmet.html'])
+
+
+def _search_metar_taf_date(now, day, hr, mn=0):
+    """The date calculation previously used by the weather readers (weather.calc_metar_taf_date), against a fixed "now" -
+    today, otherwise search from tomorrow back 25 days for the day of month.  Used to check and benchmark WeatherDateResolver
+    """
+    
+    if day == now.day:
+        yr, mth = now.year, now.month
+    else:
+        yr = 0
+        for d in range(-1,26):
+            full_date = now - timedelta(days=d)
+            if day == full_date.day:
+                yr, mth = full_date.year, full_date.month
+                break
+        if yr == 0:
+            return None
+    
+    if hr == 24:
+        return datetime(yr, mth, day, 0, mn) + timedelta(days=1)
+    return datetime(yr, mth, day, hr, mn)
+
+
+def benchmark_weather_date_resolution(times_per_page=400, repeat=50):
+    """Benchmarks resolving the day/hour/minute times on a weather page to full dates - searching the calendar for every time
+    (as the weather readers previously did) against one WeatherDateResolver per page.
+    Checks both give the same dates for reference times around month and year ends (including February and a leap year),
+    and for the benchmark page, and prints the timings
+    
+    Parameters
+    ----------
+    times_per_page : int, default=400
+        Number of times to resolve per page - roughly a METAR page, or a TAF page at 4 times per TAF
+    repeat: int, default=50
+        Number of pages to resolve
+    
+    Returns
+    -------
+    bool
+        True if both approaches gave the same dates for all reference times, and for the benchmark page
+    
+    """
+    
+    # Reference times either side of month ends
+    check_nows = [datetime(2021, 1, 31, 23, 50), datetime(2021, 2, 1, 0, 10), datetime(2021, 2, 28, 23, 55), 
+                  datetime(2021, 3, 1, 0, 5), datetime(2020, 2, 29, 12, 0), datetime(2020, 12, 31, 23, 59), 
+                  datetime(2021, 4, 30, 22, 0), datetime(2021, 5, 1, 1, 0), datetime(2021, 6, 15, 12, 0)]
+    
+    mismatches = 0
+    for now in check_nows:
+        dates = WeatherDateResolver(now)
+        for day in range(1, 32):
+            for hr in (0, 6, 12, 24):
+                if dates.resolve(day, hr, 30) != _search_metar_taf_date(now, day, hr, 30):
+                    mismatches += 1
+                    print(f'   Mismatch at {now}: day {day} hour {hr} - {dates.resolve(day, hr, 30)} vs {_search_metar_taf_date(now, day, hr, 30)}')
+    
+    # A page of times spread over the last few days and tomorrow - like METAR observations, TAF issue and validity times
+    now = datetime.utcnow()
+    page = [((now - timedelta(hours=h % 72 - 24)).day, h % 24, h % 60) for h in range(times_per_page)]
+    
+    # Searching the calendar for every time, with a new "now" each time
+    start = time.perf_counter()
+    for _ in range(repeat):
+        search_dates = [_search_metar_taf_date(datetime.utcnow(), day, hr, mn) for day, hr, mn in page]
+    search_time = (time.perf_counter() - start) / repeat
+    
+    # One resolver for the page
+    start = time.perf_counter()
+    for _ in range(repeat):
+        dates = WeatherDateResolver()
+        resolver_dates = [dates.resolve(day, hr, mn) for day, hr, mn in page]
+    resolver_time = (time.perf_counter() - start) / repeat
+    
+    # Both approaches should give the same dates for the page (from the last repeat of each)
+    page_matches = search_dates == resolver_dates
+    
+    print(f'{len(check_nows)} reference times checked around month ends: {mismatches} mismatch(es)')
+    print(f'{times_per_page} times per page   Search: {search_time*1000:.2f}ms   Resolver: {resolver_time*1000:.2f}ms   Speed-up: {search_time/resolver_time:.1f}x   Page dates match: {page_matches}')
+    
+    return mismatches == 0 and page_matches
+
+#benchmark_weather_date_resolution()
+
+
+def benchmark_geojson_serialization(feature_count=3000, points_per_polygon=33, repeat=20):
+    """Benchmarks serializing a map's GEOJSON Feature list - str() of each geojson Feature (as the map pages previously did)
+    against dumps_geojson, with orjson (if installed) and with the json fallback.
+    Checks all approaches give the same structure once parsed, and prints the timings and sizes
+    
+    Parameters
+    ----------
+    feature_count : int, default=3000
+        Number of Features in the list - roughly a briefing's NOTAMs
+    points_per_polygon : int, default=33
+        Number of points in each polygon - a circle NOTAM is drawn with 33
+    repeat: int, default=20
+        Number of times to serialize the list
+    
+    Returns
+    -------
+    bool
+        True if all approaches gave the same structure
+    
+    """
+    
+    # geojson is only needed to build the Features to compare
+    from geojson import Feature, Polygon
+    
+    # NOTAM-like Features - circles around points spread over the country
+    features = []
+    for i in range(feature_count):
+        lon, lat = 17 + (i % 150) * 0.1, -22 - (i // 150) * 0.1
+        ring = [(round(lon + 0.05 * math.cos(a * 2 * math.pi / (points_per_polygon - 1)), 5), 
+                 round(lat + 0.05 * math.sin(a * 2 * math.pi / (points_per_polygon - 1)), 5)) for a in range(points_per_polygon)]
+        features.append(Feature(geometry=Polygon([ring]), properties={'fill': 'rgba(255,128,0,0.3)', 'line': 'rgba(191,96,0,1)', 
+                                                                     'group': 'Hazards', 'layer_group': 'Hazards_polygon',
+                                                                     'notam_number': f'A{i:04d}/21', 'notam_location': 'FAJA',
+                                                                     'from_date': '01-Jan-2021 06:00', 'to_date': '31-Jan-2021 18:00',
+                                                                     'duration': None, 'text': 'AIRSPACE RESTRICTED ' * 5}))
+    feature_list = geojson_output.FeatureList(features)
+    
+    # The previous approach - a list of Features shown on the page
+    start = time.perf_counter()
+    for _ in range(repeat):
+        str_text = str(list(features))
+    str_time = (time.perf_counter() - start) / repeat
+    
+    timings = []
+    outputs = []
+    
+    # dumps_geojson, with and without orjson
+    orjson = geojson_output.orjson
+    for use_orjson in ([True, False] if orjson is not None else [False]):
+        geojson_output.orjson = orjson if use_orjson else None
+        try:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                text = str(feature_list)
+            timings.append(('orjson' if use_orjson else 'json', (time.perf_counter() - start) / repeat, len(text)))
+            outputs.append(text)
+        finally:
+            geojson_output.orjson = orjson
+    
+    matches = all(json.loads(text) == json.loads(str_text) for text in outputs)
+    
+    print(f'{feature_count} Features of {points_per_polygon} points   str(): {str_time*1000:.1f}ms, {len(str_text)} characters')
+    for name, took, length in timings:
+        print(f'   dumps_geojson ({name}): {took*1000:.1f}ms, {length} characters   Speed-up: {str_time/took:.1f}x')
+    print(f'Structure matches: {matches}')
+    
+    return matches
+
+#benchmark_geojson_serialization()
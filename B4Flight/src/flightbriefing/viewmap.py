@@ -3,25 +3,32 @@
 This module contains views to 
 Display Notams on a Map (all notams / new notams / notams on flight path / notams for home aerodrome )
 Display list of Notam details (all notams / new & deleted notams )
+Serve the map layers (briefing notams / flight route / notams on flight path / new notams / home aerodrome notams / weather) 
+as JSON, with ETags, for the map to fetch once the page has loaded
 
 Functionality is implemented using FLASK
 
 """
 
-from sqlalchemy import func, and_
+import zlib
+
+from sqlalchemy import and_
 
 from flask import (
-    Blueprint, redirect, render_template, request, session, url_for, current_app, flash, abort
+    Blueprint, redirect, render_template, request, session, url_for, current_app, flash, abort, Response
 )
 
 from datetime import datetime, timedelta
 
-from . import helpers, flightplans
+from . import helpers, flightplans, briefing_cache
 from .auth import requires_login
-from .db import FlightPlan, Notam, Briefing, UserSetting, NavPoint, UserHiddenNotam
+from .db import FlightPlan, Notam, Briefing, UserSetting, NavPoint, UserHiddenNotam, NOTAM_LOAD_OPTIONS
 from .data_handling import sqa_session    #sqa_session is the Session object for the site
-from .notams import get_new_deleted_notams, generate_notam_geojson, get_hidden_notams
-from .weather import read_sigmet_airmet_ZA, read_metar_ZA, read_taf_ZA, generate_sigmet_geojson, generate_metar_geojson, generate_taf_geojson
+from .notams import (get_new_deleted_notams, get_hidden_notams, get_briefing_notam_layer, get_notam_subset_layer, 
+                     get_user_hidden_notams, get_notam_style_table)
+from .weather_cache import get_weather_snapshot, content_hash, SIGMET_LAYER, METAR_LAYER, TAF_LAYER
+from .geojson_output import tolerance_for_zoom, dumps_geojson
+from .current_briefing import get_current_briefing
 
 bp = Blueprint('viewmap', __name__)
 
@@ -54,14 +61,14 @@ def detailnotams():
         
     # Otherwise start with the latest notam
     else:
-        briefing_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
+        briefing_id = get_current_briefing().BriefingID
 
     # Filter for a flight on a specific date if requested
     if flight_date:
-        notam_list = sqa_sess.query(Notam).filter(and_(Notam.BriefingID == briefing_id, Notam.From_Date <= flight_date, Notam.To_Date > flight_date))
+        notam_list = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == briefing_id, Notam.From_Date <= flight_date, Notam.To_Date > flight_date))
     # Otherwise fetch all
     else:
-        notam_list = sqa_sess.query(Notam).filter(Notam.BriefingID == briefing_id)
+        notam_list = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.BriefingID == briefing_id)
         
     
     return render_template('maps/detailnotams.html', briefings = briefings, notams = notam_list, 
@@ -78,7 +85,7 @@ def changednotamdetail():
     # Only show Briefings from last 60 days
     since_date = datetime.utcnow().date() - timedelta(days=60)
     # Get the latest briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
+    latest_brief_id = get_current_briefing().BriefingID
     # Get all historic briefings except for the latest
     briefings = sqa_sess.query(Briefing.BriefingID, Briefing.Briefing_Ref, Briefing.Briefing_Date).filter(and_(Briefing.Briefing_Date > since_date, Briefing.BriefingID < latest_brief_id)).order_by(Briefing.BriefingID.desc()).all()
     
@@ -127,10 +134,10 @@ def listnotams():
         
         # If a Flight Date was chosen, filter
         if flight_date:
-            notam_list = sqa_sess.query(Notam).filter(and_(Notam.BriefingID == briefing_id, Notam.From_Date <= flight_date, Notam.To_Date > flight_date)).all()
+            notam_list = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(and_(Notam.BriefingID == briefing_id, Notam.From_Date <= flight_date, Notam.To_Date > flight_date)).all()
         #Otherwise show all
         else:
-            notam_list = sqa_sess.query(Notam).filter(Notam.BriefingID == briefing_id).all()
+            notam_list = sqa_sess.query(Notam).options(*NOTAM_LOAD_OPTIONS).filter(Notam.BriefingID == briefing_id).all()
 
     
     return render_template('maps/listnotams.html', briefings = briefings, notams = notam_list, default_date = default_date, briefing_id = briefing_id)
@@ -142,6 +149,9 @@ def listnotams():
 def viewmap():
     """Displays html page showing Notams on a Map
     User has ability to filter NOTAMS by flight date
+    
+    The page is sent without the map data - the map fetches each layer (Notams, SIGMET/AIRMET, METAR, TAF) 
+    from its own url once the page has loaded (refer notam_layer and weather_layer)
     """    
     
     # Start with no filter on Flight Date
@@ -149,48 +159,408 @@ def viewmap():
     
     # User has asked to filter by flight date
     if request.method == "POST":
-        flight_date = request.form['flight-date']
+        flight_date = request.form['flight-date'] or None
+
+        # Each flight date builds (and caches) a briefing layer - so only accept real dates, as notam_layer does
+        _check_flight_date(flight_date)
 
     # Retrieve the most recent briefing
+    briefing = get_current_briefing()
+    latest_brief_id = briefing.BriefingID
+
+    # Get the Groups and Layers needed for the map - filtering by flight date if required
+    # The Features for the briefing are built once and cached; only this user's hidden Notams are re-tagged
+    notam_layer = get_briefing_notam_layer(latest_brief_id, flight_date)
+    used_groups, used_layers = notam_layer.layer_names(get_user_hidden_notams(latest_brief_id))
+    
+    # The map fetches the weather layers that have reports
+    weather = get_weather_snapshot()
+    sigair_geojson_url = url_for('viewmap.weather_layer', layer_name=SIGMET_LAYER) if weather.sigairmets else None
+    metar_geojson_url = url_for('viewmap.weather_layer', layer_name=METAR_LAYER) if weather.metars else None
+    taf_geojson_url = url_for('viewmap.weather_layer', layer_name=TAF_LAYER) if weather.tafs else None
+    
+    radius_default = UserSetting.get_setting(session['userid'], 'map_radius_filter').SettingValue
+    
+    # Display the map
+    return render_template('maps/showmap.html', mapbox_token=current_app.config['MAPBOX_TOKEN'], radius_default=radius_default, 
+                           map_bounds=helpers.get_max_map_bounds(), briefing=briefing, 
+                           notam_geojson_url=url_for('viewmap.notam_layer', briefing_id=latest_brief_id, flight_date=flight_date),
+                           notam_text_url=url_for('viewmap.notam_text', briefing_id=latest_brief_id),
+                           notam_styles=get_notam_style_table().to_dict(), used_groups=used_groups, used_layers=used_layers,
+                           sigair_geojson_url=sigair_geojson_url, metar_geojson_url=metar_geojson_url, taf_geojson_url=taf_geojson_url, 
+                           used_wx_groups=weather.used_groups, used_wx_layers=weather.used_layers,
+                           weather_stale_since=weather.oldest_stale_since, default_flight_date = flight_date)
+
+
+def _check_flight_date(flight_date):
+    """Aborts with a 400 (Bad Request) if a flight date (YYYY-MM-DD) is given, and is not a real date - each flight date 
+    builds (and caches) its own layers
+    
+    Parameters
+    ----------
+    flight_date : str or None
+        The flight date from the request
+    
+    Returns
+    -------
+    date or None
+        The flight date
+    """
+    
+    if not flight_date:
+        return None
+    
+    try:
+        return datetime.strptime(flight_date, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+
+def _get_user_flight(flight_id):
+    """Returns a Flight - aborting with a 404 if it does not exist, or a 403 if it is not the current user's flight 
+    (and the user is not an admin)
+    
+    Parameters
+    ----------
+    flight_id : int
+        ID of the flight
+    
+    Returns
+    -------
+    FlightPlan
+    """
+    
     sqa_sess = sqa_session()
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
-    briefing = sqa_sess.query(Briefing).get(latest_brief_id)
+    flight = sqa_sess.query(FlightPlan).get(flight_id)
+    
+    #Check the flight exists
+    if flight is None:
+        abort(404)
+        
+    # Check that the Flight belongs to the currently logged-in user, and user is not an admin
+    if flight.UserID != int(session['userid']) and session['user_admin'] == False:
+        abort(403)
+    
+    return flight
+
+
+def _check_current_briefing(briefing_id):
+    """Aborts with a 404 if briefing_id is not the latest briefing - the flight and home aerodrome Notams are filtered 
+    from the latest briefing, so layers for earlier briefings cannot be built
+    
+    Parameters
+    ----------
+    briefing_id : int
+        ID of the briefing from the request
+    """
+    
+    if briefing_id != get_current_briefing().BriefingID:
+        abort(404)
+
+
+def _flight_notam_layer(flight, briefing_id, flight_date, buffer_nm):
+    """Returns the shared layer of Notams along a flight's route (refer get_notam_subset_layer) """
+    
+    return get_notam_subset_layer(briefing_id, ('flight', flight.FlightplanID, int(buffer_nm)), 
+                                  lambda: briefing_cache.get_flight_route_notams(flight, briefing_id, flight_date, buffer_nm), flight_date)
+
+
+def _new_notam_layer(briefing_id, prev_briefing_id):
+    """Returns the shared layer of Notams that are new in a briefing since an earlier briefing (refer get_notam_subset_layer) """
+    
+    return get_notam_subset_layer(briefing_id, ('new', int(prev_briefing_id)), 
+                                  lambda: get_new_deleted_notams(briefing_id=prev_briefing_id, return_count_only=False)[1])
+
+
+def _home_notam_layer(briefing_id, flight_date, home_navpt, home_radius):
+    """Returns the shared layer of Notams within a radius of a home aerodrome (refer get_notam_subset_layer) """
+    
+    return get_notam_subset_layer(briefing_id, ('home', home_navpt.ICAO_Code, int(home_radius)), 
+                                  lambda: flightplans.filter_point_notams(home_navpt.Longitude, home_navpt.Latitude, home_radius, date_of_flight=flight_date), 
+                                  flight_date)
 
-    # Filter applicable NOtams for the Briefing - filtering by flight date if required
-    if flight_date:
-        notam_list = sqa_sess.query(Notam).filter(and_(Notam.BriefingID == latest_brief_id, Notam.From_Date <= flight_date, Notam.To_Date >= flight_date)).order_by(Notam.A_Location).all()
 
+def _home_aerodrome():
+    """Returns the current user's home aerodrome Nav Point, home radius, and initial radius filter for the map - aborting with 
+    a 404 if the home aerodrome is not a known Nav Point
+    """
+    
+    # Get user's home aerodrome and radius to use to filter notams, and the initial radius filter for the map - read in one query
+    settings = UserSetting.get_setting_values(session['userid'], ['home_aerodrome', 'home_radius', 'map_radius_filter'])
+
+    # Get the Nav Point for the home aerodrome
+    sqa_sess = sqa_session()
+    home_navpt = sqa_sess.query(NavPoint).filter(NavPoint.ICAO_Code == settings['home_aerodrome']).first()
+    if home_navpt is None:
+        abort(404)
+    
+    return home_navpt, settings['home_radius'], settings['map_radius_filter']
+
+
+def _map_layer_response(body, etag, public=False, max_age=0):
+    """Returns a map layer as JSON, with an ETag - or a 304 (Not Modified) with no body, if the browser already has this version
+    
+    Parameters
+    ----------
+    body : function
+        Called to create the JSON (str or bytes) - only if the browser does not already have it
+    etag : str
+        Identifies this version of the layer
+    public : bool
+        Can the layer be cached by shared caches (ie. it is the same for all users)?
+    max_age : int
+        Seconds the browser can use the layer without checking it again
+    
+    Returns
+    -------
+    Response
+    """
+    
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
     else:
-        notam_list = sqa_sess.query(Notam).filter(and_(Notam.BriefingID == latest_brief_id)).order_by(Notam.A_Location).all()
+        resp = Response(body(), mimetype='application/json')
     
-    # Create the GEOJSON Features, Groups and Layers needed for the map
-    notam_features, used_groups, used_layers = generate_notam_geojson(notam_list, hide_user_notams = True)
+    resp.set_etag(etag)
+    if public:
+        resp.cache_control.public = True
+    else:
+        resp.cache_control.private = True
     
-    # Retrieve the SIGMET/AIRMET list and create the GEOJSON collection
-    sigair_list = read_sigmet_airmet_ZA(current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA'])
-    sigair_geojson, used_wx_groups, used_wx_layers = generate_sigmet_geojson(sigair_list)
+    # With no max-age, the browser checks with the server each time - getting a 304 if nothing has changed
+    if max_age > 0:
+        resp.cache_control.max_age = max_age
+    else:
+        resp.cache_control.no_cache = True
     
-    # Retrieve the METAR list and create the GEOJSON collection
-    metar_list = read_metar_ZA(current_app.config['WEATHER_METAR_URL_ZA'])
-    metar_geojson = generate_metar_geojson(metar_list)
-    used_wx_groups.append('METAR')
-    used_wx_layers.append('METAR_symbol')
+    return resp
+
 
-    taf_list = read_taf_ZA(current_app.config['WEATHER_TAF_URL_ZA'])
-    taf_geojson = generate_taf_geojson(taf_list)
-    used_wx_groups.append('TAF')
-    used_wx_layers.append('TAF_symbol')
+@bp.route('/maplayer/notams/<int:briefing_id>', methods=('GET',))
+@requires_login
+def notam_layer(briefing_id):
+    """Returns the GEOJSON Features for the Notams in a briefing, for the current user (hidden Notams re-tagged)
+    
+    Parameters
+    ----------
+    briefing_id : int
+        ID of the briefing
+    
+    Query string: flight_date (YYYY-MM-DD, optional) - only include Notams applicable on this date
+                  zoom (int, optional) - the map's zoom; overview zooms get simplified geometry
+    """
+    
+    flight_date = request.args.get('flight_date') or None
+    _check_flight_date(flight_date)
+    
+    # Only a few tolerances are possible (one per overview zoom), so the cache holds few variants
+    simplify_tolerance = tolerance_for_zoom(request.args.get('zoom', type=int), current_app.config['MAP_OVERVIEW_ZOOM'])
+    
+    layer = get_briefing_notam_layer(briefing_id, flight_date, simplify_tolerance)
     
+    return _notam_layer_response(layer, briefing_id, f'notams-{briefing_id}-{flight_date or "all"}')
 
-    radius_default = UserSetting.get_setting(session['userid'], 'map_radius_filter').SettingValue
+
+def _notam_layer_response(layer, briefing_id, etag_prefix):
+    """Returns a shared Notam layer (BriefingNotamLayer) for the current user, with their hidden Notams re-tagged
     
-    # Display the map
-    return render_template('maps/showmap.html', mapbox_token=current_app.config['MAPBOX_TOKEN'], radius_default=radius_default, 
-                           map_bounds=helpers.get_max_map_bounds(), briefing=briefing, 
-                           notam_geojson=notam_features, used_groups=used_groups, used_layers=used_layers,
-                           sigair_geojson=sigair_geojson, metar_geojson=metar_geojson, taf_geojson=taf_geojson, 
-                           used_wx_groups=used_wx_groups, used_wx_layers=used_wx_layers,
-                           default_flight_date = flight_date)
+    Parameters
+    ----------
+    layer : BriefingNotamLayer
+        The layer
+    briefing_id : int
+        ID of the briefing the layer's Notams come from
+    etag_prefix : str
+        Identifies the layer in its ETag
+    
+    Returns
+    -------
+    Response
+    """
+    
+    hidden_notams = get_user_hidden_notams(briefing_id)
+    
+    # The layer only changes if the cached layer is rebuilt, or the user hides another Notam
+    hidden_key = ','.join(sorted(set(ntm.Notam_Number for ntm in hidden_notams)))
+    etag = f'{etag_prefix}-{zlib.crc32(repr((layer.key, hidden_key)).encode("utf-8")):08x}'
+    
+    return _map_layer_response(lambda: layer.overlay_hidden(hidden_notams)[0], etag)
+
+
+@bp.route('/maplayer/flight/<int:flight_id>', methods=('GET',))
+@requires_login
+def flight_layer(flight_id):
+    """Returns the GEOJSON Features for a flight's route
+    
+    Parameters
+    ----------
+    flight_id : int
+        ID of the flight
+    """
+    
+    flight = _get_user_flight(flight_id)
+    
+    # The route's colour is the user's setting, so the layer is tagged by its content
+    body = dumps_geojson(flightplans.generate_flight_geojson(flightplan_object=flight))
+    
+    return _map_layer_response(lambda: body, f'flight-{flight_id}-{content_hash(body)}')
+
+
+@bp.route('/maplayer/flight_notams/<int:flight_id>/<int:briefing_id>', methods=('GET',))
+@requires_login
+def flight_notam_layer(flight_id, briefing_id):
+    """Returns the GEOJSON Features for the Notams along a flight's route, for the current user (hidden Notams re-tagged)
+    
+    Parameters
+    ----------
+    flight_id : int
+        ID of the flight
+    briefing_id : int
+        ID of the briefing - the latest
+    
+    Query string: flight_date (YYYY-MM-DD, optional) - only include Notams applicable on this date
+    """
+    
+    flight_date = _check_flight_date(request.args.get('flight_date'))
+    flight = _get_user_flight(flight_id)
+    _check_current_briefing(briefing_id)
+    
+    buffer_nm = UserSetting.get_setting(session['userid'], 'route_buffer').SettingValue
+    layer = _flight_notam_layer(flight, briefing_id, flight_date, buffer_nm)
+    
+    return _notam_layer_response(layer, briefing_id, f'flight-notams-{flight_id}-{briefing_id}-{flight_date or "all"}')
+
+
+@bp.route('/maplayer/new_notams/<int:briefing_id>/<int:prev_briefing_id>', methods=('GET',))
+@requires_login
+def new_notam_layer(briefing_id, prev_briefing_id):
+    """Returns the GEOJSON Features for the Notams that are new in a briefing, for the current user (hidden Notams re-tagged)
+    
+    Parameters
+    ----------
+    briefing_id : int
+        ID of the briefing - the latest
+    prev_briefing_id : int
+        ID of the earlier briefing the Notams are new since
+    """
+    
+    _check_current_briefing(briefing_id)
+    
+    layer = _new_notam_layer(briefing_id, prev_briefing_id)
+    
+    return _notam_layer_response(layer, briefing_id, f'new-notams-{briefing_id}-{prev_briefing_id}')
+
+
+@bp.route('/maplayer/home_notams/<int:briefing_id>', methods=('GET',))
+@requires_login
+def home_notam_layer(briefing_id):
+    """Returns the GEOJSON Features for the Notams around the current user's home aerodrome (hidden Notams re-tagged)
+    
+    Parameters
+    ----------
+    briefing_id : int
+        ID of the briefing - the latest
+    
+    Query string: flight_date (YYYY-MM-DD, optional) - only include Notams applicable on this date
+    """
+    
+    flight_date = _check_flight_date(request.args.get('flight_date'))
+    _check_current_briefing(briefing_id)
+    
+    home_navpt, home_radius, _ = _home_aerodrome()
+    layer = _home_notam_layer(briefing_id, flight_date, home_navpt, home_radius)
+    
+    return _notam_layer_response(layer, briefing_id, f'home-notams-{briefing_id}-{flight_date or "all"}')
+
+
+@bp.route('/maplayer/notam_text/<int:briefing_id>', methods=('GET',))
+@requires_login
+def notam_text(briefing_id):
+    """Returns the text of Notams in a briefing, as JSON {Notam Number: text} - the briefing layer is sent without
+    the Notam text, and the map fetches it when Notams are clicked
+    
+    Parameters
+    ----------
+    briefing_id : int
+        ID of the briefing
+    
+    Query string: notam (repeated) - the Notam Numbers to return
+    """
+    
+    notam_numbers = request.args.getlist('notam')
+    if not notam_numbers:
+        abort(400)
+    
+    sqa_sess = sqa_session()
+    notams = sqa_sess.query(Notam.Notam_Number, Notam.Notam_Text).filter(and_(Notam.BriefingID == briefing_id, 
+                                                                              Notam.Notam_Number.in_(notam_numbers))).all()
+    
+    # A briefing's Notams do not change, so the text can be kept by the browser
+    resp = Response(dumps_geojson({ntm.Notam_Number: ntm.Notam_Text for ntm in notams}), mimetype='application/json')
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 86400
+    
+    return resp
+
+
+@bp.route('/maplayer/weather/<layer_name>', methods=('GET',))
+@requires_login
+def weather_layer(layer_name):
+    """Returns the GEOJSON Features for a weather layer, from the cached weather snapshot
+    
+    Parameters
+    ----------
+    layer_name : str
+        SIGMET_LAYER, METAR_LAYER or TAF_LAYER
+    """
+    
+    if layer_name not in (SIGMET_LAYER, METAR_LAYER, TAF_LAYER):
+        abort(404)
+    
+    weather = get_weather_snapshot()
+    
+    # The layer is the same for all users - tagged by its content, so it only changes when the reports do
+    etag = f'{layer_name}-{weather.layer_hashes[layer_name]}'
+    
+    return _map_layer_response(lambda: weather.layers[layer_name], etag, public=True, max_age=weather.max_age())
+
+
+def _flight_has_weather(flight_date):
+    """ Is there weather for a flight on this date?  Only for flights today or tomorrow (or with no date) """
+    return flight_date is None or flight_date <= (datetime.utcnow().date() + timedelta(days=1))
+
+
+@bp.route('/maplayer/flight_weather/<int:flight_id>/<layer_name>', methods=('GET',))
+@requires_login
+def flight_weather_layer(flight_id, layer_name):
+    """Returns the GEOJSON Features for a weather layer along a flight's route, filtered from the cached weather snapshot
+    
+    Parameters
+    ----------
+    flight_id : int
+        ID of the flight
+    layer_name : str
+        SIGMET_LAYER, METAR_LAYER or TAF_LAYER
+    
+    Query string: flight_date (YYYY-MM-DD, optional) - SIGMETs/AIRMETs not valid on this date are excluded
+    """
+    
+    if layer_name not in (SIGMET_LAYER, METAR_LAYER, TAF_LAYER):
+        abort(404)
+    
+    flight_date = _check_flight_date(request.args.get('flight_date'))
+    flight = _get_user_flight(flight_id)
+    
+    if not _flight_has_weather(flight_date):
+        abort(404)
+    
+    buffer_nm = UserSetting.get_setting(session['userid'], 'route_buffer').SettingValue
+    weather = briefing_cache.get_flight_weather_layers(flight, flight_date, buffer_nm)
+    
+    # Tagged by its content, so it only changes when the reports along the route do
+    etag = f'flight-{flight_id}-{layer_name}-{weather.layer_hashes[layer_name]}'
+    
+    return _map_layer_response(lambda: weather.layers[layer_name], etag, max_age=get_weather_snapshot().max_age())
 
 
 
@@ -221,33 +591,24 @@ def flightmap(flight_id):
         purpose_print_brief = True;
         #flight_date = request.form['flight-date']
         hidden_notams = request.form['hidden-notams']
-        flight_date = request.form['briefing-flight-date']
-        print(flight_date)
-
-        # Ensure Flight_Date is correctly set as a DATE 
-        if flight_date is not None:
-            if flight_date == "": 
-                flight_date = None
-            else:
-                flight_date = datetime.strptime(flight_date,'%Y-%m-%d').date()
-        
-    #Establish session to connect to DB 
-    sqa_sess = sqa_session()
+        departure_time = request.form.get('briefing-departure-time')
 
-    # Retrieve the Flight
-    flight = sqa_sess.query(FlightPlan).get(flight_id)
-    
-    #Check the flight exists
-    if flight is None:
-        abort(404)
+        # Ensure Flight_Date is correctly set as a DATE - the briefing's ETA forecasts are worked out from it, so only accept real dates
+        flight_date = _check_flight_date(request.form['briefing-flight-date'])
         
-    # Check that the Flight belongs to the currently logged-in user, and user is not an admin
-    if flight.UserID != int(session['userid']) and session['user_admin'] == False:
-        abort(403)
+        # Likewise the departure time (HH:MM), if one was given
+        if departure_time:
+            try:
+                departure_time = datetime.strptime(departure_time, '%H:%M').time()
+            except ValueError:
+                abort(400)
+        
+    # Retrieve the Flight - checking it belongs to the currently logged-in user
+    flight = _get_user_flight(flight_id)
 
     # Get latest briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
-    briefing = sqa_sess.query(Briefing).get(latest_brief_id)
+    briefing = get_current_briefing()
+    latest_brief_id = briefing.BriefingID
 
     # What buffer does this user want to use?
     buffer_nm = UserSetting.get_setting(session['userid'], 'route_buffer').SettingValue
@@ -269,36 +630,12 @@ def flightmap(flight_id):
         # For audit purposes the date the briefing was run
         generate_date = datetime.strftime(datetime.utcnow(), "%Y-%m-%d %H:%M")
         
-        # Get the departure point and destination point for the flight plan
-        depart = flight.FlightPlanPoints[0]
-        dest = flight.FlightPlanPoints[-1]
-        
-        # Get NOTAMS within 5nm of dep and dest.
-        # If the departure and destination are the same, only get for departure point
-        if depart.Latitude == dest.Latitude and depart.Longitude == dest.Longitude:
-            depart_notams = flightplans.filter_point_notams(depart.Longitude, depart.Latitude, 5, True, flight_date)
-            dest_notams = []
-        # Otherwise get for departure and destination
-        else:
-            depart_notams = flightplans.filter_point_notams(depart.Longitude, depart.Latitude, 5, True, flight_date)
-            dest_notams = flightplans.filter_point_notams(dest.Longitude, dest.Latitude, 5, True, flight_date)
-        
-        # Filter by flight date if one is given
-        if flight_date:
-            enroute_notams = flightplans.filter_route_notams(flight_id, buffer_nm, date_of_flight=flight_date)
-        else:
-            enroute_notams = flightplans.filter_route_notams(flight_id, buffer_nm)
-
-        # Remove Notams applicable to the departure point from the dest list
-        for ntm in depart_notams:
-            if ntm in dest_notams: dest_notams.remove(ntm)
-        
-            # Remove Notams applicable to the departure point from the en-route list
-            if ntm in enroute_notams: enroute_notams.remove(ntm)
-
-        # Remove Notams applicable to the dest point from the en-route list
-        for ntm in dest_notams:
-            if ntm in enroute_notams: enroute_notams.remove(ntm)
+        # Get the Departure, Destination and En-Route notams - the classification is cached per flight, briefing, date and buffer,
+        # so printing again (eg. after hiding other Notams) only works out which Notams are hidden
+        flight_notams = briefing_cache.get_flight_notams(flight, latest_brief_id, flight_date, buffer_nm)
+        depart_notams = flight_notams[briefing_cache.DEPART]
+        dest_notams = flight_notams[briefing_cache.DEST]
+        enroute_notams = flight_notams[briefing_cache.ENROUTE]
         
         # Create a list of relevant permanently hidden Notam Numbers
         relevant_perm_hidden_notams = [n.Notam_Number for n in depart_notams if n.Notam_Number in perm_hidden_notams]
@@ -313,36 +650,26 @@ def flightmap(flight_id):
 
         # Get the weather...
         # If flight date is today or tomorrow, retrieve WEATHER and filter it by date
-        if flight_date is None or flight_date <= (datetime.utcnow().date() + timedelta(days=1)):
-            sigairmet_list = flightplans.filter_route_sigairmets_ZA(flight_id, buffer_nm, current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA'], flight_date)
-            
-            metar_list, taf_list = flightplans.filter_route_metar_taf_ZA(flight_id, buffer_nm, current_app.config['WEATHER_METAR_URL_ZA'], current_app.config['WEATHER_TAF_URL_ZA'])
+        if _flight_has_weather(flight_date):
+            # The weather is classified once per weather refresh (refer briefing_cache)
+            flight_weather = briefing_cache.get_flight_weather(flight, flight_date, buffer_nm)
             
-            # Get METAR and TAF for departure and destination aerodromes 
-            if depart.Latitude == dest.Latitude and depart.Longitude == dest.Longitude:
-                depart_metar, depart_taf = flightplans.filter_point_metar_taf_ZA(depart.Longitude, depart.Latitude, 5, current_app.config['WEATHER_METAR_URL_ZA'], current_app.config['WEATHER_TAF_URL_ZA'])
-                dest_metar = []
-                dest_taf = []
-            # Otherwise get for departure and destination
-            else:
-                depart_metar, depart_taf = flightplans.filter_point_metar_taf_ZA(depart.Longitude, depart.Latitude, 5, current_app.config['WEATHER_METAR_URL_ZA'], current_app.config['WEATHER_TAF_URL_ZA'])
-                dest_metar, dest_taf = flightplans.filter_point_metar_taf_ZA(dest.Longitude, dest.Latitude, 5, current_app.config['WEATHER_METAR_URL_ZA'], current_app.config['WEATHER_TAF_URL_ZA'])
+            # The templates use the dictionary view of the weather
+            sigairmet_list = [met.to_dict() for met in flight_weather.sigairmets]
+            metar_list = [met.to_dict() for met in flight_weather.metars[briefing_cache.ENROUTE]]
+            depart_metar = [met.to_dict() for met in flight_weather.metars[briefing_cache.DEPART]]
+            dest_metar = [met.to_dict() for met in flight_weather.metars[briefing_cache.DEST]]
+            taf_list = [taf.to_dict() for taf in flight_weather.tafs[briefing_cache.ENROUTE]]
+            depart_taf = [taf.to_dict() for taf in flight_weather.tafs[briefing_cache.DEPART]]
+            dest_taf = [taf.to_dict() for taf in flight_weather.tafs[briefing_cache.DEST]]
             
-            # Now remove depart and dest metars from the list of metars
-            for dep_met in depart_metar:
-                if dep_met in metar_list: metar_list.remove(dep_met)
-                if dep_met in dest_metar: dest_metar.remove(dep_met)
-                if dep_met['has_no_data']: depart_metar.remove(dep_met)
-            for dest_met in dest_metar:
-                if dest_met in metar_list: metar_list.remove(dest_met)
-                if dest_met['has_no_data']: dest_metar.remove(dest_met)
-            
-            # Now remove depart and dest tafs from the list of tafs
-            for dep_taf in depart_taf:
-                if dep_taf in taf_list: taf_list.remove(dep_taf)
-                if dep_taf in dest_taf: dest_taf.remove(dep_taf)
-            for dest_tf in dest_taf:
-                if dest_tf in taf_list: taf_list.remove(dest_tf)
+            # Work out the forecast at the expected time over each aerodrome - from the departure time and the user's cruise speed
+            # If no departure time was given, use the current time (on the flight date)
+            if not departure_time:
+                departure_time = datetime.utcnow().time().replace(second=0, microsecond=0)
+            departure_time = datetime.combine(flight_date or datetime.utcnow().date(), departure_time)
+            cruise_speed = UserSetting.get_setting(session['userid'], 'cruise_speed').SettingValue
+            flightplans.forecast_tafs_at_eta(flight_id, [depart_taf, taf_list, dest_taf], departure_time, cruise_speed)
             
         else:
             sigairmet_list = []
@@ -364,47 +691,23 @@ def flightmap(flight_id):
 
     # We are generating the MAP briefing
     else:
-        # Filter by flight date if one is given
-        if flight_date:
-            notam_list = flightplans.filter_route_notams(flight_id, buffer_nm, date_of_flight=flight_date)
-            
-        else:
-            notam_list = flightplans.filter_route_notams(flight_id, buffer_nm)
+        # The map fetches the layers once the page has loaded - the Notams along the route are built once and cached, 
+        # so only this user's hidden Notams are re-tagged
+        notam_layer = _flight_notam_layer(flight, latest_brief_id, flight_date, buffer_nm)
+        used_groups, used_layers = notam_layer.layer_names(get_user_hidden_notams(latest_brief_id))
+        flight_date_arg = flight_date.strftime('%Y-%m-%d') if flight_date else None
             
-        #If flight date is today or tomorrow, retrieve WEATHER and filter it by date
+        #If flight date is today or tomorrow, the map fetches the WEATHER layers along the route that have reports
         used_wx_groups = []
         used_wx_layers = []
-        if flight_date is None or flight_date <= (datetime.utcnow().date() + timedelta(days=1)):
-            sigairmet_list = flightplans.filter_route_sigairmets_ZA(flight_id, buffer_nm, current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA'], flight_date)
-            sigairmet_geojson, used_wx_groups, used_wx_layers = generate_sigmet_geojson(sigairmet_list)
-            
-            metar_list, taf_list = flightplans.filter_route_metar_taf_ZA(flight_id, buffer_nm, current_app.config['WEATHER_METAR_URL_ZA'], current_app.config['WEATHER_TAF_URL_ZA'])
-            if len(metar_list) > 0:
-                metar_geojson = generate_metar_geojson(metar_list)
-                used_wx_groups.append('METAR')
-                used_wx_layers.append('METAR_symbol')
-            else:
-                metar_geojson = None
-            
-            if len(taf_list) > 0:
-                taf_geojson = generate_taf_geojson(taf_list)
-                used_wx_groups.append('TAF')
-                used_wx_layers.append('TAF_symbol')
-            else:
-                taf_geojson = None
-            
-        else:
-            sigairmet_geojson = None
-            metar_geojson = None
-            taf_geojson = None
-            
-
-
-        # Generate the GEOJSON features for the Notams
-        notam_features, used_groups, used_layers = generate_notam_geojson(notam_list, hide_user_notams = True)
-    
-        # Generate the GEOJSON for the flight plan
-        flight_geojson = flightplans.generate_flight_geojson(flight_id) 
+        wx_urls = {SIGMET_LAYER: None, METAR_LAYER: None, TAF_LAYER: None}
+        if _flight_has_weather(flight_date):
+            flight_weather = briefing_cache.get_flight_weather_layers(flight, flight_date, buffer_nm)
+            used_wx_groups = flight_weather.used_groups
+            used_wx_layers = flight_weather.used_layers
+            for layer_name, report_count in flight_weather.report_counts.items():
+                if report_count > 0:
+                    wx_urls[layer_name] = url_for('viewmap.flight_weather_layer', flight_id=flight_id, layer_name=layer_name, flight_date=flight_date_arg)
         
         # Get flight bounds and centre-point, so map can be centered on the flight
         flight_bounds = helpers.get_flight_bounds(flight)
@@ -414,11 +717,13 @@ def flightmap(flight_id):
 
         return render_template('maps/showmap.html', mapbox_token=current_app.config['MAPBOX_TOKEN'], radius_default=radius_default,
                                map_bounds=helpers.get_max_map_bounds(), briefing=briefing, 
-                               notam_geojson=notam_features, used_groups=used_groups, used_layers=used_layers,
+                               notam_geojson_url=url_for('viewmap.flight_notam_layer', flight_id=flight_id, briefing_id=latest_brief_id, flight_date=flight_date_arg),
+                               notam_text_url=url_for('viewmap.notam_text', briefing_id=latest_brief_id),
+                               notam_styles=get_notam_style_table().to_dict(), used_groups=used_groups, used_layers=used_layers,
                                flight=flight, default_flight_date = flight_date,
-                               flight_geojson=flight_geojson, 
-                               sigair_geojson=sigairmet_geojson, used_wx_groups=used_wx_groups, used_wx_layers=used_wx_layers,
-                               metar_geojson=metar_geojson, taf_geojson=taf_geojson, 
+                               flight_geojson_url=url_for('viewmap.flight_layer', flight_id=flight_id), 
+                               sigair_geojson_url=wx_urls[SIGMET_LAYER], metar_geojson_url=wx_urls[METAR_LAYER], taf_geojson_url=wx_urls[TAF_LAYER], 
+                               used_wx_groups=used_wx_groups, used_wx_layers=used_wx_layers,
                                flight_bounds=flight_bounds, flight_centre=flight_centre)
 
 
@@ -428,27 +733,20 @@ def weathermap():
     """Displays html page showing weather on a map
     """    
     
-    # Retrieve the SIGMET/AIRMET list and create the GEOJSON collection
-    sigair_list = read_sigmet_airmet_ZA(current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA'])
-    sigair_geojson, used_groups, used_layers = generate_sigmet_geojson(sigair_list)
+    # Get the current weather - the GEOJSON layers are already serialized in the snapshot
+    weather = get_weather_snapshot()
+    sigair_geojson = weather.layer_text(SIGMET_LAYER)
     
-    # Retrieve the METAR list and create the GEOJSON collection
-    metar_list = read_metar_ZA(current_app.config['WEATHER_METAR_URL_ZA'])
-    metar_geojson = generate_metar_geojson(metar_list)
-    used_groups.append('METAR')
-    used_layers.append('METAR_symbol')
-    
-    # Retrieve the TAF list and create the GEOJSON collection
-    taf_list = read_taf_ZA(current_app.config['WEATHER_TAF_URL_ZA'])
-    taf_geojson = generate_taf_geojson(taf_list)
-    used_groups.append('TAF')
-    used_layers.append('TAF_symbol')
+    # METAR and TAF symbols are fetched clustered for the map's zoom and extent (refer map_clusters)
+    metar_cluster_url = url_for('map_clusters.get_clusters', layer_name=METAR_LAYER) if weather.metars else None
+    taf_cluster_url = url_for('map_clusters.get_clusters', layer_name=TAF_LAYER) if weather.tafs else None
 
     # Display the map
     return render_template('maps/weathermap.html', mapbox_token=current_app.config['MAPBOX_TOKEN'],  
                            map_bounds=helpers.get_max_map_bounds(), 
-                           sigair_geojson=sigair_geojson, metar_geojson=metar_geojson, taf_geojson=taf_geojson,
-                           used_groups=used_groups, used_layers=used_layers)
+                           sigair_geojson=sigair_geojson, metar_cluster_url=metar_cluster_url, taf_cluster_url=taf_cluster_url,
+                           used_groups=weather.used_groups, used_layers=weather.used_layers,
+                           weather_stale_since=weather.oldest_stale_since)
 
 
 
@@ -459,27 +757,28 @@ def newnotams():
     """Displays html page showing New Notams on a Map
     """
     
-    sqa_sess = sqa_session()
-
     # Get the latest briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
-    briefing = sqa_sess.query(Briefing).get(latest_brief_id)
+    briefing = get_current_briefing()
 
     # Compare Latest briefing to one from 7 days ago
-    prev_briefing, new_notams, del_notams = get_new_deleted_notams(since_date=datetime.utcnow().date() - timedelta(days=7), return_count_only=False)
+    # Only the count is needed here - the map fetches the new Notams themselves
+    prev_briefing, new_count, del_count = get_new_deleted_notams(since_date=datetime.utcnow().date() - timedelta(days=7))
     
-    if len(new_notams) == 0:
+    if new_count == 0:
         flash("No new NOTAMS were released in the past week.")
         return redirect(url_for("home.index"))
     
-    # Create the GEOJSON Features
-    notam_features, used_groups, used_layers = generate_notam_geojson(new_notams, hide_user_notams = True)
+    # The map fetches the new Notams once the page has loaded - the layer is built once and cached
+    notam_layer = _new_notam_layer(briefing.BriefingID, prev_briefing.BriefingID)
+    used_groups, used_layers = notam_layer.layer_names(get_user_hidden_notams(briefing.BriefingID))
 
     radius_default = UserSetting.get_setting(session['userid'], 'map_radius_filter').SettingValue
 
     return render_template('maps/showmap.html', mapbox_token=current_app.config['MAPBOX_TOKEN'], radius_default=radius_default, 
                            map_bounds=helpers.get_max_map_bounds(), briefing=briefing, 
-                           notam_geojson=notam_features, used_groups=used_groups, used_layers=used_layers, prev_briefing=prev_briefing)
+                           notam_geojson_url=url_for('viewmap.new_notam_layer', briefing_id=briefing.BriefingID, prev_briefing_id=prev_briefing.BriefingID),
+                           notam_text_url=url_for('viewmap.notam_text', briefing_id=briefing.BriefingID),
+                           notam_styles=get_notam_style_table().to_dict(), used_groups=used_groups, used_layers=used_layers, prev_briefing=prev_briefing)
 
 
 @bp.route('/homenotams', methods=('GET', 'POST'))
@@ -492,44 +791,35 @@ def homenotams():
     # No Flight Date supplied yet
     flight_date = None
     
-    # User provides flight date
+    # User provides flight date - each flight date builds (and caches) a layer, so only accept real dates
     if request.method == "POST":
-        flight_date = request.form['flight-date']
+        flight_date = _check_flight_date(request.form['flight-date'])
     
-    sqa_sess = sqa_session()
     # Get the latest briefing
-    latest_brief_id = sqa_sess.query(func.max(Briefing.BriefingID)).first()[0]
-    briefing = sqa_sess.query(Briefing).get(latest_brief_id)
+    briefing = get_current_briefing()
 
     # Get user's home aerodrome and radius to use to filter notams
-    home_aerodrome = UserSetting.get_setting(session['userid'], "home_aerodrome").SettingValue
-    home_radius = UserSetting.get_setting(session['userid'], "home_radius").SettingValue
-
-    # Get the Nav Point for the home aerodrome
-    home_navpt = sqa_sess.query(NavPoint).filter(NavPoint.ICAO_Code == home_aerodrome).first()
+    home_navpt, home_radius, radius_default = _home_aerodrome()
+    home_aerodrome = home_navpt.ICAO_Code
     
     # Generate a circle for the radius around the home aerodrome
     radius = helpers.generate_circle_shapely(home_navpt.Latitude, home_navpt.Longitude, int(home_radius), format_is_dms=False)
     
-    # Filter applicable Notams within the radius- using the date of flight if supplied
-    if flight_date:
-        notam_list = flightplans.filter_point_notams(home_navpt.Longitude, home_navpt.Latitude, home_radius, date_of_flight=flight_date)
-    else:
-        notam_list = flightplans.filter_point_notams(home_navpt.Longitude, home_navpt.Latitude, home_radius)
-    
-    # Generate the GEOJSON for the notams
-    notam_features, used_groups, used_layers = generate_notam_geojson(notam_list, hide_user_notams = True)
+    # The map fetches the Notams within the radius (for the date of flight if supplied) once the page has loaded - 
+    # the layer is built once and cached
+    notam_layer = _home_notam_layer(briefing.BriefingID, flight_date, home_navpt, home_radius)
+    used_groups, used_layers = notam_layer.layer_names(get_user_hidden_notams(briefing.BriefingID))
+    flight_date_arg = flight_date.strftime('%Y-%m-%d') if flight_date else None
 
     # Get bounds and center point for the maps
     flight_bounds = helpers.get_shape_bounds(radius)
     flight_centre = [home_navpt.Longitude, home_navpt.Latitude]
 
-    radius_default = UserSetting.get_setting(session['userid'], 'map_radius_filter').SettingValue
-
     return render_template('maps/showmap.html', mapbox_token=current_app.config['MAPBOX_TOKEN'], radius_default=radius_default, 
                            map_bounds=helpers.get_max_map_bounds(), briefing=briefing, 
-                           notam_geojson=notam_features, used_groups=used_groups, used_layers=used_layers,
+                           notam_geojson_url=url_for('viewmap.home_notam_layer', briefing_id=briefing.BriefingID, flight_date=flight_date_arg),
+                           notam_text_url=url_for('viewmap.notam_text', briefing_id=briefing.BriefingID),
+                           notam_styles=get_notam_style_table().to_dict(), used_groups=used_groups, used_layers=used_layers,
                            default_flight_date = flight_date, home_aerodrome=home_aerodrome,
                            flight_bounds=flight_bounds, flight_centre=flight_centre)
 
-
@@ -4,15 +4,25 @@ This module contains functions to
 - Retrieve SIGMET and AIRMET data and generate GEOJSON features
 - Retrieve METAR data and generate GEOJSON features
 - Retrieve TAF data and generate GEOJSON features
+
+Upstream weather pages are fetched through a circuit breaker per host: when a host keeps failing, or is too slow,
+it is not called for a cool-off period.  While a reader cannot get new data, it returns the last data it read successfully,
+and get_stale_since reports since when the data has been stale
+
+Each page is scraped into records (SigmetReport, MetarObservation, TafForecast) by a _scrape_* function keyed on the page URL only - 
+so concurrent callers share one fetch, and one last good result, whichever view they ask for.  The read_*_ZA functions 
+return the records, or derive the dictionary view from them
  
 """
 
 from geojson import Polygon, Feature, Point
 import re
-from datetime import datetime, timedelta
+import threading
+import functools
+from datetime import datetime
+from urllib.parse import urlparse
 
 import requests
-from bs4 import BeautifulSoup
 
 from flask import (
     current_app
@@ -21,12 +31,153 @@ from flask import (
 from .data_handling import sqa_session
 from . import helpers
 from .db import NavPoint
+from .geojson_output import map_output_geometry, FeatureList
+from .weather_parsing import iter_weather_page, extract_pre_blocks, PRE_BLOCK, MetarObservation, SigmetReport, WeatherDateResolver, decode_metar, decode_taf
+
+
+# Circuit breakers for the upstream weather hosts, by host name
+_host_breakers = {}
+_host_breakers_lock = threading.Lock()
+
+
+def get_host_breaker(url):
+    """ Returns the circuit breaker for the host of a weather URL, creating it from the app's WEATHER_BREAKER_* settings if needed
+    
+    Parameters
+    ----------
+    url: string
+        URL of the upstream weather page
+    
+    Returns
+    -------
+        helpers.CircuitBreaker
+    """
+    
+    host = urlparse(url).netloc
+    with _host_breakers_lock:
+        breaker = _host_breakers.get(host)
+        if breaker is None:
+            breaker = _host_breakers[host] = helpers.CircuitBreaker(host, max_failures=current_app.config['WEATHER_BREAKER_FAILURES'], 
+                                                                    latency_threshold=current_app.config['WEATHER_BREAKER_LATENCY'],
+                                                                    reset_seconds=current_app.config['WEATHER_BREAKER_RESET'])
+    return breaker
+
+
+def fetch_weather_page(url, product):
+    """ Retrieves an upstream weather page through the host's circuit breaker, with a timeout
+    
+    Parameters
+    ----------
+    url: string
+        URL of the weather page
+    product: string
+        Name of the weather product, for log messages - eg. METAR
+    
+    Returns
+    -------
+        requests.Response
+            The page, if retrieved successfully
+        OR
+        None
+            If the page could not be retrieved, or the host's circuit breaker is open
+    """
+    
+    breaker = get_host_breaker(url)
+    
+    # If the host has been failing, don't wait on it - the caller will use the last good data
+    if not breaker.allow_request():
+        current_app.logger.warning(f"Not retrieving {product} - circuit breaker is open for {breaker.name}")
+        return None
+    
+    started = datetime.utcnow()
+    try:
+        r = requests.get(url, verify=False, timeout=current_app.config['WEATHER_REQUEST_TIMEOUT'])
+    except:
+        breaker.record_failure()
+        current_app.logger.error(f"Error retrieving {product} - failed at REQUESTS call")
+        return None
+    
+    # If error retrieving page, return None
+    if r.status_code != 200: 
+        breaker.record_failure()
+        current_app.logger.error(f"Error retrieving {product}: URL = {url}: {r.status_code} - {r.reason}")
+        return None
+    
+    # The page is used even if it was slow - but slow responses count towards opening the breaker
+    breaker.record_success((datetime.utcnow() - started).total_seconds())
+    
+    return r
+
+
+# Last good result of each weather scrape, by (scraper, URL): (result, time read, stale since)
+_last_good = {}
+
+
+def serve_stale_on_failure(reader):
+    """ Decorator for the weather scrapes: if the scrape returns None (the upstream page could not be read), return the 
+    last good result for the same URL instead, and note the time since which it has been stale
+    
+    Parameters
+    ----------
+    reader: function
+        The weather scrape to wrap - takes the page URL as its only argument
+    
+    Returns
+    -------
+        function
+    """
+    
+    @functools.wraps(reader)
+    def wrapper(url):
+        key = (reader.__name__, url)
+        
+        result = reader(url)
+        if result is not None:
+            _last_good[key] = (result, datetime.utcnow(), None)
+            return result
+        
+        last_good = _last_good.get(key)
+        if last_good is None:
+            return None
+        
+        # Mark the data as stale from the first failed read
+        if last_good[2] is None:
+            last_good = _last_good[key] = (last_good[0], last_good[1], datetime.utcnow())
+        current_app.logger.warning(f"Using {reader.__name__} data read at {last_good[1]:%Y-%m-%d %H:%M} - stale since {last_good[2]:%H:%M}")
+        
+        return last_good[0]
+    
+    return wrapper
+
+
+def get_stale_since(url):
+    """ Returns the time since which the data from a weather URL has been stale - i.e. readers are serving the last good data
+    
+    Parameters
+    ----------
+    url: string
+        URL of the upstream weather page
+    
+    Returns
+    -------
+        datetime
+            The first failed read since the last good read
+        OR
+        None
+            If the last read of the URL succeeded
+    """
+    
+    stale = [stale_since for (reader_name, reader_url), (result, read_time, stale_since) in list(_last_good.items()) 
+             if reader_url == url and stale_since is not None]
+    return min(stale) if stale else None
 
 
 def calc_metar_taf_date(day, hr, mn=0):
     """ Function that calculates the FULL date for a METAR/TAF, based on the day, hour and minute 
         As METARS can be expired, and TAFs can be in the future, we need to work out the Year and Month 
         
+        To resolve all the times on a page, create one WeatherDateResolver and use it for each time instead - 
+        this function works out a new day/month mapping for every call
     
     Parameters
     ----------
@@ -46,43 +197,11 @@ def calc_metar_taf_date(day, hr, mn=0):
             If no date or time could be calculated
     """
 
-    yr=0
-    mth=0
-    # Now get the month and year: METARS/TAFs can be from the day before (eg around midnight) or older; TAF's can be valid for a tomorrow...
-    # so we need to compare to today's date
-    
-    if day == datetime.utcnow().day:
-        # METAR/TAF is from today
-        yr = datetime.utcnow().year
-        mth = datetime.utcnow().month
-    
-    #METAR/TAF is not from today, so start from today +1 (TAF validity may be in the future) and go back in time up to 25 days
-    else:
-        for d in range(-1,26):
-            # Go back in time
-            full_date = datetime.utcnow() - timedelta(days=d)
-            # Check if the days match
-            if day == (full_date.day):
-                # They do, so we have the year and month for the METAR
-                yr = full_date.year
-                mth = full_date.month
-                break
-    
-    # If we couldn't find a date (unlikely) then set date to None
-    if yr == 0:
-        full_date = None
-    #Otherwise set the datetime
-    else:
-        if hr == 24: #Aviation weather uses hr 24, python only uses 0-23.  If hr is 24, make it ) on the next day
-            full_date = datetime(yr, mth, day, 0, mn, 0) + timedelta(days=1)
-        else:
-            full_date = datetime(yr, mth, day, hr, mn, 0)
-    
-    return full_date
-
-
-
-def read_sigmet_airmet_ZA(sigmet_url):
+    return WeatherDateResolver().resolve(day, hr, mn)
+
+
+
+def read_sigmet_airmet_ZA(sigmet_url, as_records=False):
     """ Function that webscrapes SIGMET and AIRMET data from specified URL, 
         returning a list of SIGMET/AIRMET dictionary items for further processing
         
@@ -91,10 +210,12 @@ def read_sigmet_airmet_ZA(sigmet_url):
     ----------
     sigmet_url: string
         URL from which to scrape the SIGMET/AIRMET data
+    as_records: boolean, optional
+        Return SigmetReport objects rather than dictionaries
     
     Returns
     -------
-        sigair_met_list : list of dictionary elements
+        sigair_met_list : list of dictionary elements, or SigmetReport objects if as_records is True (the records are shared with all callers - do not modify them in place)
         type: SIGMET / AIRMET
         valid_from: datetime
         valid_to: datetime
@@ -104,8 +225,30 @@ def read_sigmet_airmet_ZA(sigmet_url):
         
     """
 
+    # One scrape of the page, shared by all callers
+    sigair_met_list = _scrape_sigmet_airmet_ZA(sigmet_url)
+    if sigair_met_list is None:
+        return None
+
+    if as_records == True:
+        return sigair_met_list
+
+    # Return the dictionary view of the reports
+    return [met.to_dict() for met in sigair_met_list]
+
+
+@helpers.single_flight
+@serve_stale_on_failure
+def _scrape_sigmet_airmet_ZA(sigmet_url):
+    """ Scrapes the SIGMET/AIRMET page - refer read_sigmet_airmet_ZA.  Concurrent calls for the same URL share one fetch,
+    and the last good reports are returned if the page cannot be read
+    
+    Returns
+    -------
+        list of SigmetReport objects, or None if the page could not be read (and has never been read)
+    """
     
-    sigair_met_list = [] # The list of disctionaries that will be returned, containing SIGMAT/AIRMET data
+    sigair_met_list = [] # The list of reports that will be returned, containing SIGMAT/AIRMET data
     
     # Regular expressions to extract the co-ordinats and the Flight Level
     coord_re = re.compile(r'([NS]\d{4,4} [EW]\d{5,5})')
@@ -113,26 +256,21 @@ def read_sigmet_airmet_ZA(sigmet_url):
     fl_sfc_re = re.compile(r'SFC[/](FL.+)|(TOP FL[0-9/]+)=') 
     fl_re = re.compile(r'(FL.+)|(TOP FL[0-9/]+)=')
     
-    # Retrieve the webpage containing SIGMET/AIRMET data
-    try:
-        r = requests.get(sigmet_url, verify=False)
-    except:
-        current_app.logger.error(f"Error retrieving SIGMET - failed at REQUESTS call")
+    # Retrieve the webpage containing SIGMET/AIRMET data - through the host's circuit breaker
+    r = fetch_weather_page(sigmet_url, 'SIGMET')
+    if r is None:
         return None
     
-    # If error retrieving page, return None
-    if r.status_code != 200: 
-        current_app.logger.error(f"Error retrieving SIGMET: URL = {sigmet_url}: {r.status_code} - {r.reason}")
-        return None
-    
-    # Setup Beautiful Soup, and extract all teh "PRE" tags - these are where the AIRMET data is stored
-    soup = BeautifulSoup(r.text, 'html.parser')
-    mets = soup.find_all('pre')
+    # Extract all the "PRE" blocks - these are where the AIRMET data is stored
+    mets, no_data = extract_pre_blocks(r.content, r.encoding)
+
+    # Resolve all the validity times on the page against the same date
+    dates = WeatherDateResolver()
 
     # Loop through the individual SIGMETS/AIRMETS
     for met in mets:
-        # Convert to a string and replace newline with space
-        met_string = str(met.string).replace("\n", " ")
+        # Replace newline with space
+        met_string = met.replace("\n", " ")
 
         # Extract the co-ords using regex
         coords = coord_re.findall(met_string)
@@ -164,8 +302,8 @@ def read_sigmet_airmet_ZA(sigmet_url):
                 valid_from = valid_re.search(met_string).group('valid_from')
                 valid_to = valid_re.search(met_string).group('valid_to')
                 
-                valid_from = calc_metar_taf_date(int(valid_from[0:2]), int(valid_from[2:4]), int(valid_from[4:6]))
-                valid_to = calc_metar_taf_date(int(valid_to[0:2]), int(valid_to[2:4]), int(valid_to[4:6]))
+                valid_from = dates.resolve(int(valid_from[0:2]), int(valid_from[2:4]), int(valid_from[4:6]))
+                valid_to = dates.resolve(int(valid_to[0:2]), int(valid_to[2:4]), int(valid_to[4:6]))
                 
             except:
                 current_app.logger.error(f"Error parsing SIGMET/AIRMET validity: {met_string}")
@@ -194,16 +332,13 @@ def read_sigmet_airmet_ZA(sigmet_url):
             # Specify the type - SIGMET or AIRMET
             sa_type = 'SIGMET' if body.find("SIGMET")>=0 else 'AIRMET'
 
-            # Create the dictionary object for this Sig/Air MET
-            this_met = {'type':sa_type, 'valid_from': valid_from, 'valid_to': valid_to, 'body':body, 'coords': split_coords, 'flevels': flevels}
-
-            # Add to the list
-            sigair_met_list.append(this_met)
+            # Create the record for this Sig/Air MET, and add it to the list
+            sigair_met_list.append(SigmetReport(sa_type, valid_from, valid_to, body, split_coords, flevels))
 
     return sigair_met_list
 
             
-def generate_sigmet_geojson(sigair_met_list):
+def generate_sigmet_geojson(sigair_met_list, simplify_tolerance=None):
     """ Function that accepts SIGMET and AIRMET data, and creates a list of GEOJSON features grouped into SIGMET and AIRMET 
     Each Feature will form a layer on the map - this allows for easy filtering of layers.
     The function also returns a list of the Groups applicable (eg. there may be no AIRMETS so only SIGMETS will be returned)
@@ -215,18 +350,20 @@ def generate_sigmet_geojson(sigair_met_list):
         body: body of the Sigmet/Airmet
         coords: list of co-ord pairs - LONG, LAT in decimal degrees
         flevels: vertical limits
+    simplify_tolerance : float, optional
+        Simplify the polygons to this tolerance (degrees) - for overview zoom levels (refer geojson_output.tolerance_for_zoom)
         
     Returns
     -------
     tuple
-        sigair_met_features: list of GEOJSON Feature strings - each element in the list includes details for SIGMET or AIRMET
+        sigair_met_features: FeatureList of GEOJSON Features (serializes itself on the page) - each element in the list includes details for SIGMET or AIRMET
         used_groups: list of groups that were used - one of SIGMET or AIRMET
     """
 
     # Initialise Variables
     used_groups = []  #contains applicable groupings for use on the web page (i.e. it excludes groupings that do not appear) - used to filter layers on the map
     used_layers = []
-    sigair_met_features = []
+    sigair_met_features = FeatureList()
 
         # If there are no Sig/Airmets (incase None is passed)
     if sigair_met_list is None:
@@ -262,6 +399,9 @@ def generate_sigmet_geojson(sigair_met_list):
         
         geojson_geom=Polygon([met['coords']])
 
+        # Quantize (and simplify, for overview zooms) the polygon
+        geojson_geom = map_output_geometry(geojson_geom, simplify_tolerance)
+
         # Append this Feature to the collection, setting the various attributes as properties
         sigair_met_features.append(Feature(geometry=geojson_geom, properties={'fill':fill_col[met['type']], 'line':line_col[met['type']], 
                                                                  'group': met['type'],
@@ -285,7 +425,7 @@ def generate_sigmet_geojson(sigair_met_list):
 
 
 
-def read_metar_ZA(metar_url, date_as_ISO_text=False):
+def read_metar_ZA(metar_url, date_as_ISO_text=False, as_records=False):
     """ Function that webscrapes METAR data from specified URL, 
         returning a list of METAR dictionary items for further processing
         
@@ -296,16 +436,23 @@ def read_metar_ZA(metar_url, date_as_ISO_text=False):
         URL from which to scrape the METAR data
     date_as_ISO_text: boolean, optional
         Return the Metar Date/Time as an ISO text string (allows use in JSON)
+    as_records: boolean, optional
+        Return the decoded MetarObservation objects rather than dictionaries
     
     Returns
     -------
-        metar_list : list of dictionary elements
+        metar_list : list of dictionary elements (or MetarObservation objects if as_records is True)
+            All callers share one scrape and the same records - do not modify them in place
             aerodrome: ICAO code
             has_no_data: boolean
             is_speci: boolean
             is_correction: boolean
             time: date and time of the METAR
             wind: dictionary containing (direction, strength, gusting, is_variable).  Direction of -1 means variable
+            visibility: visibility in metres (9999 = 10km or more)
+            is_cavok: boolean
+            weather: list of weather groups - eg. ['-TSRA', 'BR']
+            clouds: list of cloud layers [cover, height in ft, type] - eg. [['BKN', 1500, 'CB']]
             temperature: temp in degrees centigrade
             dew_point: dewpoint temp in degrees centigrade (integer, so M01 is shown as -01)
             QNH: QNH in hPa
@@ -314,164 +461,81 @@ def read_metar_ZA(metar_url, date_as_ISO_text=False):
         
     """
 
+    # One scrape of the page, shared by all callers
+    metar_list = _scrape_metar_ZA(metar_url)
+    if metar_list is None:
+        return None
+
+    if as_records == True:
+        return metar_list
     
-    metar_list = [] # The list of dictionaries that will be returned, containing METAR data
+    # Return the dictionary view of the observations
+    return [obs.to_dict(date_as_ISO_text) for obs in metar_list]
+
+
+@helpers.single_flight
+@serve_stale_on_failure
+def _scrape_metar_ZA(metar_url):
+    """ Scrapes the METAR page - refer read_metar_ZA.  Concurrent calls for the same URL share one fetch,
+    and the last good observations are returned if the page cannot be read
     
-    # Regular expressions to extract the wind
-    re_wind_no_gust = re.compile(r'(?P<direction>[0-9]{3,3})(?P<spd>[0-9]{2,2})KT') # 10005KT
-    re_wind_gust = re.compile(r'(?P<direction>[0-9]{3,3})(?P<spd>[0-9]{2,2})G(?P<gust>[0-9]{2,2})KT') # 10005G15KT
-    re_wind_variable = re.compile(r'(?P<direction>VRB)(?P<spd>[0-9]{2,2})KT') # VRB05KT
-    re_no_data = re.compile(r'No Data For (?P<missing>[A-Z,a-z]{4,4})', re.IGNORECASE) # No data for FAGC
-    re_temp = re.compile(r' (?P<temp>[M]?[0-9]{2,2})+/(?P<dewpt>[M]?[0-9]{2,2}) ') #temp in format 20/12 or 20/M02 or M03/M10 etc. 
-    re_qnh = re.compile(r'Q(?P<qnh>[0-9]{3,4})')
+    Returns
+    -------
+        list of MetarObservation objects, or None if the page could not be read (and has never been read)
+    """
     
+    metar_list = [] # The list of observations that will be returned, containing METAR data
     
-    # Retrieve the webpage containing METAR data
-    try:
-        r = requests.get(metar_url, verify=False)
-    except:
-        current_app.logger.error(f"Error retrieving METAR - failed at REQUESTS call")
+    # Retrieve the webpage containing METAR data - through the host's circuit breaker
+    r = fetch_weather_page(metar_url, 'METAR')
+    if r is None:
         return None
-        
-    
-    # If error retrieving page, return None
-    if r.status_code != 200: 
-        current_app.logger.error(f"Error retrieving METAR: URL = {metar_url}: {r.status_code} - {r.reason}")
-        return None
-    
-    # Setup Beautiful Soup, and extract all the "PRE" tags - these are where the METAR data is stored
-    soup = BeautifulSoup(r.text, 'html.parser')
-    mets = soup.find_all('pre')
     
     #Connect to DB
     sess = sqa_session()
     
-    # Loop through the individual METAR
-    for met in mets:
-        
-        # Get just the text.  Sould be: similar to: 'View DecodedMETAR FAOR 100530Z 19015KT CAVOK 15/M03 Q1020 NOSIG='
-        met_string = str(met.text)
-        
-        is_speci = False # Is this a SPECI and not a METAR - default to False
-        is_correction = False #Is this METAR a correction of an earlier (i.e. 'METAR COR xxxxxxxxx')
+    # Resolve all the observation times on the page against the same date
+    dates = WeatherDateResolver()
+    
+    # Stations with no data - the page lists these as "No Data For FAGC"
+    aero_no_datas = []
+    
+    # Scan the page once, picking up the "PRE" blocks (where the METAR data is stored) and the stations with no data
+    for kind, met_string in iter_weather_page(r.content, r.encoding):
         
-        # Determine if this is a METAR, a SPECI, or a line to be ignored
-        s = met_string.find('METAR') # Is it a METAR?
+        # If this is a station with no data, note it and process it once all the METARs have been read
+        if kind != PRE_BLOCK:
+            aero_no_datas.append(met_string)
+            continue
         
-        # If text not found, this is not a METAR - is it a SPECI?
-        if s < 0:
-            s = met_string.find('SPECI') # Is it a SPECI
-
-            if s >= 0: # It is a speci
-                is_speci = True
-            
-            else: # It's not a SPECI either, so continue to the next element
-                continue
-
-        s += 5 # 5 is the length of the text METAR and SPECI - we want to remove this.
-        # Remove METAR/SPECI text - we should now have the raw METAR/SPECI only (eg. 'FAOR 100530Z 19015KT CAVOK 15/M03 Q1020 NOSIG=')
-        met_string = met_string[s:].strip()
+        # met_string is just the text.  Sould be: similar to: 'View DecodedMETAR FAOR 100530Z 19015KT CAVOK 15/M03 Q1020 NOSIG='
+        # Decode it - if it is not a METAR or SPECI, continue to the next element
+        try:
+            obs = decode_metar(met_string)
+        except:
+            current_app.logger.error(f"Error decoding METAR: {met_string}")
+            continue
         
-        # If this METAR is a Correction, then flag and remove the 'COR '  (eg: METAR COR FAHS 011200Z AUTO 30009KT 34/02 Q1017=
-        if met_string[:4] == 'COR ':
-            is_correction = True
-            met_string = met_string[4:]
+        if obs is None:
+            continue
         
-        # Extract aerodrome name
-        aerodrome = met_string[:4]
         # Get aerodrome NavPoint - contains coordinates
-        aero_point = sess.query(NavPoint).filter(NavPoint.ICAO_Code == aerodrome).first()
+        aero_point = sess.query(NavPoint).filter(NavPoint.ICAO_Code == obs.aerodrome).first()
         
         # If aerdrome not found, this is a non-aerodrome station - ignore it (May implement later)
         if not aero_point:
             continue
         
-        # Get the date and time
-        day = int(met_string[5:7])
-        hr = int(met_string[7:9])
-        mn = int(met_string[9:11])
-        
-        met_date = calc_metar_taf_date(day, hr, mn)
-        
-        #Get the winds
-        wind_variable = False # Wind defaults to not light and variable
-        wind_gust = 0 # Gust defaults to 0
-        no_wind = False #Is there no wind data avail (i.e. /////KT)
-        
-        
-        #Check whether there is now wind specified (i.e. /////KT)
-        if met_string.find('///KT') > 0:
-            no_wind = True
-            wind_dir = 0
-            wind_spd = 0
-        else:
-            
-            # Use regular expression to try to extract non-gusting wind (eg. 10010KT)
-            tmp = re_wind_no_gust.search(met_string)
-            if tmp:
-                try:
-                    wind_dir = tmp.group('direction')
-                    wind_spd = tmp.group('spd')
-                except:
-                    current_app.logger.error(f"Error passing METAR winds: {met_string}")
-    
-            # Use regular expression to try to extract gusting wind (eg. 10010G15KT)
-            elif re_wind_gust.search(met_string):
-                tmp = re_wind_gust.search(met_string)
-                try:
-                    wind_dir = tmp.group('direction')
-                    wind_spd = tmp.group('spd')
-                    wind_gust = tmp.group('gust')
-                except:
-                    current_app.logger.error(f"Error passing METAR wind GUSTING: {met_string}")
-                    
-            # Use regular expression to try to extract variable wind (eg. VRB02KT)
-            elif re_wind_variable.search(met_string):
-                tmp = re_wind_variable.search(met_string)
-                try:
-                    wind_dir = -1
-                    wind_spd = tmp.group('spd')
-                    wind_variable = True
-                except:
-                    current_app.logger.error(f"Error passing METAR wind VARIABLE: {met_string}")
-
-        # Use regular expression to try to extract Temp and Dewpoint (eg. 25/M02)
-        temperature = 0
-        dew_point = 0
-
-        tmp = re_temp.search(met_string)
-        if tmp:
-            try:
-                temperature = int(tmp.group('temp').replace('M','-'))
-                dew_point = int(tmp.group('dewpt').replace('M','-'))
-            except:
-                current_app.logger.error(f"Error passing METAR temperature: {met_string}")
-
-
-        # Use regular expression to try to extract QNH (eg. Q1025)
-        qnh = 1013
-        
-        tmp = re_qnh.search(met_string)
-        if tmp:
-            try:
-                qnh = tmp.group('qnh')
-            except:
-                current_app.logger.error(f"Error passing METAR QNH: {met_string}")
-        
-        if date_as_ISO_text == True:
-            met_date = datetime.isoformat(met_date)
+        # If there is no date and time, we cannot use this METAR
+        if obs.day is None:
+            current_app.logger.error(f"Error decoding METAR date and time: {met_string}")
+            continue
         
-        met_dict = {'aerodrome': aerodrome , 'coords': (aero_point.Longitude, aero_point.Latitude), 
-                    'has_no_data': False , 'is_speci': is_speci, 'is_correction': is_correction, 'time': met_date, 
-                    'wind': {'no_wind_data': no_wind, 'direction': wind_dir, 'speed': wind_spd, 'gusting': wind_gust, 'is_variable': wind_variable},  #(wind_dir, wind_spd, wind_gust, wind_variable) , 
-                    'temperature': temperature, 'dew_point': dew_point,
-                    'qnh': qnh,
-                     'body': met_string}
+        obs.coords = (aero_point.Longitude, aero_point.Latitude)
+        obs.time = dates.resolve(obs.day, obs.hour, obs.minute)
         
-        metar_list.append(met_dict)
+        metar_list.append(obs)
         
-    # Check for any stations with no data - search the whole page
-    aero_no_datas = re_no_data.findall(soup.text)
     # If there are stations with no data, iterate through them
     if aero_no_datas:
         for aerodrome in aero_no_datas:
@@ -482,11 +546,11 @@ def read_metar_ZA(metar_url, date_as_ISO_text=False):
             if not aero_point:
                 continue
         
-            # Add a disctionary item
-            met_dict = {'aerodrome': aerodrome , 'coords': (aero_point.Longitude, aero_point.Latitude) , 
-                        'has_no_data': True, 'body': f'No data for {aerodrome}'}
+            # Add an observation with no data
+            obs = MetarObservation(aerodrome=aerodrome, body=f'No data for {aerodrome}', has_no_data=True)
+            obs.coords = (aero_point.Longitude, aero_point.Latitude)
             
-            metar_list.append(met_dict)
+            metar_list.append(obs)
 
     return metar_list
 
@@ -502,7 +566,6 @@ def generate_metar_geojson(metar_list):
         has_no_data: boolean
         is_speci: boolean
         time: date and time of the METAR
-        metar_age: string: how old is the METAR
         wind: dictionary containing (direction, strength, gusting, is_variable).  Direction of -1 means variable
         body: full body of the METAR
         coords: co-ord pair for the aerodrome - LONG, LAT in decimal degrees
@@ -510,11 +573,11 @@ def generate_metar_geojson(metar_list):
     Returns
     -------
     list
-        metar_features: list of GEOJSON Feature strings - each element in the list includes details for METAR
+        metar_features: FeatureList of GEOJSON Features (serializes itself on the page) - each element in the list includes details for METAR
     """
 
     # Initialise Variables
-    metar_features = []
+    metar_features = FeatureList()
     
     # If there are no Metars (incase None is passed)
     if metar_list is None:
@@ -540,15 +603,7 @@ def generate_metar_geojson(metar_list):
         if met['has_no_data'] : continue
         
         geojson_geom=Point(met['coords'])
-        metar_age = datetime.utcnow() - met['time']
-        if metar_age.days > 0:
-            metar_age = f'{metar_age.days} day(s) old'
-        elif (metar_age.seconds/3600) > 2:
-            metar_age = f'{int(metar_age.seconds/3600)} hours old'
-        else:
-            metar_age = f'{int(metar_age.seconds/60)} minutes old'
         
-
         # Append this Feature to the collection, setting the various attributes as properties
         metar_features.append(Feature(geometry=geojson_geom, properties={'fill':fill_col, 'line':line_col, 
                                                                  'group': 'METAR',
@@ -558,14 +613,14 @@ def generate_metar_geojson(metar_list):
                                                                  'wind_speed_kts': met['wind']['speed'],
                                                                  'wind_gust_kts': met['wind']['gusting'],
                                                                  'date_time': datetime.strftime(met['time'], '%H:%M %d-%b'),
-                                                                 'metar_age' : metar_age,
+                                                                 'time_utc': met['time'].strftime('%Y-%m-%dT%H:%M:%SZ'), # Age is shown on the map, from this time
                                                                  'text': met['body']}))
 
     return metar_features
 
 
 
-def read_taf_ZA(taf_url):
+def read_taf_ZA(taf_url, date_as_ISO_text=False, as_records=False):
     """ Function that webscrapes TAF data from specified URL, 
         returning a list of TAF dictionary items for further processing
         
@@ -574,108 +629,96 @@ def read_taf_ZA(taf_url):
     ----------
     taf_url: string
         URL from which to scrape the TAF data
+    date_as_ISO_text: boolean, optional
+        Return the TAF Dates/Times as ISO text strings (allows use in JSON)
+    as_records: boolean, optional
+        Return the decoded TafForecast objects rather than dictionaries
     
     Returns
     -------
-        taf_list : list of dictionary elements
+        taf_list : list of dictionary elements (or TafForecast objects if as_records is True)
+            All callers share one scrape and the same records - do not modify them in place
             aerodrome: ICAO code
             is_amended_corrected: boolean
             time: date and time of the TAF
             valid_From: date TAF is valid from
             valid_to: date teh TAF is valid to
+            periods: list of the base forecast and change groups (FM/BECMG/TEMPO/PROB) - refer TafPeriod.to_dict
             body: full body of the TAF
             coords: co-ord pair for the aerodrome - LONG, LAT in decimal degrees
         
     """
 
+    # One scrape of the page, shared by all callers
+    taf_list = _scrape_taf_ZA(taf_url)
+    if taf_list is None:
+        return None
+
+    if as_records == True:
+        return taf_list
     
-    taf_list = [] # The list of disctionaries that will be returned, containing SIGMAT/AIRMET data
+    # Return the dictionary view of the forecasts
+    return [taf.to_dict(date_as_ISO_text) for taf in taf_list]
+
+
+@helpers.single_flight
+@serve_stale_on_failure
+def _scrape_taf_ZA(taf_url):
+    """ Scrapes the TAF page - refer read_taf_ZA.  Concurrent calls for the same URL share one fetch,
+    and the last good forecasts are returned if the page cannot be read
     
+    Returns
+    -------
+        list of TafForecast objects, or None if the page could not be read (and has never been read)
+    """
     
-    # Retrieve the webpage containing TAF data
-    try:
-        r = requests.get(taf_url, verify=False)
-    except:
-        current_app.logger.error(f"Error retrieving TAF - failed at REQUESTS call")
-        return None
-        
+    taf_list = [] # The list of forecasts that will be returned, containing TAF data
     
-    # If error retrieving page, return None
-    if r.status_code != 200: 
-        current_app.logger.error(f"Error retrieving TAF: URL = {taf_url}: {r.status_code} - {r.reason}")
-        print(f"Error retrieving TAF: URL = {taf_url}: {r.status_code} - {r.reason}")
+    
+    # Retrieve the webpage containing TAF data - through the host's circuit breaker
+    r = fetch_weather_page(taf_url, 'TAF')
+    if r is None:
         return None
     
-    # Setup Beautiful Soup, and extract all the "PRE" tags - these are where the TAF data is stored
-    soup = BeautifulSoup(r.text, 'html.parser')
-    tafs = soup.find_all('pre')
+    # Extract all the "PRE" blocks - these are where the TAF data is stored
+    tafs, no_data = extract_pre_blocks(r.content, r.encoding)
     
     #Connect to DB
     sess = sqa_session()
     
+    # Resolve all the issue and validity times on the page against the same date
+    dates = WeatherDateResolver()
+    
     # Loop through the individual TAF
     for this_taf in tafs:
         
-        # Get just the text.  Sould be: similar to: ''View DecodedTAF FAOR 171000Z 1712/1818 30012KT CAVOK\xa0\xa0\xa0TX31 ...'
-        taf_string = str(this_taf.text).replace(u'\xa0',' ') #replace \xa0 (a unicode non-breaking space) with a normal space.
-        
-        # Determine if this is an amended TAF, normal TAF, or a line to be ignored
-        s = taf_string.find('TAF AMD') + taf_string.find('TAF COR') + 1# Is it an amended/corrected TAF?
-        
-        # This is an amended TAF
-        if s >= 0:
-            s+=7 # the length of text "TAF AMD"
-            is_amended_corrected = True
+        # Decode the TAF into its change groups.  Sould be: similar to: ''View DecodedTAF FAOR 171000Z 1712/1818 30012KT CAVOK\xa0\xa0\xa0TX31 ...'
+        # If it is not a TAF, continue to the next element
+        try:
+            taf = decode_taf(this_taf)
+        except:
+            current_app.logger.error(f"Error decoding TAF: {this_taf}")
+            continue
         
-        # If text not found, is this a normal TAF?
-        else:
-            s = taf_string.find('TAF') # Is it a normal TAF?
-            # This is a normal TAF
-            if s >= 0:
-                s+=3 # the length of text "TAF"
-                is_amended_corrected = False
-
-            
-            # This is neither - ignore it
-            else:
-                continue
-
-        # Remove TAF text - we should now have the raw TAF only (eg. 'FAWK 170900Z 1710/1718 31010KT CAVOK TX31/1712Z TN23/1718Z=')
-        taf_string = taf_string[s:].strip()
+        if taf is None or taf.issue_ddhhmm is None:
+            continue
         
-        # Extract aerodrome name
-        aerodrome = taf_string[:4]
         # Get aerodrome NavPoint - contains coordinates
-        aero_point = sess.query(NavPoint).filter(NavPoint.ICAO_Code == aerodrome).first()
+        aero_point = sess.query(NavPoint).filter(NavPoint.ICAO_Code == taf.aerodrome).first()
         
         # If aerdrome not found, this is a non-aerodrome station - ignore it (May implement later)
         if not aero_point:
             continue
         
-        # Get the date and time the TAF was issued
-        day = int(taf_string[5:7])
-        hr = int(taf_string[7:9])
-        mn = int(taf_string[9:11])
-        
-        taf_date = calc_metar_taf_date(day,hr,mn)
-        
-        # Now get the validity of the TAF
-        from_day = int(taf_string[13:15])
-        from_hr = int(taf_string[15:17])
-        valid_from = calc_metar_taf_date(from_day, from_hr)
-
-        to_day = int(taf_string[18:20])
-        to_hr = int(taf_string[20:22])
-        valid_to = calc_metar_taf_date(to_day, to_hr)
-
-
+        taf.coords = (aero_point.Longitude, aero_point.Latitude)
         
-        taf_dict = {'aerodrome': aerodrome , 'coords': (aero_point.Longitude, aero_point.Latitude) , 
-                    'is_amended_corrected': is_amended_corrected, 'time': taf_date, 'valid_from': valid_from, 'valid_to':valid_to, 
-                    'body': taf_string}
-        
-        taf_list.append(taf_dict)
+        # Get the date and time the TAF was issued, and the start of the validity.  
+        # The remaining times in the TAF are worked out from the validity start
+        taf_date = dates.resolve(*taf.issue_ddhhmm)
+        valid_from = dates.resolve(*taf.valid_from_ddhh)
+        taf.resolve_times(valid_from, taf_date)
         
+        taf_list.append(taf)
 
     return taf_list
 
@@ -698,11 +741,11 @@ def generate_taf_geojson(taf_list):
     Returns
     -------
     list
-        taf_features: list of GEOJSON Feature strings - each element in the list includes details for TAF
+        taf_features: FeatureList of GEOJSON Features (serializes itself on the page) - each element in the list includes details for TAF
     """
 
     # Initialise Variables
-    taf_features = []
+    taf_features = FeatureList()
     
     # If there are no TAFs (incase None is passed)
     if taf_list is None:
@@ -726,18 +769,6 @@ def generate_taf_geojson(taf_list):
         
         # Create the Point geometry
         geojson_geom = Point(this_taf['coords'])
-        #Calculate the age of the TAF
-        if (datetime.utcnow() < this_taf['time']):
-            taf_age = ''
-        else:
-            taf_age = datetime.utcnow() - this_taf['time']
-            if taf_age.days > 0:
-                taf_age = f'{taf_age.days} day(s) old'
-            elif (taf_age.seconds/3600) > 2:
-                taf_age = f'{int(taf_age.seconds/3600)} hours old'
-            else:
-                taf_age = f'{int(taf_age.seconds/60)} minutes old'
-        
 
         # Append this Feature to the collection, setting the various attributes as properties
         taf_features.append(Feature(geometry=geojson_geom, properties={'fill':fill_col, 'line':line_col, 
@@ -747,7 +778,7 @@ def generate_taf_geojson(taf_list):
                                                                  'date_time': datetime.strftime(this_taf['time'], '%H:%M %d-%b'),
                                                                  'valid_from': datetime.strftime(this_taf['valid_from'], '%d-%b %H:%M'),
                                                                  'valid_to': datetime.strftime(this_taf['valid_to'], '%d-%b %H:%M'),
-                                                                 'taf_age' : taf_age,
+                                                                 'time_utc': this_taf['time'].strftime('%Y-%m-%dT%H:%M:%SZ'), # Age is shown on the map, from this time
                                                                  'text': this_taf['body']}))
 
     return taf_features
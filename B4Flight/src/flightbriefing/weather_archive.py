@@ -0,0 +1,417 @@
+"""Archives Weather Reports
+
+This module keeps an append-only history of the METARs and TAFs that are scraped,
+so that trends and post-flight reviews can be shown without re-scraping.
+
+Storage is one segment file per report type per day (eg. metar/2020-11-01.seg), with a small index file alongside it:
+- Each archive write appends one zlib-compressed block to the day's segment.  Within a block, station codes are interned
+  (stored once, and referred to by position) and observation times are delta-encoded (seconds from the previous record)
+- Each block has a line in the day's index (eg. metar/2020-11-01.idx) giving its offset in the segment,
+  and the first/last observation time for each station in the block - the time-range index used for queries
+- Queries only decompress the blocks in the requested days that contain the station and overlap the time window
+
+Records already in the archive are not written again - so overlapping feeds do not duplicate records.
+Each append holds an OS lock on the kind's lock file (eg. metar/append.lock), so several processes can append safely
+
+Fed from one process - the archive-weather command, expected to be scheduled - rather than from the web requests' scrapes,
+so compressing and writing blocks is kept out of the request path.  From the command line:
+ - archive-weather
+ - weather-history <metar|taf> <ICAO code> [hours]
+
+"""
+
+import os
+import json
+import zlib
+import threading
+import contextlib
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl - msvcrt locks the first byte of the lock file instead
+    fcntl = None
+    import msvcrt
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .weather_parsing import MetarObservation, decode_metar, decode_taf, resolve_taf_time
+
+
+# The types of weather report the archive holds
+METAR = 'metar'
+TAF = 'taf'
+ARCHIVE_KINDS = (METAR, TAF)
+
+_epoch = datetime(1970, 1, 1)
+
+
+def _to_seconds(dt):
+    """ Converts a naive UTC datetime to whole seconds since 1970 """
+    return int((dt - _epoch).total_seconds())
+
+
+def _from_seconds(secs):
+    """ Converts seconds since 1970 to a naive UTC datetime """
+    return _epoch + timedelta(seconds=secs)
+
+
+def _archive_text(record):
+    """ Returns the text stored in the archive for a METAR/TAF record - the report including its METAR/SPECI/TAF prefix,
+    so it can be decoded again when read back """
+
+    if isinstance(record, MetarObservation):
+        return ('SPECI ' if record.is_speci else 'METAR ') + ('COR ' if record.is_correction else '') + record.body
+
+    # Keep the TAF's own header - an amendment (AMD) or a correction (COR)
+    return ('TAF ' + record.amendment + ' ' if record.amendment else 'TAF ') + record.body
+
+
+@contextlib.contextmanager
+def _file_lock(lock_path):
+    """ Holds an exclusive OS lock on a lock file - waiting for any other process holding it """
+
+    with open(lock_path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class WeatherArchive():
+    """
+    An append-only archive of METARs and TAFs, stored as compressed daily segments in a folder
+
+    Methods
+    -------
+    append(kind, records)
+        Adds the records not yet in the archive, returning the number added
+    query(kind, aerodrome, start, end)
+        Returns the series of records for an aerodrome, between two times
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+        # Loaded day indexes: (kind, day) -> (index file size when read, list of index entries)
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+        for kind in ARCHIVE_KINDS:
+            os.makedirs(os.path.join(folder, kind), exist_ok=True)
+
+    def _day_path(self, kind, day, extension):
+        return os.path.join(self.folder, kind, f'{day.isoformat()}.{extension}')
+
+    def _read_index(self, kind, day):
+        """ Returns the index entries for a day - cached, and re-read only if the index file has grown """
+
+        idx_path = self._day_path(kind, day, 'idx')
+        try:
+            idx_size = os.path.getsize(idx_path)
+        except OSError:
+            return []
+
+        cached = self._indexes.get((kind, day))
+        if cached is not None and cached[0] == idx_size:
+            return cached[1]
+
+        entries = []
+        with open(idx_path, 'r') as f:
+            for line in f:
+                # Ignore a partly-written last line
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+
+        self._indexes[(kind, day)] = (idx_size, entries)
+        return entries
+
+    def _last_archived(self, kind, day):
+        """ Returns, for each station, the time and checksum of its latest record already archived for the day """
+
+        last = {}
+        for entry in self._read_index(kind, day):
+            for station, (first_time, last_time, last_crc) in entry['s'].items():
+                if station not in last or last_time >= last[station][0]:
+                    last[station] = (last_time, last_crc)
+        return last
+
+    def append(self, kind, records):
+        """ Adds records to the archive.  Records already archived (same station, with the same or an older time) are skipped,
+        unless the text differs from the latest archived record at that time - eg. a correction
+
+        Parameters
+        ----------
+        kind: str
+            METAR or TAF
+        records: list
+            MetarObservation or TafForecast objects - each must have its time set
+
+        Returns
+        -------
+        int
+            The number of records added
+        """
+
+        # Group the records by day, as (time in seconds, station, text)
+        days = {}
+        for rec in records:
+            if rec.time is None or getattr(rec, 'has_no_data', False):
+                continue
+            days.setdefault(rec.time.date(), []).append((_to_seconds(rec.time), rec.aerodrome, _archive_text(rec)))
+
+        added = 0
+
+        # The thread lock guards the cached indexes in this process; the file lock keeps other processes from appending
+        # between reading the day's index and writing the block - which would duplicate records and interleave the writes
+        with self._lock, _file_lock(os.path.join(self.folder, kind, 'append.lock')):
+            for day, day_records in days.items():
+
+                # Drop records already in the archive
+                last = self._last_archived(kind, day)
+                new_records = []
+                for secs, station, text in sorted(set(day_records)):
+                    crc = zlib.crc32(text.encode('utf-8'))
+                    prev = last.get(station)
+                    if prev is not None and (secs < prev[0] or (secs == prev[0] and crc == prev[1])):
+                        continue
+                    new_records.append((secs, station, text, crc))
+                    last[station] = (secs, crc)
+
+                if not new_records:
+                    continue
+
+                # Build the block - stations interned, times delta-encoded
+                stations = []
+                station_pos = {}
+                station_range = {}
+                rows = []
+                base = new_records[0][0]
+                prev_secs = base
+                for secs, station, text, crc in new_records:
+                    if station not in station_pos:
+                        station_pos[station] = len(stations)
+                        stations.append(station)
+                    rows.append([station_pos[station], secs - prev_secs, text])
+                    prev_secs = secs
+
+                    first_time = station_range[station][0] if station in station_range else secs
+                    station_range[station] = [first_time, secs, crc]
+
+                block = zlib.compress(json.dumps({'b': base, 's': stations, 'r': rows}, separators=(',', ':')).encode('utf-8'), 9)
+
+                # Append the block to the segment, then record it in the index
+                seg_path = self._day_path(kind, day, 'seg')
+                with open(seg_path, 'ab') as f:
+                    offset = f.tell()
+                    f.write(block)
+
+                with open(self._day_path(kind, day, 'idx'), 'a') as f:
+                    f.write(json.dumps({'o': offset, 'n': len(block), 't': [base, prev_secs], 's': station_range}, separators=(',', ':')) + '\n')
+
+                added += len(new_records)
+
+        return added
+
+    def query(self, kind, aerodrome, start, end):
+        """ Returns the archived records for an aerodrome between two times, oldest first
+
+        Parameters
+        ----------
+        kind: str
+            METAR or TAF
+        aerodrome: str
+            ICAO code of the aerodrome
+        start: datetime
+            Start of the window (UTC)
+        end: datetime
+            End of the window (UTC)
+
+        Returns
+        -------
+        list
+            MetarObservation or TafForecast objects (without co-ordinates)
+        """
+
+        start_secs = _to_seconds(start)
+        end_secs = _to_seconds(end)
+
+        series = []
+        day = start.date()
+        while day <= end.date():
+
+            # Use the index to find the blocks containing this station within the window
+            blocks = []
+            for entry in self._read_index(kind, day):
+                station_range = entry['s'].get(aerodrome)
+                if station_range is not None and station_range[0] <= end_secs and station_range[1] >= start_secs:
+                    blocks.append((entry['o'], entry['n']))
+
+            if blocks:
+                with open(self._day_path(kind, day, 'seg'), 'rb') as f:
+                    for offset, length in blocks:
+                        f.seek(offset)
+                        block = json.loads(zlib.decompress(f.read(length)).decode('utf-8'))
+
+                        secs = block['b']
+                        station_no = block['s'].index(aerodrome)
+                        for row_station, delta, text in block['r']:
+                            secs += delta
+                            if row_station == station_no and start_secs <= secs <= end_secs:
+                                series.append((secs, text))
+
+            day += timedelta(days=1)
+
+        series.sort(key=lambda s: s[0])
+
+        return [self._decode(kind, secs, text) for secs, text in series]
+
+    @staticmethod
+    def _decode(kind, secs, text):
+        """ Decodes an archived report, setting its times """
+
+        report_time = _from_seconds(secs)
+
+        if kind == METAR:
+            rec = decode_metar(text)
+            rec.time = report_time
+        else:
+            rec = decode_taf(text)
+            # The TAF validity starts on or after the day it was issued
+            day_start = report_time.replace(hour=0, minute=0)
+            rec.resolve_times(resolve_taf_time(day_start, *rec.valid_from_ddhh), report_time)
+
+        return rec
+
+
+_archives = {}
+
+
+def get_weather_archive():
+    """ Returns the WeatherArchive for the application's WEATHER_ARCHIVE_FOLDER - one instance per folder,
+    so the cached indexes are shared across requests
+
+    Returns
+    -------
+    WeatherArchive
+    """
+
+    folder = current_app.config['WEATHER_ARCHIVE_FOLDER']
+    archive = _archives.get(folder)
+    if archive is None:
+        archive = _archives.setdefault(folder, WeatherArchive(folder))
+    return archive
+
+
+def archive_weather(kind, records):
+    """ Adds scraped records to the weather archive.  Errors are logged, not raised - archiving must never stop a page showing
+
+    Parameters
+    ----------
+    kind: str
+        METAR or TAF
+    records: list
+        MetarObservation or TafForecast objects
+
+    Returns
+    -------
+    int
+        The number of records added, or None if archiving failed
+    """
+
+    try:
+        return get_weather_archive().append(kind, records)
+    except Exception as e:
+        current_app.logger.error(f"Error archiving {kind} records: {e}")
+        return None
+
+
+def get_weather_history(kind, aerodrome, start, end=None):
+    """ Returns the archived series of METARs or TAFs for an aerodrome
+
+    Parameters
+    ----------
+    kind: str
+        METAR or TAF
+    aerodrome: str
+        ICAO code of the aerodrome
+    start: datetime
+        Start of the window (UTC)
+    end: datetime, optional
+        End of the window (UTC) - defaults to now
+
+    Returns
+    -------
+    list
+        MetarObservation or TafForecast objects, oldest first
+    """
+
+    if end is None:
+        end = datetime.utcnow()
+
+    return get_weather_archive().query(kind, aerodrome.upper(), start, end)
+
+
+@click.command('archive-weather')
+@with_appcontext
+def archive_weather_command():
+    """Command Line to scrape the current METARs and TAFs and add them to the weather archive - expected to be scheduled
+    usage: flask archive-weather
+    """
+    from .weather import read_metar_ZA, read_taf_ZA
+
+    click.echo("--- Command Line ready to archive weather ---")
+
+    metars = read_metar_ZA(current_app.config['WEATHER_METAR_URL_ZA'], as_records=True)
+    tafs = read_taf_ZA(current_app.config['WEATHER_TAF_URL_ZA'], as_records=True)
+
+    if metars is None or tafs is None:
+        click.echo("***Weather archive failed - check log files***")
+        return -1
+
+    # Only the records not already archived are written
+    metars_added = archive_weather(METAR, metars)
+    tafs_added = archive_weather(TAF, tafs)
+
+    if metars_added is None or tafs_added is None:
+        click.echo("***Weather archive failed - check log files***")
+        return -1
+
+    click.echo(f'Scraped {len(metars)} METARs and {len(tafs)} TAFs - archived {metars_added} new METARs and {tafs_added} new TAFs')
+    click.echo("--- Command-Line Completed ---")
+
+
+@click.command('weather-history')
+@click.argument('kind', type=click.Choice(ARCHIVE_KINDS))
+@click.argument('aerodrome')
+@click.argument('hours', type=int, default=24)
+@with_appcontext
+def weather_history_command(kind, aerodrome, hours):
+    """Command Line to show the archived METARs or TAFs for an aerodrome over the last number of hours
+    usage: flask weather-history <metar|taf> <ICAO code> [hours]
+    """
+
+    for rec in get_weather_history(kind, aerodrome, datetime.utcnow() - timedelta(hours=hours)):
+        click.echo(f'{rec.time:%Y-%m-%d %H:%M}  {_archive_text(rec)}')
+
+
+def init_app(app):
+    """
+    Register the Command-Line commands with the flightbriefing app
+    """
+    app.cli.add_command(archive_weather_command)
+    app.cli.add_command(weather_history_command)
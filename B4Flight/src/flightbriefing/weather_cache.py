@@ -0,0 +1,255 @@
+"""Caches the Current Weather
+
+This module holds the latest scraped weather as a WeatherSnapshot, shared by all requests in the process:
+- The SIGMET/AIRMET, METAR and TAF lists
+- The GEOJSON layers for the map, serialized to bytes once when the snapshot is built
+- Each report serialized to JSON bytes, with its geometry, so the API can filter and return reports without re-serializing
+
+The snapshot is rebuilt in the background when it is older than WEATHER_CACHE_TTL seconds - requests keep using the old snapshot meanwhile.
+Map layers hold the report times rather than ages (the map works out the age), so a layer stays valid until the next refresh.
+Responses are tagged (ETag) by a hash of their content, rather than the snapshot version - the version is counted separately 
+in each process, and changes at each refresh even when no report has changed.
+
+"""
+
+import zlib
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+from shapely import geometry
+
+from .weather import (read_sigmet_airmet_ZA, read_metar_ZA, read_taf_ZA, get_stale_since,
+                      generate_sigmet_geojson, generate_metar_geojson, generate_taf_geojson)
+from .geojson_output import dumps_geojson
+
+
+# Names of the map layers held in a snapshot
+SIGMET_LAYER = 'sigmet'
+METAR_LAYER = 'metar'
+TAF_LAYER = 'taf'
+
+
+class WeatherSnapshot():
+    """
+    A Class to represent the weather scraped at one point in time, with its map layers already serialized
+
+    Attributes
+    ----------
+    version : int
+        Increases by one each time the weather is refreshed - can be used to key anything built from the weather
+    refreshed : datetime
+        When the weather was scraped (UTC)
+    sigairmet_records, metar_records, taf_records : list
+        The records returned by the weather readers - SigmetReport, MetarObservation and TafForecast objects 
+        (empty if the weather could not be read).  Shared - do not modify them in place
+    sigairmets, metars, tafs : list
+        The records as dictionaries
+    layers : dict
+        Layer name: GEOJSON Feature list, serialized to UTF-8 bytes
+    layer_hashes : dict
+        Layer name: hash of the serialized layer (hex text) - the same in every process for the same reports, for ETags
+    used_groups, used_layers : list
+        The weather groups and map layers in the snapshot, for the map filters
+    api_items : dict
+        Layer name: list of (ICAO code or None, Shapely geometry, report serialized to JSON bytes)
+    newest : dict
+        Layer name: time of the newest report in the layer (None if there are no reports)
+    stale_since : dict
+        Layer name: time since which the upstream source has been failing, and the last good reports are shown (None if current)
+
+    Methods
+    -------
+    layer_text(layer_name)
+        Returns a serialized layer as text, for including in a page
+    filter_reports(layer_name, icao_codes=None, bbox=None, point=None, radius_nm=None)
+        Returns the reports in a layer that meet the filters, as a JSON array in bytes
+    max_age()
+        Returns the seconds until the snapshot is next refreshed - how long clients can keep anything built from it
+    """
+
+    __slots__ = ('version', 'refreshed', 'sigairmet_records', 'metar_records', 'taf_records', 'sigairmets', 'metars', 'tafs', 'layers', 'layer_hashes', 'used_groups', 'used_layers', 'api_items', 'newest', 'stale_since')
+
+    def __init__(self, version, sigairmet_records, metar_records, taf_records, stale_since=None):
+        self.version = version
+        self.refreshed = datetime.utcnow()
+        self.stale_since = stale_since or {SIGMET_LAYER: None, METAR_LAYER: None, TAF_LAYER: None}
+        self.sigairmet_records = sigairmet_records or []
+        self.metar_records = metar_records or []
+        self.taf_records = taf_records or []
+
+        # The dictionary view of the records - as returned by the weather readers
+        self.sigairmets = [met.to_dict() for met in self.sigairmet_records]
+        self.metars = [met.to_dict() for met in self.metar_records]
+        self.tafs = [taf.to_dict() for taf in self.taf_records]
+
+        # Create the GEOJSON features once, and serialize them
+        sigair_features, used_groups, used_layers = generate_sigmet_geojson(self.sigairmets)
+        self.layers = {SIGMET_LAYER: dumps_geojson(sigair_features),
+                       METAR_LAYER: dumps_geojson(generate_metar_geojson(self.metars)),
+                       TAF_LAYER: dumps_geojson(generate_taf_geojson(self.tafs))}
+        self.layer_hashes = {layer_name: content_hash(layer) for layer_name, layer in self.layers.items()}
+
+        self.used_groups = used_groups + ['METAR', 'TAF']
+        self.used_layers = used_layers + ['METAR_symbol', 'TAF_symbol']
+
+        # Serialize each report once for the API, with the geometry used to filter it
+        self.api_items = {SIGMET_LAYER: [(None, _sigmet_geometry(met['coords']), dumps_geojson(met)) for met in self.sigairmets],
+                          METAR_LAYER: [(met['aerodrome'], geometry.Point(met['coords']), dumps_geojson(met)) for met in self.metars],
+                          TAF_LAYER: [(taf['aerodrome'], geometry.Point(taf['coords']), dumps_geojson(taf)) for taf in self.tafs]}
+        
+        # The newest report in each layer - METARs and TAFs by their issue time, SIGMETs/AIRMETs by their validity start
+        self.newest = {SIGMET_LAYER: max((met['valid_from'] for met in self.sigairmets if met['valid_from']), default=None),
+                       METAR_LAYER: max((met['time'] for met in self.metars if met.get('time')), default=None),
+                       TAF_LAYER: max((taf['time'] for taf in self.tafs if taf['time']), default=None)}
+
+    def __repr__(self):
+        return f'<WeatherSnapshot {self.version} {self.refreshed}>'
+
+    def layer_text(self, layer_name):
+        """ Returns the serialized GEOJSON Feature list for a layer as text - for including in a page """
+        return self.layers[layer_name].decode('utf-8')
+
+    def filter_reports(self, layer_name, icao_codes=None, bbox=None, point=None, radius_nm=None):
+        """ Returns the reports in a layer that meet all the filters given, as a JSON array.
+        Distances are approximate, using the principle of 1 minute of lat = 1 nm
+        
+        Parameters
+        ----------
+        layer_name: str
+            SIGMET_LAYER, METAR_LAYER or TAF_LAYER
+        icao_codes: list of str, optional
+            Only return reports for these aerodromes (SIGMETs/AIRMETs have no aerodrome, so are not returned)
+        bbox: tuple, optional
+            (min longitude, min latitude, max longitude, max latitude) - only return reports within or overlapping the box
+        point: tuple, optional
+            (longitude, latitude) - with radius_nm, only return reports within the radius of the point
+        radius_nm: float, optional
+            Radius around the point in nautical miles
+        
+        Returns
+        -------
+        bytes
+            JSON array of the reports
+        """
+        
+        items = self.api_items[layer_name]
+        
+        if icao_codes:
+            icao_codes = set(icao_codes)
+            items = [item for item in items if item[0] in icao_codes]
+        
+        if bbox:
+            bbox_geom = geometry.box(*bbox)
+            items = [item for item in items if bbox_geom.intersects(item[1])]
+        
+        if point and radius_nm:
+            radius_geom = geometry.Point(point).buffer(float(radius_nm) / 60.0)
+            items = [item for item in items if radius_geom.intersects(item[1])]
+        
+        return b'[' + b','.join(item[2] for item in items) + b']'
+
+    @property
+    def oldest_stale_since(self):
+        """ Returns the earliest time any layer's source started failing - None if all the weather is current """
+        stale = [since for since in self.stale_since.values() if since is not None]
+        return min(stale) if stale else None
+
+    def is_expired(self, ttl_seconds):
+        """ Returns True if the snapshot is older than ttl_seconds """
+        return datetime.utcnow() - self.refreshed >= timedelta(seconds=ttl_seconds)
+
+    def max_age(self):
+        """ Returns the seconds until the snapshot is next refreshed (WEATHER_CACHE_TTL) - 0 if it is due.
+        Used as the Cache-Control max-age of responses built from the snapshot """
+        return max(current_app.config['WEATHER_CACHE_TTL'] - int((datetime.utcnow() - self.refreshed).total_seconds()), 0)
+
+
+def content_hash(content):
+    """ Returns a hash of serialized content (bytes) as hex text - for ETags that only change when the content does """
+    return f'{zlib.crc32(content):08x}-{len(content):x}'
+
+
+def _sigmet_geometry(coords):
+    """ Returns the Shapely geometry for a SIGMET/AIRMET's co-ordinates - a polygon, unless there are too few points """
+    if len(coords) >= 4:
+        return geometry.Polygon(coords)
+    return geometry.MultiPoint(coords)
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_weather_snapshot(force_refresh=False):
+    """ Returns the current WeatherSnapshot, scraping the weather again if the snapshot is older than WEATHER_CACHE_TTL seconds
+
+    Parameters
+    ----------
+    force_refresh: boolean, optional
+        Scrape the weather again regardless of the snapshot's age
+
+    Returns
+    -------
+    WeatherSnapshot
+    """
+    global _snapshot
+
+    snapshot = _snapshot
+    if snapshot is not None and force_refresh == False and not snapshot.is_expired(current_app.config['WEATHER_CACHE_TTL']):
+        return snapshot
+
+    # Only one thread rebuilds the snapshot.  While it scrapes, requests keep using the existing snapshot rather than 
+    # waiting on the upstream hosts (which may be timing out until their circuit breakers open) - the refresh runs in 
+    # the background.  Only the first build (or a forced refresh) waits for the weather
+    if snapshot is not None and force_refresh == False:
+        if _snapshot_lock.acquire(blocking=False):
+            try:
+                threading.Thread(target=_refresh_in_background, args=(current_app._get_current_object(), snapshot), 
+                                 name='weather-refresh', daemon=True).start()
+            except RuntimeError:
+                _snapshot_lock.release()
+                raise
+        return snapshot
+    
+    _snapshot_lock.acquire()
+
+    try:
+        if _snapshot is not snapshot:
+            return _snapshot
+
+        _snapshot = _build_snapshot(snapshot)
+    finally:
+        _snapshot_lock.release()
+
+    return _snapshot
+
+
+def _refresh_in_background(app, previous):
+    """ Replaces the snapshot with a new one - run in its own thread, holding _snapshot_lock (released when done) """
+    global _snapshot
+
+    try:
+        with app.app_context():
+            try:
+                _snapshot = _build_snapshot(previous)
+            except Exception as e:
+                # Keep the existing snapshot - the next request after the TTL tries again
+                app.logger.error(f"Error refreshing the weather: {e}")
+    finally:
+        _snapshot_lock.release()
+
+
+def _build_snapshot(previous):
+    """ Scrapes the weather and returns a new WeatherSnapshot, numbered after the previous one """
+
+    sigairmets = read_sigmet_airmet_ZA(current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA'], as_records=True)
+    metars = read_metar_ZA(current_app.config['WEATHER_METAR_URL_ZA'], as_records=True)
+    tafs = read_taf_ZA(current_app.config['WEATHER_TAF_URL_ZA'], as_records=True)
+
+    # If a source is down, the readers return the last good reports - note since when they have been stale
+    stale_since = {SIGMET_LAYER: get_stale_since(current_app.config['WEATHER_SIGMET_AIRMET_URL_ZA']),
+                   METAR_LAYER: get_stale_since(current_app.config['WEATHER_METAR_URL_ZA']),
+                   TAF_LAYER: get_stale_since(current_app.config['WEATHER_TAF_URL_ZA'])}
+
+    return WeatherSnapshot(0 if previous is None else previous.version + 1, sigairmets, metars, tafs, stale_since)
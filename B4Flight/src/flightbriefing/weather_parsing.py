@@ -0,0 +1,1093 @@
+"""Parses raw Weather pages and reports
+
+This module contains functions to
+- Extract the PRE blocks and "No Data For" markers from a weather web page, without building a DOM
+- Decode a METAR/SPECI into a MetarObservation, walking the groups once
+- Decode a TAF into a TafForecast, split into its base period and FM/BECMG/TEMPO/PROB change groups
+- Hold a SIGMET/AIRMET as a SigmetReport
+- Resolve the day/hour/minute times in reports to full dates, for a whole page at once (WeatherDateResolver)
+- Index decoded TAFs by aerodrome and time (TafIndex), to look up the forecast conditions at a station at a given time
+
+Functions in this module are pure text processing - they do not access the database or the Flask app,
+so they can be used (and benchmarked) on recorded pages outside of the web application.
+
+"""
+
+import re
+import html
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+
+# Kinds of items yielded by iter_weather_page
+PRE_BLOCK = 'pre'
+NO_DATA = 'no_data'
+
+# Single regular expression that finds both PRE blocks and "No Data For xxxx" markers in one scan of the page
+# Eg. <pre><a href="...">View Decoded</a>METAR FAOR 100530Z 19015KT CAVOK 15/M03 Q1020 NOSIG=</pre>
+# Eg. No Data For FAGC
+_re_page_item = re.compile(rb'<pre\b[^>]*>(?P<pre>.*?)</pre\s*>|No Data For (?P<missing>[A-Za-z]{4})', re.IGNORECASE | re.DOTALL)
+
+# "No Data For" markers that appear inside a PRE block
+_re_no_data = re.compile(r'No Data For (?P<missing>[A-Za-z]{4})', re.IGNORECASE)
+
+# Any HTML tag inside a PRE block - eg. the <a> link to the decoded METAR
+_re_tag = re.compile(r'<[^>]*>')
+
+
+def iter_weather_page(page_content, encoding=None):
+    """ Generator that scans a weather web page once, yielding the text of each PRE block (where the METAR/TAF/SIGMET data is stored)
+    and each "No Data For xxxx" marker, in the order they appear on the page.
+    PRE text is returned the same way BeautifulSoup's .text would return it - tags removed and HTML entities converted
+    (so &nbsp; becomes the unicode non-breaking space \xa0)
+
+    Parameters
+    ----------
+    page_content: bytes or str
+        The raw web page - typically requests.Response.content
+    encoding: str, optional
+        Encoding of the page - typically requests.Response.encoding.  Defaults to UTF-8
+
+    Yields
+    -------
+        tuple (kind, value)
+            (PRE_BLOCK, text of the PRE block)
+            OR
+            (NO_DATA, ICAO code of the station that has no data)
+    """
+
+    # Work on the raw bytes - the expensive scan is then done without decoding the full page
+    if isinstance(page_content, str):
+        encoding = 'utf-8'
+        page_content = page_content.encode(encoding)
+
+    if encoding is None:
+        encoding = 'utf-8'
+
+    for item in _re_page_item.finditer(page_content):
+
+        raw_pre = item.group('pre')
+
+        # This is a "No Data For" marker outside a PRE block
+        if raw_pre is None:
+            yield NO_DATA, item.group('missing').decode(encoding, errors='replace')
+            continue
+
+        # This is a PRE block - decode it, remove any tags, and convert entities
+        pre_text = raw_pre.decode(encoding, errors='replace')
+        if '<' in pre_text:
+            pre_text = _re_tag.sub('', pre_text)
+        if '&' in pre_text:
+            pre_text = html.unescape(pre_text)
+
+        yield PRE_BLOCK, pre_text
+
+        # "No Data For" markers can also appear within the PRE block itself
+        if 'DATA' in pre_text.upper():
+            for missing in _re_no_data.findall(pre_text):
+                yield NO_DATA, missing
+
+
+def extract_pre_blocks(page_content, encoding=None):
+    """ Returns the text of all PRE blocks in a weather web page, plus the stations reported as having no data
+
+    Parameters
+    ----------
+    page_content: bytes or str
+        The raw web page - typically requests.Response.content
+    encoding: str, optional
+        Encoding of the page - typically requests.Response.encoding.  Defaults to UTF-8
+
+    Returns
+    -------
+        pre_blocks: list of str
+            text of each PRE block, in page order
+        no_data: list of str
+            ICAO codes of the stations with no data, in page order
+    """
+
+    pre_blocks = []
+    no_data = []
+
+    for kind, value in iter_weather_page(page_content, encoding):
+        if kind == PRE_BLOCK:
+            pre_blocks.append(value)
+        else:
+            no_data.append(value)
+
+    return pre_blocks, no_data
+
+
+class MetarObservation():
+    """
+    A Class to represent a single decoded METAR or SPECI observation
+    Uses __slots__ to keep the per-observation memory small - a scrape holds a few hundred of these
+    
+    Wind direction of -1 means variable; visibility is in metres (9999 = 10km or more);
+    cloud layers are tuples of (cover, height in ft, cloud type) - eg. ('BKN', 1500, 'CB')
+    Values that are not reported in the METAR are None
+    
+    Observations are equal (and hash the same) when they are for the same station and time, so they can be
+    de-duplicated with sets and dictionaries.  The time must be set before the observation is added to a set
+    
+    Methods
+    -------
+    to_dict(date_as_ISO_text=False)
+        Returns the observation as the dictionary used by templates and the API
+    """
+    
+    __slots__ = ('aerodrome', 'coords', 'time', 'day', 'hour', 'minute', 'has_no_data', 'is_speci', 'is_correction', 'is_auto',
+                 'no_wind_data', 'wind_direction', 'wind_speed', 'wind_gust', 'wind_variable', 'wind_variation', 'wind_unit',
+                 'visibility', 'is_cavok', 'weather', 'clouds', 'vertical_visibility', 'temperature', 'dew_point', 'qnh', 'body')
+    
+    def __init__(self, aerodrome=None, body=None, has_no_data=False):
+        self.aerodrome = aerodrome
+        self.coords = None
+        self.time = None
+        self.day = None
+        self.hour = None
+        self.minute = None
+        self.has_no_data = has_no_data
+        self.is_speci = False
+        self.is_correction = False
+        self.is_auto = False
+        self.no_wind_data = False
+        self.wind_direction = None
+        self.wind_speed = None
+        self.wind_gust = None
+        self.wind_variable = False
+        self.wind_variation = None
+        self.wind_unit = 'KT'
+        self.visibility = None
+        self.is_cavok = False
+        self.weather = []
+        self.clouds = []
+        self.vertical_visibility = None
+        self.temperature = None
+        self.dew_point = None
+        self.qnh = None
+        self.body = body
+
+    def __repr__(self):
+        return f'<MetarObservation {self.aerodrome} {self.time}>'
+    
+    @property
+    def key(self):
+        """ The station and observation time - identifies the observation """
+        return (self.aerodrome, self.time)
+    
+    def __eq__(self, other):
+        if not isinstance(other, MetarObservation):
+            return NotImplemented
+        return self.key == other.key
+    
+    def __hash__(self):
+        return hash(self.key)
+    
+    def to_dict(self, date_as_ISO_text=False):
+        """
+        Returns the observation as a dictionary, in the format read_metar_ZA has always returned
+        (with visibility, weather and clouds added).  Used by the templates and the API
+        
+        Parameters
+        ----------
+        date_as_ISO_text: boolean, optional
+            Return the Metar Date/Time as an ISO text string (allows use in JSON)
+        
+        Returns
+        -------
+        dict
+        """
+        
+        if self.has_no_data:
+            return {'aerodrome': self.aerodrome , 'coords': self.coords, 'has_no_data': True, 'body': self.body}
+        
+        met_date = self.time
+        if date_as_ISO_text == True and met_date is not None:
+            met_date = met_date.isoformat()
+        
+        # Wind is shown as it appears in the METAR - eg. direction '190', speed '15'.  Direction of -1 means variable
+        if self.no_wind_data or self.wind_speed is None:
+            wind_dir = 0
+            wind_spd = 0
+        else:
+            wind_dir = -1 if self.wind_variable else f'{self.wind_direction:03d}'
+            wind_spd = f'{self.wind_speed:02d}'
+        wind_gust = 0 if self.wind_gust is None else f'{self.wind_gust:02d}'
+        
+        return {'aerodrome': self.aerodrome , 'coords': self.coords, 
+                'has_no_data': False , 'is_speci': self.is_speci, 'is_correction': self.is_correction, 'time': met_date, 
+                'wind': {'no_wind_data': self.no_wind_data, 'direction': wind_dir, 'speed': wind_spd, 'gusting': wind_gust, 'is_variable': self.wind_variable},
+                'visibility': self.visibility, 'is_cavok': self.is_cavok,
+                'weather': list(self.weather), 'clouds': [list(c) for c in self.clouds],
+                'temperature': 0 if self.temperature is None else self.temperature, 
+                'dew_point': 0 if self.dew_point is None else self.dew_point,
+                'qnh': 1013 if self.qnh is None else str(self.qnh),
+                'body': self.body}
+
+
+# Regular expressions for the individual METAR groups - each is matched against a single token
+_re_met_time = re.compile(r'^(?P<day>\d{2})(?P<hr>\d{2})(?P<mn>\d{2})Z$')  # 100530Z
+_re_met_wind = re.compile(r'^(?P<direction>\d{3}|VRB)(?P<spd>\d{2,3})(?:G(?P<gust>\d{2,3}))?(?P<unit>KT|MPS)$')  # 10005KT 10005G15KT VRB05KT
+_re_met_wind_variation = re.compile(r'^(?P<from>\d{3})V(?P<to>\d{3})$')  # 180V240
+_re_met_visibility = re.compile(r'^(?P<vis>\d{4})(?:NDV|[NSEW]{1,2})?$')  # 9999 0800 1500SW
+_re_met_rvr = re.compile(r'^R\d{2}[LRC]?/')  # R03L/1200N
+_re_met_weather = re.compile(r'^(?:[+-]|VC)?(?:MI|PR|BC|DR|BL|SH|TS|FZ)?(?:DZ|RA|SN|SG|IC|PL|GR|GS|UP|BR|FG|FU|VA|DU|SA|HZ|PY|PO|SQ|FC|SS|DS)*$')  # -RA +TSRA VCSH BR
+_re_met_cloud = re.compile(r'^(?P<cover>FEW|SCT|BKN|OVC)(?P<height>\d{3}|///)(?P<type>CB|TCU|///)?$')  # BKN015CB
+_re_met_vertical_vis = re.compile(r'^VV(?P<height>\d{3}|///)$')  # VV002
+_re_met_temp = re.compile(r'^(?P<temp>M?\d{2})/(?P<dewpt>M?\d{2})?$')  # 20/12 20/M02 M03/M10
+_re_met_qnh = re.compile(r'^(?P<unit>[QA])(?P<qnh>\d{4})$')  # Q1025 A2992
+
+# Groups after which the rest of the METAR is a trend or remarks - these are not decoded
+_metar_trend_groups = ('NOSIG', 'BECMG', 'TEMPO', 'RMK')
+
+
+def decode_metar(met_string):
+    """ Decodes the text of a METAR or SPECI, walking the groups in one pass, and returns a MetarObservation.
+    The text may include a prefix before the METAR/SPECI keyword - eg. 'View DecodedMETAR FAOR 100530Z 19015KT CAVOK 15/M03 Q1020 NOSIG='
+    The day/hour/minute of the observation are decoded - the full date (month and year) is left to the caller
+    
+    Parameters
+    ----------
+    met_string: str
+        Text containing the METAR or SPECI
+    
+    Returns
+    -------
+        MetarObservation
+            The decoded observation
+        OR
+        None
+            If the text is not a METAR or SPECI
+    """
+    
+    is_speci = False # Is this a SPECI and not a METAR - default to False
+    
+    # Determine if this is a METAR, a SPECI, or a line to be ignored
+    s = met_string.find('METAR') # Is it a METAR?
+    
+    # If text not found, this is not a METAR - is it a SPECI?
+    if s < 0:
+        s = met_string.find('SPECI') # Is it a SPECI
+        if s < 0: 
+            return None
+        is_speci = True
+    
+    # Remove METAR/SPECI text - we should now have the raw METAR/SPECI only (eg. 'FAOR 100530Z 19015KT CAVOK 15/M03 Q1020 NOSIG=')
+    met_string = met_string[s+5:].strip()
+    
+    # If this METAR is a Correction, then flag and remove the 'COR '  (eg: METAR COR FAHS 011200Z AUTO 30009KT 34/02 Q1017=
+    is_correction = False
+    if met_string[:4] == 'COR ':
+        is_correction = True
+        met_string = met_string[4:]
+    
+    tokens = met_string.replace('=', ' ').split()
+    if len(tokens) == 0:
+        return None
+    
+    obs = MetarObservation(aerodrome=met_string[:4], body=met_string)
+    obs.is_speci = is_speci
+    obs.is_correction = is_correction
+    
+    # Walk the groups once.  Groups appear in a fixed order, so each group is only tested against the patterns still possible 
+    for token in tokens[1:]:
+        
+        if token in _metar_trend_groups:
+            break
+        
+        if obs.day is None:
+            tmp = _re_met_time.match(token)
+            if tmp:
+                obs.day = int(tmp.group('day'))
+                obs.hour = int(tmp.group('hr'))
+                obs.minute = int(tmp.group('mn'))
+                continue
+        
+        if token == 'AUTO':
+            obs.is_auto = True
+            continue
+        
+        if obs.wind_speed is None and not obs.no_wind_data:
+            # Check whether there is no wind specified (i.e. /////KT)
+            if token.endswith('///KT'):
+                obs.no_wind_data = True
+                continue
+            tmp = _re_met_wind.match(token)
+            if tmp:
+                if tmp.group('direction') == 'VRB':
+                    obs.wind_direction = -1
+                    obs.wind_variable = True
+                else:
+                    obs.wind_direction = int(tmp.group('direction'))
+                obs.wind_speed = int(tmp.group('spd'))
+                if tmp.group('gust'):
+                    obs.wind_gust = int(tmp.group('gust'))
+                obs.wind_unit = tmp.group('unit')
+                continue
+        
+        if token == 'CAVOK':
+            obs.is_cavok = True
+            obs.visibility = 9999
+            continue
+        
+        # Temperature/dewpoint and QNH come after cloud - check them before the weather group, which can match an empty string 
+        tmp = _re_met_temp.match(token)
+        if tmp:
+            obs.temperature = int(tmp.group('temp').replace('M','-'))
+            if tmp.group('dewpt'):
+                obs.dew_point = int(tmp.group('dewpt').replace('M','-'))
+            continue
+        
+        tmp = _re_met_qnh.match(token)
+        if tmp:
+            # Convert inches of mercury (A2992) to hPa
+            if tmp.group('unit') == 'A':
+                obs.qnh = int(round(int(tmp.group('qnh')) * 0.338639))
+            else:
+                obs.qnh = int(tmp.group('qnh'))
+            continue
+        
+        if obs.wind_variation is None:
+            tmp = _re_met_wind_variation.match(token)
+            if tmp:
+                obs.wind_variation = (int(tmp.group('from')), int(tmp.group('to')))
+                continue
+        
+        # Only the first (prevailing) visibility is kept - a second one is the minimum visibility in a direction
+        tmp = _re_met_visibility.match(token)
+        if tmp:
+            if obs.visibility is None:
+                obs.visibility = int(tmp.group('vis'))
+            continue
+        
+        if _re_met_rvr.match(token):
+            continue
+        
+        tmp = _re_met_cloud.match(token)
+        if tmp:
+            height = tmp.group('height')
+            obs.clouds.append((tmp.group('cover'), None if height == '///' else int(height) * 100, tmp.group('type')))
+            continue
+        
+        if token in ('NSC', 'NCD', 'SKC', 'CLR', 'NSW'):
+            continue
+        
+        tmp = _re_met_vertical_vis.match(token)
+        if tmp:
+            height = tmp.group('height')
+            obs.vertical_visibility = None if height == '///' else int(height) * 100
+            continue
+        
+        if _re_met_weather.match(token) and token.strip('+-'):
+            obs.weather.append(token)
+            continue
+        
+    return obs
+
+
+class TafPeriod():
+    """
+    A Class to represent one period of a decoded TAF - the base forecast, or a FM/BECMG/TEMPO/PROB change group
+    Uses __slots__ to keep the per-period memory small
+    
+    change is one of BASE, FM, BECMG, TEMPO or PROB (PROB30 TEMPO is a TEMPO with a probability of 30)
+    Period times are held as (day, hour, minute) as they appear in the TAF until the TAF's dates are resolved;
+    start and end are then datetimes.  Elements that are not forecast in the group are None
+    
+    Methods
+    -------
+    to_dict()
+        Returns the period as a dictionary - used by the TafIndex and templates
+    """
+    
+    __slots__ = ('change', 'probability', 'start_ddhhmm', 'end_ddhhmm', 'start', 'end',
+                 'wind_direction', 'wind_speed', 'wind_gust', 'wind_variable', 'visibility', 'is_cavok', 'no_sig_weather', 
+                 'weather', 'clouds', 'vertical_visibility', 'body')
+    
+    def __init__(self, change='BASE', probability=None):
+        self.change = change
+        self.probability = probability
+        self.start_ddhhmm = None
+        self.end_ddhhmm = None
+        self.start = None
+        self.end = None
+        self.wind_direction = None
+        self.wind_speed = None
+        self.wind_gust = None
+        self.wind_variable = False
+        self.visibility = None
+        self.is_cavok = False
+        self.no_sig_weather = False
+        self.weather = None
+        self.clouds = None
+        self.vertical_visibility = None
+        self.body = ''
+
+    def __repr__(self):
+        return f'<TafPeriod {self.change} {self.start} - {self.end}>'
+    
+    def to_dict(self):
+        """
+        Returns the period as a dictionary.  Wind is None if not forecast in this period,
+        and weather/clouds are None if not forecast (an empty list means NSW / NSC)
+        
+        Returns
+        -------
+        dict
+        """
+        
+        if self.wind_speed is None:
+            wind = None
+        else:
+            wind = {'direction': self.wind_direction, 'speed': self.wind_speed, 'gusting': self.wind_gust, 'is_variable': self.wind_variable}
+        
+        period_dict = {'change': self.change, 'probability': self.probability, 'start': self.start, 'end': self.end,
+                       'wind': wind, 'visibility': self.visibility, 'is_cavok': self.is_cavok,
+                       'weather': None if self.weather is None else list(self.weather), 
+                       'clouds': None if self.clouds is None else [list(c) for c in self.clouds],
+                       'vertical_visibility': self.vertical_visibility, 'body': self.body}
+        period_dict['summary'] = taf_conditions_text(period_dict)
+        
+        return period_dict
+
+
+class TafForecast():
+    """
+    A Class to represent a decoded TAF, made up of the base forecast and its change groups
+    Uses __slots__ to keep the per-forecast memory small
+    
+    Forecasts are equal (and hash the same) when they are for the same station and issue time, so they can be
+    de-duplicated with sets and dictionaries.  The times must be resolved before the forecast is added to a set
+    
+    Methods
+    -------
+    resolve_times(valid_from, issue_time=None)
+        Sets the datetimes of the TAF and its periods, once the validity start is known
+    to_dict(date_as_ISO_text=False)
+        Returns the forecast as the dictionary used by templates
+    """
+    
+    __slots__ = ('aerodrome', 'coords', 'time', 'valid_from', 'valid_to', 'issue_ddhhmm', 'valid_from_ddhh', 'valid_to_ddhh',
+                 'is_amended_corrected', 'amendment', 'is_cancelled', 'periods', 'body')
+    
+    def __init__(self, aerodrome=None, body=None):
+        self.aerodrome = aerodrome
+        self.coords = None
+        self.time = None
+        self.valid_from = None
+        self.valid_to = None
+        self.issue_ddhhmm = None
+        self.valid_from_ddhh = None
+        self.valid_to_ddhh = None
+        self.is_amended_corrected = False
+        self.amendment = None  # 'AMD' or 'COR' for an amended or corrected TAF - as it appears in the TAF header
+        self.is_cancelled = False
+        self.periods = []
+        self.body = body
+
+    def __repr__(self):
+        return f'<TafForecast {self.aerodrome} {self.valid_from} - {self.valid_to}>'
+    
+    @property
+    def key(self):
+        """ The station and issue time - identifies the forecast """
+        return (self.aerodrome, self.time)
+    
+    def __eq__(self, other):
+        if not isinstance(other, TafForecast):
+            return NotImplemented
+        return self.key == other.key
+    
+    def __hash__(self):
+        return hash(self.key)
+    
+    def resolve_times(self, valid_from, issue_time=None):
+        """
+        Sets the validity end, and the start and end of each period, as datetimes.
+        TAF groups only give day-of-month and hour, so each is placed in the few days following the validity start 
+        (which handles the end of a month without looking at the current date again)
+        
+        Parameters
+        ----------
+        valid_from: datetime
+            The date and time the TAF is valid from
+        issue_time: datetime, optional
+            The date and time the TAF was issued
+        """
+        
+        self.valid_from = valid_from
+        self.time = issue_time
+        self.valid_to = resolve_taf_time(valid_from, *self.valid_to_ddhh)
+        
+        for period_no, period in enumerate(self.periods):
+            if period.change == 'BASE':
+                period.start = valid_from
+            else:
+                period.start = resolve_taf_time(valid_from, *period.start_ddhhmm)
+            
+            # FM and BASE periods run until the next FM group, or to the end of the TAF
+            if period.end_ddhhmm is None:
+                period.end = self.valid_to
+                for next_period in self.periods[period_no+1:]:
+                    if next_period.change == 'FM':
+                        period.end = resolve_taf_time(valid_from, *next_period.start_ddhhmm)
+                        break
+            else:
+                period.end = resolve_taf_time(valid_from, *period.end_ddhhmm)
+
+    def to_dict(self, date_as_ISO_text=False):
+        """
+        Returns the forecast as a dictionary, in the format read_taf_ZA has always returned (with the decoded periods added)
+        
+        Parameters
+        ----------
+        date_as_ISO_text: boolean, optional
+            Return the TAF Dates/Times as ISO text strings (allows use in JSON)
+        
+        Returns
+        -------
+        dict
+        """
+        
+        periods = [p.to_dict() for p in self.periods]
+        
+        if date_as_ISO_text == True:
+            iso = lambda dt: None if dt is None else dt.isoformat()
+            for p in periods:
+                p['start'] = iso(p['start'])
+                p['end'] = iso(p['end'])
+            return {'aerodrome': self.aerodrome , 'coords': self.coords, 'is_amended_corrected': self.is_amended_corrected, 
+                    'time': iso(self.time), 'valid_from': iso(self.valid_from), 'valid_to': iso(self.valid_to), 
+                    'periods': periods, 'body': self.body}
+        
+        return {'aerodrome': self.aerodrome , 'coords': self.coords, 'is_amended_corrected': self.is_amended_corrected, 
+                'time': self.time, 'valid_from': self.valid_from, 'valid_to': self.valid_to, 
+                'periods': periods, 'body': self.body}
+
+
+class SigmetReport():
+    """
+    A Class to represent a single SIGMET or AIRMET, with the area it applies to
+    Uses __slots__ to keep the per-report memory small
+    
+    SIGMETs/AIRMETs are not issued for a station - reports are equal (and hash the same) when they have the same type,
+    validity start and text, so they can be de-duplicated with sets and dictionaries
+    
+    Methods
+    -------
+    to_dict()
+        Returns the report as the dictionary used by templates and the map
+    """
+    
+    __slots__ = ('type', 'valid_from', 'valid_to', 'body', 'coords', 'flevels')
+    
+    def __init__(self, sa_type, valid_from, valid_to, body, coords, flevels=None):
+        self.type = sa_type
+        self.valid_from = valid_from
+        self.valid_to = valid_to
+        self.body = body
+        self.coords = coords
+        self.flevels = flevels
+
+    def __repr__(self):
+        return f'<SigmetReport {self.type} {self.valid_from} - {self.valid_to}>'
+    
+    @property
+    def key(self):
+        """ The type, validity start and text - identifies the report """
+        return (self.type, self.valid_from, self.body)
+    
+    def __eq__(self, other):
+        if not isinstance(other, SigmetReport):
+            return NotImplemented
+        return self.key == other.key
+    
+    def __hash__(self):
+        return hash(self.key)
+    
+    def to_dict(self):
+        """
+        Returns the report as a dictionary, in the format read_sigmet_airmet_ZA has always returned
+        
+        Returns
+        -------
+        dict
+        """
+        
+        return {'type': self.type, 'valid_from': self.valid_from, 'valid_to': self.valid_to, 
+                'body': self.body, 'coords': self.coords, 'flevels': self.flevels}
+
+
+class WeatherDateResolver():
+    """
+    A Class to work out the full dates of METAR/TAF/SIGMET times, which only give the day of the month.
+    
+    One resolver is created per scrape, with a single reference time - so every time on a page is resolved
+    against the same "now", even if the scrape runs over midnight or the end of a month.
+    The day of month -> (year, month) mapping is worked out once when the resolver is created:
+    today, then tomorrow (TAF validity may be in the future), then back in time up to 25 days (old METARs)
+    
+    Methods
+    -------
+    resolve(day, hr, mn=0)
+        Returns the full date and time for a day of month, hour and minute
+    """
+    
+    __slots__ = ('now', 'months')
+    
+    def __init__(self, now=None):
+        self.now = datetime.utcnow() if now is None else now
+        
+        # Map each day of month in the window to its year and month - the first (closest) match is kept
+        self.months = {}
+        for d in [0, -1] + list(range(1, 26)):
+            full_date = self.now - timedelta(days=d)
+            self.months.setdefault(full_date.day, (full_date.year, full_date.month))
+
+    def __repr__(self):
+        return f'<WeatherDateResolver {self.now}>'
+    
+    def resolve(self, day, hr, mn=0):
+        """ Returns the full date and time for a METAR/TAF/SIGMET day of month, hour and minute
+        
+        Parameters
+        ----------
+        day: int
+            Day of month
+        hr: int
+            Hour - 24 is the end of the day, and is returned as hour 0 of the next day
+        mn: int, optional
+            Minute
+        
+        Returns
+        -------
+            datetime
+                The full date and time
+            OR
+            None
+                If the day is not in the window around the reference time
+        """
+        
+        yr_mth = self.months.get(day)
+        if yr_mth is None:
+            return None
+        
+        if hr == 24: #Aviation weather uses hr 24, python only uses 0-23.  If hr is 24, make it 0 on the next day
+            return datetime(yr_mth[0], yr_mth[1], day, 0, mn) + timedelta(days=1)
+        
+        return datetime(yr_mth[0], yr_mth[1], day, hr, mn)
+
+
+def resolve_taf_time(anchor, day, hr, mn=0):
+    """ Places a TAF day-of-month/hour/minute in the few days starting at the anchor date - normally the TAF's validity start.
+    Hour 24 is the end of the day, and is returned as hour 0 of the next day
+    
+    Parameters
+    ----------
+    anchor: datetime
+        Date and time from which to search forward - normally the TAF's validity start
+    day: int
+        Day of month
+    hr: int
+        Hour
+    mn: int, optional
+        Minute
+    
+    Returns
+    -------
+        datetime
+            The full date and time
+        OR
+        None
+            If the anchor is not known, or the day is not in the 3 days following the anchor
+    """
+    
+    if anchor is None:
+        return None
+    
+    # TAFs are valid for at most 30 hours, so the day must be within 3 days of the anchor
+    for d in range(0, 3):
+        full_date = anchor + timedelta(days=d)
+        if full_date.day == day:
+            if hr == 24:
+                return datetime(full_date.year, full_date.month, full_date.day, 0, mn) + timedelta(days=1)
+            return datetime(full_date.year, full_date.month, full_date.day, hr, mn)
+    
+    return None
+
+
+def taf_conditions_text(period_dict):
+    """ Returns a short text description of the conditions in a TAF period dictionary - eg. '31010G20KT 9999 -TSRA BKN030CB'
+    
+    Parameters
+    ----------
+    period_dict: dict
+        A period dictionary, as returned by TafPeriod.to_dict or TafIndex.conditions_at
+    
+    Returns
+    -------
+        str
+    """
+    
+    items = []
+    
+    wind = period_dict['wind']
+    if wind is not None:
+        direction = 'VRB' if wind['is_variable'] else f"{wind['direction']:03d}"
+        gust = '' if wind['gusting'] is None else f"G{wind['gusting']:02d}"
+        items.append(f"{direction}{wind['speed']:02d}{gust}KT")
+    
+    if period_dict['is_cavok']:
+        items.append('CAVOK')
+    else:
+        if period_dict['visibility'] is not None:
+            items.append(f"{period_dict['visibility']:04d}")
+        if period_dict['weather'] is not None:
+            items += period_dict['weather'] if period_dict['weather'] else ['NSW']
+        if period_dict['vertical_visibility'] is not None:
+            items.append(f"VV{period_dict['vertical_visibility'] // 100:03d}")
+        if period_dict['clouds'] is not None:
+            if period_dict['clouds']:
+                for cover, height, cloud_type in period_dict['clouds']:
+                    items.append(f"{cover}{'///' if height is None else f'{height // 100:03d}'}{cloud_type or ''}")
+            else:
+                items.append('NSC')
+    
+    return ' '.join(items)
+
+
+# Regular expressions for the TAF groups that differ from METAR groups - each is matched against a single token
+_re_taf_time = _re_met_time  # 171000Z
+_re_taf_validity = re.compile(r'^(?P<from_day>\d{2})(?P<from_hr>\d{2})/(?P<to_day>\d{2})(?P<to_hr>\d{2})$')  # 1712/1818
+_re_taf_from = re.compile(r'^FM(?P<day>\d{2})(?P<hr>\d{2})(?P<mn>\d{2})$')  # FM171400
+_re_taf_prob = re.compile(r'^PROB(?P<prob>\d{2})$')  # PROB30
+_re_taf_temperature = re.compile(r'^T[XN]M?\d{2}/\d{4}Z$')  # TX31/1712Z TN03/1804Z
+
+
+def decode_taf(taf_string):
+    """ Decodes the text of a TAF into a TafForecast, walking the groups in one pass and splitting the forecast into
+    its base period and FM/BECMG/TEMPO/PROB change groups.
+    The text may include a prefix before the TAF keyword - eg. 'View DecodedTAF FAOR 171000Z 1712/1818 30012KT CAVOK TX31/1712Z ...'
+    Day/hour values are decoded - the full dates are set by TafForecast.resolve_times
+    
+    Parameters
+    ----------
+    taf_string: str
+        Text containing the TAF
+    
+    Returns
+    -------
+        TafForecast
+            The decoded forecast
+        OR
+        None
+            If the text is not a TAF, or has no validity period
+    """
+    
+    taf_string = taf_string.replace(u'\xa0',' ') #replace \xa0 (a unicode non-breaking space) with a normal space.
+    
+    # Determine if this is an amended TAF, normal TAF, or a line to be ignored
+    s = taf_string.find('TAF AMD') + taf_string.find('TAF COR') + 1# Is it an amended/corrected TAF?
+    
+    # This is an amended TAF
+    if s >= 0:
+        amendment = taf_string[s+4:s+7] # AMD or COR
+        s+=7 # the length of text "TAF AMD"
+        is_amended_corrected = True
+    
+    # If text not found, is this a normal TAF?
+    else:
+        s = taf_string.find('TAF') # Is it a normal TAF?
+        # This is neither - ignore it
+        if s < 0:
+            return None
+        s+=3 # the length of text "TAF"
+        is_amended_corrected = False
+        amendment = None
+    
+    # Remove TAF text - we should now have the raw TAF only (eg. 'FAWK 170900Z 1710/1718 31010KT CAVOK TX31/1712Z TN23/1718Z=')
+    taf_string = taf_string[s:].strip()
+    
+    tokens = taf_string.replace('=', ' ').split()
+    if len(tokens) < 3:
+        return None
+    
+    taf = TafForecast(aerodrome=tokens[0], body=taf_string)
+    taf.is_amended_corrected = is_amended_corrected
+    taf.amendment = amendment
+    
+    period = None  # The period currently being decoded
+    period_tokens = []  # The tokens of the current period - kept to rebuild the period's text
+    pending_prob = None  # A PROBnn group waiting to see if it is followed by TEMPO
+    
+    for token in tokens[1:]:
+        
+        # Header groups - issue time and validity
+        if period is None:
+            if taf.issue_ddhhmm is None:
+                tmp = _re_taf_time.match(token)
+                if tmp:
+                    taf.issue_ddhhmm = (int(tmp.group('day')), int(tmp.group('hr')), int(tmp.group('mn')))
+                    continue
+            tmp = _re_taf_validity.match(token)
+            if tmp:
+                taf.valid_from_ddhh = (int(tmp.group('from_day')), int(tmp.group('from_hr')))
+                taf.valid_to_ddhh = (int(tmp.group('to_day')), int(tmp.group('to_hr')))
+                period = TafPeriod('BASE')
+                taf.periods.append(period)
+                continue
+            if token == 'NIL':
+                return None
+            continue
+        
+        # A new change group - close off the current period
+        if token in ('BECMG', 'TEMPO') or token.startswith('FM') or token.startswith('PROB'):
+            tmp_fm = _re_taf_from.match(token)
+            tmp_prob = _re_taf_prob.match(token)
+            
+            if tmp_fm or tmp_prob or token in ('BECMG', 'TEMPO'):
+                
+                # PROB30 TEMPO - the TEMPO belongs to the PROB group already started
+                if token == 'TEMPO' and pending_prob is not None and period.start_ddhhmm is None:
+                    period.change = 'TEMPO'
+                    period_tokens.append(token)
+                    continue
+                
+                period.body = ' '.join(period_tokens)
+                period_tokens = []
+                pending_prob = None
+                
+                if tmp_fm:
+                    period = TafPeriod('FM')
+                    period.start_ddhhmm = (int(tmp_fm.group('day')), int(tmp_fm.group('hr')), int(tmp_fm.group('mn')))
+                elif tmp_prob:
+                    pending_prob = int(tmp_prob.group('prob'))
+                    period = TafPeriod('PROB', pending_prob)
+                else:
+                    period = TafPeriod(token)
+                
+                taf.periods.append(period)
+                period_tokens.append(token)
+                continue
+        
+        period_tokens.append(token)
+        
+        # Change period for BECMG/TEMPO/PROB groups - eg. 1714/1716
+        if period.change != 'BASE' and period.change != 'FM' and period.start_ddhhmm is None:
+            tmp = _re_taf_validity.match(token)
+            if tmp:
+                period.start_ddhhmm = (int(tmp.group('from_day')), int(tmp.group('from_hr')), 0)
+                period.end_ddhhmm = (int(tmp.group('to_day')), int(tmp.group('to_hr')), 0)
+                continue
+        
+        if token == 'CNL':
+            taf.is_cancelled = True
+            continue
+        
+        if period.wind_speed is None:
+            tmp = _re_met_wind.match(token)
+            if tmp:
+                if tmp.group('direction') == 'VRB':
+                    period.wind_direction = -1
+                    period.wind_variable = True
+                else:
+                    period.wind_direction = int(tmp.group('direction'))
+                period.wind_speed = int(tmp.group('spd'))
+                if tmp.group('gust'):
+                    period.wind_gust = int(tmp.group('gust'))
+                continue
+        
+        if token == 'CAVOK':
+            period.is_cavok = True
+            period.visibility = 9999
+            period.weather = []
+            period.clouds = []
+            continue
+        
+        # Max/min temperature groups are not kept
+        if _re_taf_temperature.match(token):
+            continue
+        
+        if period.visibility is None:
+            tmp = _re_met_visibility.match(token)
+            if tmp:
+                period.visibility = int(tmp.group('vis'))
+                continue
+        
+        tmp = _re_met_cloud.match(token)
+        if tmp:
+            height = tmp.group('height')
+            if period.clouds is None:
+                period.clouds = []
+            period.clouds.append((tmp.group('cover'), None if height == '///' else int(height) * 100, tmp.group('type')))
+            continue
+        
+        if token in ('NSC', 'SKC'):
+            period.clouds = []
+            continue
+        
+        if token == 'NSW':
+            period.weather = []
+            continue
+        
+        tmp = _re_met_vertical_vis.match(token)
+        if tmp:
+            height = tmp.group('height')
+            period.vertical_visibility = None if height == '///' else int(height) * 100
+            continue
+        
+        if _re_met_weather.match(token) and token.strip('+-'):
+            if period.weather is None:
+                period.weather = []
+            period.weather.append(token)
+            continue
+    
+    # A TAF without a validity period cannot be used
+    if period is None:
+        return None
+    
+    period.body = ' '.join(period_tokens)
+    
+    # Change groups without a valid time cannot be placed in the forecast - drop them
+    taf.periods = [p for p in taf.periods if p.change == 'BASE' or p.start_ddhhmm is not None]
+    
+    return taf
+
+
+# Elements of a TAF period that a change group can replace
+_taf_condition_keys = ('wind', 'visibility', 'is_cavok', 'weather', 'clouds', 'vertical_visibility')
+
+
+class TafIndex():
+    """
+    An interval index over decoded TAFs, answering "what are the forecast conditions at station X at time T" with a 
+    binary search, rather than re-reading the TAF text for each question.
+    
+    When built, each station's TAF is split into consecutive intervals at every period boundary.  For each interval the 
+    prevailing conditions (the base forecast with FM and BECMG groups applied) and the TEMPO/PROB groups in force are stored,
+    so a lookup is a bisect on the interval start times - O(log n) in the number of intervals.
+    BECMG changes are applied from the start of their change period (the earliest the new conditions can be expected).
+    
+    Methods
+    -------
+    conditions_at(aerodrome, when)
+        Returns the forecast conditions for the aerodrome at the given time
+    """
+    
+    def __init__(self, taf_list):
+        """
+        Parameters
+        ----------
+        taf_list: list
+            TAF dictionaries (as returned by read_taf_ZA) or TafForecast objects
+        """
+        
+        # aerodrome: (list of interval start times, list of (interval end time, prevailing, temporary, taf dict))
+        self._stations = {}
+        
+        latest_tafs = {}
+        for taf in taf_list:
+            if isinstance(taf, TafForecast):
+                taf = taf.to_dict()
+            if taf.get('valid_from') is None or taf.get('valid_to') is None or not taf.get('periods'):
+                continue
+            # Where a station has more than one TAF (eg. an amendment), use the latest
+            current = latest_tafs.get(taf['aerodrome'])
+            if current is None or (taf['time'] is not None and (current['time'] is None or taf['time'] >= current['time'])):
+                latest_tafs[taf['aerodrome']] = taf
+        
+        for aerodrome, taf in latest_tafs.items():
+            self._stations[aerodrome] = self._build_intervals(taf)
+    
+    def __len__(self):
+        return len(self._stations)
+    
+    def __contains__(self, aerodrome):
+        return aerodrome in self._stations
+    
+    @staticmethod
+    def _build_intervals(taf):
+        """ Splits a TAF dictionary into consecutive intervals of unchanging conditions """
+        
+        periods = [p for p in taf['periods'] if p['start'] is not None and p['end'] is not None]
+        
+        # Every period start and end is a boundary, within the TAF's validity
+        boundaries = {taf['valid_from'], taf['valid_to']}
+        for p in periods:
+            boundaries.add(max(p['start'], taf['valid_from']))
+            boundaries.add(min(p['end'], taf['valid_to']))
+        boundaries = sorted(b for b in boundaries if taf['valid_from'] <= b <= taf['valid_to'])
+        
+        starts = []
+        intervals = []
+        for interval_start, interval_end in zip(boundaries[:-1], boundaries[1:]):
+            prevailing = None
+            temporary = []
+            for p in periods:
+                if p['change'] in ('BASE', 'FM'):
+                    # BASE and FM periods replace the conditions entirely
+                    if p['start'] <= interval_start < p['end']:
+                        prevailing = dict(p)
+                elif p['change'] == 'BECMG':
+                    # BECMG changes persist after the change period, until the next FM
+                    if p['start'] <= interval_start and prevailing is not None and prevailing['start'] <= p['start']:
+                        prevailing = dict(prevailing)
+                        for key in _taf_condition_keys:
+                            if p[key] is not None and p[key] is not False:
+                                prevailing[key] = p[key]
+                        if p['is_cavok']:
+                            prevailing['is_cavok'] = True
+                        elif p['visibility'] is not None or p['weather'] or p['clouds']:
+                            prevailing['is_cavok'] = False
+                        prevailing['body'] = prevailing['body'] + ' ' + p['body']
+                elif p['start'] <= interval_start < p['end']:
+                    temporary.append(p)
+            
+            if prevailing is not None:
+                prevailing['start'] = interval_start
+                prevailing['end'] = interval_end
+                prevailing['summary'] = taf_conditions_text(prevailing)
+            
+            starts.append(interval_start)
+            intervals.append((interval_end, prevailing, temporary, taf))
+        
+        return starts, intervals
+    
+    def conditions_at(self, aerodrome, when):
+        """ Returns the forecast conditions for an aerodrome at a specific time
+        
+        Parameters
+        ----------
+        aerodrome: str
+            ICAO code of the aerodrome
+        when: datetime
+            The time for which the forecast is needed
+        
+        Returns
+        -------
+            dict
+                aerodrome: ICAO code
+                time: the time asked for
+                prevailing: period dictionary of the prevailing conditions (with a 'summary' text)
+                temporary: list of the TEMPO/PROB period dictionaries in force
+                taf: the TAF dictionary the conditions come from
+            OR
+            None
+                If there is no TAF for the aerodrome valid at that time
+        """
+        
+        station = self._stations.get(aerodrome)
+        if station is None:
+            return None
+        
+        starts, intervals = station
+        pos = bisect_right(starts, when) - 1
+        if pos < 0:
+            return None
+        
+        interval_end, prevailing, temporary, taf = intervals[pos]
+        if when >= interval_end:
+            return None
+        
+        return {'aerodrome': aerodrome, 'time': when, 'prevailing': prevailing, 'temporary': temporary, 'taf': taf}
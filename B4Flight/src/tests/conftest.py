@@ -0,0 +1,64 @@
+"""Shared pytest fixtures for the flightbriefing tests
+
+The flightbriefing modules read flightbriefing.ini when they are imported (refer data_handling).  If it has not been created,
+a temporary one is written from "template flightbriefing.ini" for the test session - with an in-memory SQLite database,
+and the app's folders in a temporary folder - and removed afterwards.
+Run from the src folder:  python -m pytest tests
+
+"""
+
+import os
+import configparser
+import logging.handlers
+
+import pytest
+
+
+APP_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'flightbriefing')
+APP_INI = os.path.join(APP_FOLDER, 'flightbriefing.ini')
+TEMPLATE_INI = os.path.join(APP_FOLDER, 'template flightbriefing.ini')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def app_ini(tmp_path_factory):
+    """ Writes a temporary flightbriefing.ini from the template if there is none - before any flightbriefing module is imported """
+
+    if os.path.exists(APP_INI):
+        yield APP_INI
+        return
+
+    # Read the template without interpolation, so values are written back unchanged
+    cfg = configparser.ConfigParser(interpolation=None)
+    cfg.read(TEMPLATE_INI)
+
+    cfg.set('database', 'connect_string', 'sqlite://')
+    cfg.set('application', 'secret_key', 'flightbriefing-tests')
+
+    # Absolute paths are used as they are, rather than relative to the instance folder
+    app_folders = tmp_path_factory.mktemp('instance')
+    for section, option in (('application', 'working_folder'), ('application', 'upload_archive_folder'),
+                            ('notam_import_ZA', 'archive_folder'), ('maps', 'tile_cache_folder'), ('weather', 'archive_folder')):
+        cfg.set(section, option, str(app_folders / cfg.get(section, option)))
+
+    with open(APP_INI, 'w') as f:
+        cfg.write(f)
+
+    try:
+        yield APP_INI
+    finally:
+        os.remove(APP_INI)
+
+
+@pytest.fixture
+def app(app_ini):
+    """ The flightbriefing app, with the settings from flightbriefing.ini """
+
+    from flightbriefing import create_app
+
+    app = create_app({'TESTING': True})
+
+    # Errors logged by the tests should not be e-mailed to the administrator
+    for handler in [h for h in app.logger.handlers if isinstance(h, logging.handlers.SMTPHandler)]:
+        app.logger.removeHandler(handler)
+
+    return app
@@ -0,0 +1,56 @@
+"""Tests that the hot queries' indexes are checked on an existing database (refer db.check_query_plans)
+
+A database created before an index was added to the models does not have it - create-db only creates indexes along with
+new tables.  These tests drop an index from a SQLite database built from the models, and check it is reported, and that
+create-db-indexes adds it back.
+
+"""
+
+import os
+
+import pytest
+from sqlalchemy import create_engine, text
+
+
+DROPPED_INDEX = 'IX_Notams_BriefingID_Notam_Number'
+
+
+@pytest.fixture
+def db_engine(tmp_path):
+    """ A SQLite database file created from the ORM models, without the DROPPED_INDEX """
+
+    from flightbriefing.db import Base
+
+    sqa_engine = create_engine(f'sqlite:///{os.path.join(str(tmp_path), "test.db")}')
+    Base.metadata.create_all(bind=sqa_engine)
+    with sqa_engine.begin() as conn:
+        conn.execute(text(f'DROP INDEX {DROPPED_INDEX}'))
+
+    yield sqa_engine
+
+    sqa_engine.dispose()
+
+
+def test_models_use_indexes():
+    from flightbriefing.db import check_query_plans
+
+    assert [description for description, plan, scanned in check_query_plans() if scanned] == []
+
+
+def test_missing_index_is_reported(db_engine):
+    from flightbriefing.db import find_missing_indexes, check_query_plans
+
+    assert [index.name for index in find_missing_indexes(db_engine)] == [DROPPED_INDEX]
+
+    # Without the index, the briefing's NOTAMs are read by scanning the whole table
+    scanned_tables = {table for description, plan, scanned in check_query_plans(db_engine) for table in scanned}
+    assert 'Notams' in scanned_tables
+
+
+def test_create_missing_indexes(db_engine):
+    from flightbriefing.db import find_missing_indexes, create_missing_indexes, check_query_plans
+
+    assert create_missing_indexes(db_engine) == [DROPPED_INDEX]
+
+    assert find_missing_indexes(db_engine) == []
+    assert [description for description, plan, scanned in check_query_plans(db_engine) if scanned] == []
@@ -0,0 +1,61 @@
+"""Tests that weather responses are tagged by their content, not by the weather snapshot they came from
+
+The snapshot version is counted separately in each web process, and changes at every refresh - a client should still
+get a 304 (Not Modified) when a refresh brings no new reports
+
+"""
+
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def metar():
+    """ A decoded METAR for FAOR, with its time and aerodrome co-ordinates """
+
+    from flightbriefing.weather_parsing import decode_metar
+
+    obs = decode_metar('METAR FAOR 170900Z 19015KT CAVOK 15/M03 Q1020=')
+    obs.time = datetime(2026, 10, 17, 9, 0)
+    obs.coords = [28.24, -26.13]
+    return obs
+
+
+def _use_snapshot(app, monkeypatch, version, metar_records):
+    """ Makes a weather snapshot with the METARs, and makes it the current snapshot - returns it """
+
+    from flightbriefing import weather_cache
+
+    with app.app_context():
+        snapshot = weather_cache.WeatherSnapshot(version, [], metar_records, [])
+    monkeypatch.setattr(weather_cache, '_snapshot', snapshot)
+    return snapshot
+
+
+def test_layer_hash_follows_content(app, monkeypatch, metar):
+    from flightbriefing.weather_cache import METAR_LAYER
+
+    first = _use_snapshot(app, monkeypatch, 0, [metar])
+    refreshed = _use_snapshot(app, monkeypatch, 1, [metar])
+    changed = _use_snapshot(app, monkeypatch, 2, [])
+
+    assert first.layer_hashes[METAR_LAYER] == refreshed.layer_hashes[METAR_LAYER]
+    assert first.layer_hashes[METAR_LAYER] != changed.layer_hashes[METAR_LAYER]
+
+
+def test_api_not_modified_after_refresh(app, monkeypatch, metar):
+    client = app.test_client()
+
+    _use_snapshot(app, monkeypatch, 0, [metar])
+    first = client.get('/api/metar')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    # A refresh with the same reports - the client's copy is still current
+    _use_snapshot(app, monkeypatch, 1, [metar])
+    assert client.get('/api/metar', headers={'If-None-Match': etag}).status_code == 304
+
+    # A refresh that changes the reports
+    _use_snapshot(app, monkeypatch, 2, [])
+    assert client.get('/api/metar', headers={'If-None-Match': etag}).status_code == 200
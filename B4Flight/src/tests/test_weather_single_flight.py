@@ -0,0 +1,106 @@
+"""Tests that concurrent weather reads share one upstream fetch
+
+A local stand-in HTTP server serves a SIGMET page, counting the requests it receives and waiting before it responds
+(a slow upstream), while several threads read the page at once - each in its own app context, as request threads are
+
+"""
+
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+CALLERS = 20
+
+# Seconds the stand-in server waits before responding - long enough for all the callers to arrive while the fetch is running
+UPSTREAM_DELAY = 0.5
+
+
+def _sigmet_page():
+    """ A SIGMET page with one SIGMET, valid from today """
+
+    today = datetime.utcnow().day
+    return (f'<html><body><pre>FAJA SIGMET A01 VALID {today:02d}1200/{today:02d}1600 FAOR- FAJA JOHANNESBURG FIR SEV TURB FCST '
+            f'WI S2600 E02800 - S2700 E02900 - S2800 E02800 - S2600 E02800 SFC/FL100 STNR NC=</pre></body></html>').encode('utf-8')
+
+
+@pytest.fixture
+def upstream():
+    """ Starts the stand-in weather server - yields (URL of its SIGMET page, list of the paths it was asked for) """
+
+    content = _sigmet_page()
+    hits = []
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            time.sleep(UPSTREAM_DELAY)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    yield f'http://127.0.0.1:{server.server_address[1]}/sigmet.php', hits
+
+    server.shutdown()
+    server.server_close()
+
+
+def _read_concurrently(app, read):
+    """ Calls read(caller number) from CALLERS threads at once, each in its own app context - returns the results """
+
+    results = [None] * CALLERS
+    errors = []
+    start_barrier = threading.Barrier(CALLERS)
+
+    def call_reader(caller_no):
+        with app.app_context():
+            start_barrier.wait()
+            try:
+                results[caller_no] = read(caller_no)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=call_reader, args=(i,)) for i in range(CALLERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    return results
+
+
+def test_concurrent_reads_share_one_fetch(app, upstream):
+    from flightbriefing.weather import read_sigmet_airmet_ZA
+
+    url, hits = upstream
+    results = _read_concurrently(app, lambda caller_no: read_sigmet_airmet_ZA(url, as_records=True))
+
+    assert len(hits) == 1
+    assert len(results[0]) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_record_and_dictionary_reads_share_one_fetch(app, upstream):
+    from flightbriefing.weather import read_sigmet_airmet_ZA
+
+    url, hits = upstream
+
+    # Half the callers ask for the records (as the route filters do), half for dictionaries (as the weather snapshot does)
+    results = _read_concurrently(app, lambda caller_no: read_sigmet_airmet_ZA(url, as_records=(caller_no % 2 == 0)))
+
+    assert len(hits) == 1
+    assert all(result is results[0] for result in results[::2])
+    assert all(result == [met.to_dict() for met in results[0]] for result in results[1::2])
@@ -0,0 +1,107 @@
+"""Tests that requests keep using the weather snapshot while it is refreshed from a slow upstream host
+
+A local stand-in HTTP server serves empty weather pages, waiting before it responds (a host that is timing out).  Once the
+snapshot has expired, requests should get the existing snapshot straight away while one refresh runs in the background
+
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+CALLERS = 20
+
+# Seconds the stand-in server waits before responding
+UPSTREAM_DELAY = 1.0
+
+
+@pytest.fixture
+def upstream(app):
+    """ Starts the stand-in weather server, and points the app's weather URLs at it - yields the list of paths it was asked for """
+
+    content = b'<html><body></body></html>'
+    hits = []
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            time.sleep(UPSTREAM_DELAY)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    app.config.update(WEATHER_CACHE_TTL=300,
+                      WEATHER_SIGMET_AIRMET_URL_ZA=f'{base_url}/snapshot/sigmet.php',
+                      WEATHER_METAR_URL_ZA=f'{base_url}/snapshot/metar.php',
+                      WEATHER_TAF_URL_ZA=f'{base_url}/snapshot/taf.php')
+
+    yield hits
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def expired_snapshot(app, monkeypatch):
+    """ Sets the current weather snapshot to one older than WEATHER_CACHE_TTL - yields it """
+
+    from flightbriefing import weather_cache
+
+    with app.app_context():
+        snapshot = weather_cache.WeatherSnapshot(0, [], [], [])
+    snapshot.refreshed = datetime.utcnow() - timedelta(hours=1)
+    monkeypatch.setattr(weather_cache, '_snapshot', snapshot)
+
+    yield snapshot
+
+    # Let any refresh still running finish, so it does not replace the next test's snapshot
+    with weather_cache._snapshot_lock:
+        pass
+
+
+def test_requests_use_existing_snapshot_during_refresh(app, upstream, expired_snapshot):
+    from flightbriefing import weather_cache
+
+    results = [None] * CALLERS
+    waits = [None] * CALLERS
+    start_barrier = threading.Barrier(CALLERS)
+
+    def request_weather(caller_no):
+        with app.app_context():
+            start_barrier.wait()
+            started = time.monotonic()
+            results[caller_no] = weather_cache.get_weather_snapshot()
+            waits[caller_no] = time.monotonic() - started
+
+    threads = [threading.Thread(target=request_weather, args=(i,)) for i in range(CALLERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # No request waited for the slow host - including the one that started the refresh
+    assert all(result is expired_snapshot for result in results)
+    assert max(waits) < UPSTREAM_DELAY / 2
+
+    # The one refresh then replaces the snapshot
+    with weather_cache._snapshot_lock:
+        pass
+    with app.app_context():
+        new_snapshot = weather_cache.get_weather_snapshot()
+
+    assert new_snapshot.version == expired_snapshot.version + 1
+    assert sorted(upstream) == ['/snapshot/metar.php', '/snapshot/sigmet.php', '/snapshot/taf.php']